@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+'''
+Times the phases of send-stream ingestion -- parse, apply, freeze, and
+render -- on synthetic send-streams (see `synthetic_sendstreams.py`),
+and emits the results as JSON, so that commits can be compared.
+
+Usage:
+
+  python3 -m btrfs_diff.benchmarks.benchmark_ingest \\
+      --output before.json
+  # ... change the code ...
+  python3 -m btrfs_diff.benchmarks.benchmark_ingest \\
+      --output after.json --compare before.json
+
+Use `--scenario` to run a subset of `SCENARIOS`, `--param` to override
+their `SyntheticParams`, and `--scale` for quick, smaller runs.
+
+Each phase is run `--repeat` times, and we report the minimum & median of
+its wall & CPU times.  The minimum is the least noisy statistic, so
+`--compare` uses that.
+'''
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from io import BytesIO
+from typing import Dict, List, Tuple
+
+from ..freeze import freeze
+from ..ingest_stats import start_timer
+from ..parse_send_stream import parse_send_stream
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+from ..synthetic_sendstreams import (
+    gen_synthetic_sendstreams, SyntheticParams,
+)
+
+SCENARIOS = {
+    'many_small_files': SyntheticParams(num_files=5000, write_size=512),
+    'large_files': SyntheticParams(num_files=20, write_size=4 * 2 ** 20),
+    'deep_dirs': SyntheticParams(
+        num_files=2000, dir_depth=12, write_size=512,
+    ),
+    'clone_fanout': SyntheticParams(
+        num_files=500, write_size=64 * 1024, clone_fanout=8,
+    ),
+    'snapshot_chain': SyntheticParams(num_files=1000, snapshot_chain=10),
+}
+PHASES = ('parse', 'apply', 'freeze', 'render')
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode().strip()
+    except Exception:  # Not in a repo, or no `git`
+        return None
+
+
+def _elapsed(timer):
+    wall_start, cpu_start = timer
+    return time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+
+def _run_once(sendstreams: List[bytes], phase_to_times: Dict[str, List]):
+    timer = start_timer()
+    streams_items = [
+        list(parse_send_stream(BytesIO(s))) for s in sendstreams
+    ]
+    phase_to_times['parse'].append(_elapsed(timer))
+
+    timer = start_timer()
+    subvols = SubvolumeSet.new()
+    for items in streams_items:
+        mutator = SubvolumeSetMutator.new(subvols, items[0])
+        for item in items[1:]:
+            mutator.apply_item(item)
+    phase_to_times['apply'].append(_elapsed(timer))
+
+    timer = start_timer()
+    frozen = freeze(subvols)
+    phase_to_times['freeze'].append(_elapsed(timer))
+
+    timer = start_timer()
+    frozen.map(lambda sv: sv.render())
+    phase_to_times['render'].append(_elapsed(timer))
+
+    return sum(len(items) for items in streams_items)
+
+
+def _summarize(times: List[Tuple[float, float]]):
+    walls, cpus = zip(*times)
+    return {
+        'min_wall_sec': min(walls),
+        'median_wall_sec': statistics.median(walls),
+        'min_cpu_sec': min(cpus),
+        'median_cpu_sec': statistics.median(cpus),
+    }
+
+
+def run_scenario(params: SyntheticParams, repeat: int):
+    sendstreams = list(gen_synthetic_sendstreams(params))
+    phase_to_times = {phase: [] for phase in PHASES}
+    for _ in range(repeat):
+        num_items = _run_once(sendstreams, phase_to_times)
+    return {
+        'params': params._asdict(),
+        'sendstream_bytes': sum(len(s) for s in sendstreams),
+        'num_items': num_items,
+        'phases': {
+            phase: _summarize(times)
+                for phase, times in phase_to_times.items()
+        },
+    }
+
+
+def compare(old, new, out):
+    'Prints the ratio of new to old `min_wall_sec` for each phase.'
+    for name, result in sorted(new['scenarios'].items()):
+        old_result = old['scenarios'].get(name)
+        if old_result is None:
+            continue
+        if old_result['params'] != result['params']:
+            print(f'{name}: parameters differ, not comparable', file=out)
+            continue
+        print(name + ': ' + ', '.join(
+            '{}: {:.2f}x'.format(
+                phase,
+                result['phases'][phase]['min_wall_sec'] /
+                    max(old_result['phases'][phase]['min_wall_sec'], 1e-9),
+            ) for phase in PHASES
+        ), file=out)
+
+
+def _parse_param(s: str):
+    k, sep, v = s.partition('=')
+    if not sep or k not in SyntheticParams._fields:
+        raise argparse.ArgumentTypeError(
+            f'Expected KEY=INT, with KEY in {SyntheticParams._fields}'
+        )
+    return k, int(v)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='Run only these scenarios. Repeatable. Default: all.',
+    )
+    parser.add_argument(
+        '--param', action='append', type=_parse_param, default=[],
+        metavar='KEY=INT',
+        help='Override a `SyntheticParams` field for all scenarios.',
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Multiply the number of files by this factor.',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='Write the JSON results here. Default: stdout.',
+    )
+    parser.add_argument(
+        '--compare', type=argparse.FileType('r'),
+        help='Results JSON from an earlier run. Prints speed ratios to '
+            'stderr.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    scenarios = {}
+    for name in (args.scenario or sorted(SCENARIOS)):
+        params = SCENARIOS[name]._replace(**dict(args.param))
+        scenarios[name] = params._replace(
+            num_files=max(1, int(params.num_files * args.scale)),
+        )
+
+    results = {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'scenarios': {
+            name: run_scenario(params, args.repeat)
+                for name, params in scenarios.items()
+        },
+    }
+    json.dump(results, args.output, sort_keys=True, indent=2)
+    args.output.write('\n')
+
+    if args.compare:
+        compare(json.load(args.compare), results, sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv)  # pragma: no cover
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+'''
+Optionally, while send-streams are being applied to a `SubvolumeSet`, we
+can hash the payloads of `write` commands in blocks.  This is the only
+point where we ever see file data -- the rest of `btrfs_diff` models just
+the layout of the data forks -- so it has to happen in the same pass as
+the parse.  The resulting digests let us quantify data that is duplicated
+across subvolumes (e.g. the layers of an image), but is NOT shared via
+clones, and is therefore a candidate for deduplication.
+
+Usage:
+
+    hasher = WriteBlockHasher()
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    for item in items:
+        hasher.apply_item(mutator, item)  # Instead of `mutator.apply_item`
+    frozen = freeze(
+        subvols, leaf_id_to_data_blocks=hasher.leaf_id_to_data_blocks,
+    )
+    index = DataBlockIndex.from_subvolume_set(frozen)
+
+`freeze` attaches the digests to the `Chunk`s as `DataBlock`s.  A block is
+only reported for a `Chunk` that contains it in full, since the digest says
+nothing about a partially overwritten block.
+
+The digests are attached to the ground-truth `Extent` leaf that each
+`write` creates.  Per the KEY INTERNAL INVARIANT in `extent.py`, clones
+and snapshots reuse that leaf object, so they need no special handling.
+
+Blocks never span `write` commands, which `btrfs send` caps at 48KiB, so
+the default 4KiB fixed-size blocks align with filesystem blocks.  The
+content-defined splitter is mainly useful for data that `btrfs send` did
+not emit at block-aligned offsets -- it is implemented in pure Python, and
+therefore much slower.
+'''
+import hashlib
+import itertools
+
+from collections import defaultdict
+from typing import (
+    Callable, Iterable, Iterator, List, Mapping, NamedTuple, Sequence, Set,
+    Tuple,
+)
+
+from .extent import Extent
+from .inode import DataBlock
+from .inode_id import InodeID
+from .send_stream import SendStreamItem, SendStreamItems
+from .subvolume import Subvolume
+from .subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+# Maps a `write` payload to the lengths of the blocks that it consists of.
+BlockSplitter = Callable[[bytes], Iterable[int]]
+
+_MASK_64 = 2 ** 64 - 1
+# Random-looking, but deterministic, constants for the "gear" rolling hash.
+_GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little')
+        for i in range(256)
+]
+
+
+def fixed_size_blocks(block_size: int) -> BlockSplitter:
+    'The last block of each `write` may be short.'
+    assert block_size > 0, block_size
+
+    def split(data: bytes) -> Iterator[int]:
+        for offset in range(0, len(data), block_size):
+            yield min(block_size, len(data) - offset)
+
+    return split
+
+
+def content_defined_blocks(
+    *, min_size: int, avg_size: int, max_size: int,
+) -> BlockSplitter:
+    '''
+    Cuts blocks where a "gear" rolling hash of the preceding bytes matches
+    a mask, as in FastCDC.  Unlike with fixed-size blocks, inserting bytes
+    into the data only affects the boundaries near the insertion.
+    '''
+    assert 0 < min_size <= avg_size <= max_size, (min_size, avg_size, max_size)
+    assert avg_size & (avg_size - 1) == 0, f'{avg_size} is not a power of 2'
+    # The high bits of the hash depend on the most preceding bytes.
+    avg_bits = avg_size.bit_length() - 1
+    mask = (avg_size - 1) << (64 - avg_bits)
+
+    def split(data: bytes) -> Iterator[int]:
+        start = 0
+        h = 0
+        for pos, byte in enumerate(data, 1):
+            h = ((h << 1) + _GEAR[byte]) & _MASK_64
+            size = pos - start
+            if size >= max_size or (size >= min_size and not (h & mask)):
+                yield size
+                start = pos
+                h = 0
+        if start < len(data):
+            yield len(data) - start
+
+    return split
+
+
+class WriteBlockHasher:
+    '''
+    Hashes `write` payloads as they are applied to a `SubvolumeSet`, see
+    the file docblock.
+    '''
+
+    def __init__(
+        self, *, split: BlockSplitter=None, hash_name: str='sha256',
+    ):
+        self._split = fixed_size_blocks(4096) if split is None else split
+        self._hash_name = hash_name
+        # Pass this to `freeze()` to annotate `Chunk`s.  Its `DataBlock`s
+        # have `offset == write_offset` until `freeze` relocates them.
+        self.leaf_id_to_data_blocks: Mapping[int, Sequence[DataBlock]] = {}
+        # Holding references keeps the `id()` keys above from being reused.
+        self._leaves: List[Extent] = []
+
+    def apply_item(self, mutator: SubvolumeSetMutator, item: SendStreamItem):
+        mutator.apply_item(item)
+        if isinstance(item, SendStreamItems.write):
+            self._hash_write(mutator, item)
+
+    def _hash_write(
+        self, mutator: SubvolumeSetMutator, item: SendStreamItems.write,
+    ):
+        ino = mutator.subvolume.inode_at_path(item.path)
+        # `Extent.write` puts the new, untrimmed leaf at `item.offset`.
+        (leaf_offset, length, leaf), = itertools.islice(
+            ino.extent.gen_trimmed_leaves(offset=item.offset), 1,
+        )
+        assert leaf.content is Extent.Kind.DATA, (item, ino)
+        assert (leaf_offset, length) == (0, len(item.data)), (item, ino)
+        assert id(leaf) not in self.leaf_id_to_data_blocks, (item, ino)
+
+        write_idx = len(self._leaves)
+        blocks = []
+        offset = 0
+        data = memoryview(item.data)
+        for block_len in self._split(item.data):
+            blocks.append(DataBlock(
+                offset=offset,
+                length=block_len,
+                digest=hashlib.new(
+                    self._hash_name, data[offset:offset + block_len],
+                ).hexdigest(),
+                write_idx=write_idx,
+                write_offset=offset,
+            ))
+            offset += block_len
+        assert offset == len(item.data), (offset, item)
+
+        self._leaves.append(leaf)
+        self.leaf_id_to_data_blocks[id(leaf)] = tuple(blocks)
+
+
+class DataBlockLocation(NamedTuple):
+    inode_id: InodeID
+    offset: int  # Into the data fork of the inode
+    length: int
+
+    def __repr__(self):
+        return f'{self.inode_id}:{self.offset}+{self.length}'
+
+
+class DataBlockIndex:
+    '''
+    Indexes the `DataBlock`s of frozen `Subvolume`s by digest, to find
+    identical blocks across files and subvolumes.
+    '''
+
+    def __init__(self):
+        self.digest_to_locations: Mapping[str, List[DataBlockLocation]] = \
+            defaultdict(list)
+        # The distinct `(write_idx, write_offset)` pairs of each digest.
+        # Identical blocks that are not shared via clones have several.
+        self.digest_to_copies: Mapping[str, Set[Tuple[int, int]]] = \
+            defaultdict(set)
+
+    @classmethod
+    def from_subvolume_set(cls, subvol_set: SubvolumeSet) -> 'DataBlockIndex':
+        index = cls()
+        for subvol in subvol_set.uuid_to_subvolume.values():
+            index.add_subvolume(subvol)
+        return index
+
+    def add_subvolume(self, subvol: Subvolume):
+        'Takes a frozen `Subvolume`, made with `leaf_id_to_data_blocks`.'
+        for ino_id, ino in subvol.id_to_inode.items():
+            chunk_offset = 0
+            for chunk in ino.chunks or ():
+                assert chunk.data_blocks is not None, \
+                    f'{ino_id} was not frozen with `leaf_id_to_data_blocks`'
+                for block in chunk.data_blocks:
+                    self.digest_to_locations[block.digest].append(
+                        DataBlockLocation(
+                            inode_id=ino_id,
+                            offset=chunk_offset + block.offset,
+                            length=block.length,
+                        )
+                    )
+                    self.digest_to_copies[block.digest].add(
+                        (block.write_idx, block.write_offset),
+                    )
+                chunk_offset += chunk.length
+
+    def _wasted_bytes(self, digest: str) -> int:
+        return (len(self.digest_to_copies[digest]) - 1) * \
+            self.digest_to_locations[digest][0].length
+
+    def duplicate_bytes(self) -> int:
+        'How many bytes deduplicating the indexed blocks would save.'
+        return sum(self._wasted_bytes(d) for d in self.digest_to_copies)
+
+    def gen_duplicates(self) -> Iterator[
+        Tuple[str, Sequence[DataBlockLocation]]
+    ]:
+        'Yields the duplicated blocks, the most wasteful ones first.'
+        for digest in sorted(
+            self.digest_to_copies,
+            key=lambda d: (-self._wasted_bytes(d), d),
+        ):
+            if len(self.digest_to_copies[digest]) > 1:
+                yield digest, self.digest_to_locations[digest]
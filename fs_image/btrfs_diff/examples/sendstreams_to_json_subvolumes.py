@@ -36,6 +36,7 @@ import json
 import sys
 
 from ..freeze import freeze
+from ..ingest_stats import IngestStats, maybe_phase
 from ..inode import InodeOwner
 from ..inode_utils import (
     erase_mode_and_owner, erase_selinux_xattr, erase_utimes_in_range,
@@ -99,6 +100,12 @@ def main(argv):
             'if necessary: "@minimally-unambuguous-uuid-prefix". If in '
             'doubt, first look at the output without `--show-only`.'
     )
+    parser.add_argument(
+        '--stats-json', type=argparse.FileType('w'),
+        help='Write to this file a JSON breakdown of the counts, bytes, and '
+            'the wall & CPU time spent parsing & applying each command '
+            'kind, and in each phase of freezing & rendering.',
+    )
     parser.add_argument(
         'sendstream', type=argparse.FileType('br'), nargs='+',
         help='A file containing the output of `btrfs send`. Note that '
@@ -107,14 +114,17 @@ def main(argv):
     )
     args = parser.parse_args(argv[1:])
 
+    stats = IngestStats() if args.stats_json else None
     subvols = SubvolumeSet.new()
     for sendstream_in in args.sendstream:
-        parsed = parse_send_stream(sendstream_in)
-        mutator = SubvolumeSetMutator.new(subvols, next(parsed))
+        parsed = parse_send_stream(sendstream_in, stats=stats)
+        mutator = SubvolumeSetMutator.new(subvols, next(parsed), stats=stats)
         for i in parsed:
             mutator.apply_item(i)
 
     # Check that our send-streams completely specified the subvolumes.
+    # Only the freeze for rendering below is timed, so that the stats do
+    # not count freezing twice.
     if not args.no_check_complete:
         for ino in freeze(subvols).inodes():
             ino.assert_valid_and_complete()
@@ -151,16 +161,25 @@ def main(argv):
                 raise RuntimeError(
                     f'Unknown subvol {which_subvol}, try without --show-only'
                 )
-            result[which_subvol] = emit_non_unique_traversal_ids(
-                freeze(subvol).render()
-            )
+            frozen_subvol = freeze(subvol, stats=stats)
+            with maybe_phase(stats, 'render'):
+                result[which_subvol] = emit_non_unique_traversal_ids(
+                    frozen_subvol.render()
+                )
     else:
-        result = freeze(subvols).map(
-            lambda sv: emit_non_unique_traversal_ids(sv.render())
-        )
+        frozen_subvols = freeze(subvols, stats=stats)
+        with maybe_phase(stats, 'render'):
+            result = frozen_subvols.map(
+                lambda sv: emit_non_unique_traversal_ids(sv.render())
+            )
     # Future: is there a `pprint`-style compact & pretty JSON output?
     print(json.dumps(result, sort_keys=True, indent=2))
 
+    if stats is not None:
+        json.dump(
+            stats.to_json_dict(), args.stats_json, sort_keys=True, indent=2,
+        )
+
 
 if __name__ == '__main__':
     main(sys.argv)
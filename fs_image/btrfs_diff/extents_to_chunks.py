@@ -114,10 +114,13 @@ the structures of the write forks, respecting `truncate`, `write`, and
 import functools
 
 from collections import defaultdict
-from typing import Dict, Iterable, NamedTuple, Sequence, Tuple
+from typing import (
+    Dict, Iterable, Mapping, NamedTuple, Optional, Sequence, Tuple,
+)
 
 from .extent import Extent
-from .inode import Clone, Chunk, ChunkClone
+from .ingest_stats import IngestStats, maybe_phase
+from .inode import Clone, Chunk, ChunkClone, DataBlock
 from .inode_id import InodeID
 
 
@@ -348,58 +351,157 @@ def _id_to_leaf_idx_to_chunk_clones(
     return id_to_leaf_idx_to_chunk_clones
 
 
+def _trimmed_leaf_data_blocks(
+    data_blocks: Sequence[DataBlock], offset: int, length: int,
+    chunk_offset: int,
+) -> Iterable[DataBlock]:
+    '''
+    Of the `write`-relative `data_blocks` of a leaf, yields the ones that
+    fit entirely in its trimmed portion, with `offset` now relative to the
+    `Chunk` that starts `chunk_offset` bytes before the trimmed leaf.
+    '''
+    for block in data_blocks:
+        if offset <= block.offset and \
+                block.offset + block.length <= offset + length:
+            yield block._replace(offset=block.offset - offset + chunk_offset)
+
+
+def sweep_clones(
+    ids_and_extents: Iterable[Tuple[InodeID, Extent]],
+    *,
+    stats: Optional[IngestStats]=None,
+) -> Mapping[InodeID, Mapping[int, Sequence[ChunkClone]]]:
+    '''
+    The global part of `extents_to_chunks_with_clones`: finds which parts
+    of the inodes clone each other.  Pass its result to `extent_to_chunks`.
+
+    If `stats` is set, this is timed as `clone_sweep`.
+    '''
+    with maybe_phase(stats, 'clone_sweep'):
+        return _id_to_leaf_idx_to_chunk_clones(ids_and_extents)
+
+
+def extent_to_chunks(
+    extent: Extent,
+    leaf_idx_to_chunk_clones: Mapping[int, Sequence[ChunkClone]],
+    *,
+    leaf_id_to_data_blocks: Optional[Mapping[int, Sequence[DataBlock]]]=None,
+) -> Sequence[Chunk]:
+    '''
+    The per-inode part of `extents_to_chunks_with_clones`. The second
+    argument is the value for this inode's ID in the `sweep_clones` output.
+    '''
+    new_chunks = []
+    for leaf_idx, (offset, length, extent) in enumerate(
+        extent.gen_trimmed_leaves()
+    ):
+        chunk_clones = leaf_idx_to_chunk_clones.get(leaf_idx, [])
+        assert isinstance(extent.content, Extent.Kind)
+
+        # If the chunk kind matches, merge into the previous chunk.
+        if new_chunks and new_chunks[-1].kind == extent.content:
+            prev_length = new_chunks[-1].length
+            prev_clones = new_chunks[-1].chunk_clones
+            prev_blocks = new_chunks[-1].data_blocks
+        else:  # Otherwise, make a new one.
+            prev_length = 0
+            prev_clones = set()
+            prev_blocks = None if leaf_id_to_data_blocks is None else []
+            new_chunks.append(None)
+
+        new_chunks[-1] = Chunk(
+            kind=extent.content,
+            length=length + prev_length,
+            chunk_clones=prev_clones,
+            data_blocks=prev_blocks,
+        )
+        new_chunks[-1].chunk_clones.update(
+            # Future: when switching to frozentype, __new__ should
+            # validate that clone offset & length are sane relative
+            # to the trimmed extent.
+            ChunkClone(
+                clone=clone,
+                # Subtract `offset` because `ChunkClone.offset` is
+                # Extent-relative, but in the actual file layout, the
+                # leaf Extent is trimmed further.
+                offset=clone_offset + prev_length - offset
+            ) for clone_offset, clone in chunk_clones
+        )
+        if prev_blocks is not None:
+            prev_blocks.extend(_trimmed_leaf_data_blocks(
+                leaf_id_to_data_blocks.get(id(extent), ()),
+                offset, length, prev_length,
+            ))
+    # Future: `deepfrozen` was made for this:
+    return tuple(
+        Chunk(
+            kind=c.kind,
+            length=c.length,
+            chunk_clones=frozenset(c.chunk_clones),
+            data_blocks=None if c.data_blocks is None
+                else tuple(c.data_blocks),
+        ) for c in new_chunks
+    )
+
+
 def extents_to_chunks_with_clones(
     ids_and_extents: Sequence[Tuple[InodeID, Extent]],
+    *,
+    leaf_id_to_data_blocks: Optional[Mapping[int, Sequence[DataBlock]]]=None,
+    stats: Optional[IngestStats]=None,
 ) -> Iterable[Tuple[InodeID, Sequence[Chunk]]]:
     '''
     Converts the nested, history-preserving `Extent` structures into flat
     sequences of `Chunk`s, while being careful to annotate cloned parts as
     described in this file's docblock.  The `InodeID`s are needed to ensure
     that the `Chunk`s' `Clone` objects refer to the appropriate files.
+
+    If `leaf_id_to_data_blocks` is set, `DATA` chunks also get the
+    `DataBlock`s of the leaf extents they contain, see `data_blocks.py`.
+
+    If `stats` is set, the global clone sweep is timed as `clone_sweep`.
     '''
-    id_to_leaf_idx_to_chunk_clones = _id_to_leaf_idx_to_chunk_clones(
-        ids_and_extents
+    id_to_leaf_idx_to_chunk_clones = sweep_clones(
+        ids_and_extents, stats=stats,
     )
     for ino_id, extent in ids_and_extents:
-        leaf_to_chunk_clones = id_to_leaf_idx_to_chunk_clones.get(ino_id, {})
-        new_chunks = []
-        for leaf_idx, (offset, length, extent) in enumerate(
-            extent.gen_trimmed_leaves()
-        ):
-            chunk_clones = leaf_to_chunk_clones.get(leaf_idx, [])
-            assert isinstance(extent.content, Extent.Kind)
-
-            # If the chunk kind matches, merge into the previous chunk.
-            if new_chunks and new_chunks[-1].kind == extent.content:
-                prev_length = new_chunks[-1].length
-                prev_clones = new_chunks[-1].chunk_clones
-            else:  # Otherwise, make a new one.
-                prev_length = 0
-                prev_clones = set()
-                new_chunks.append(None)
-
-            new_chunks[-1] = Chunk(
-                kind=extent.content,
-                length=length + prev_length,
-                chunk_clones=prev_clones,
-            )
-            new_chunks[-1].chunk_clones.update(
-                # Future: when switching to frozentype, __new__ should
-                # validate that clone offset & length are sane relative
-                # to the trimmed extent.
-                ChunkClone(
-                    clone=clone,
-                    # Subtract `offset` because `ChunkClone.offset` is
-                    # Extent-relative, but in the actual file layout, the
-                    # leaf Extent is trimmed further.
-                    offset=clone_offset + prev_length - offset
-                ) for clone_offset, clone in chunk_clones
+        yield ino_id, extent_to_chunks(
+            extent, id_to_leaf_idx_to_chunk_clones.get(ino_id, {}),
+            leaf_id_to_data_blocks=leaf_id_to_data_blocks,
+        )
+
+
+class LazyCloneSweep:
+    '''
+    Like `extents_to_chunks_with_clones`, but each inode's `Chunk`s are
+    only computed when requested.  The first request runs `sweep_clones`
+    over all of `ids_and_extents`, and the rest share its result.
+
+    IMPORTANT: The `Extent`s must not be mutated while this is in use.
+    '''
+
+    def __init__(
+        self,
+        ids_and_extents: Sequence[Tuple[InodeID, Extent]],
+        *,
+        leaf_id_to_data_blocks: Optional[
+            Mapping[int, Sequence[DataBlock]]
+        ]=None,
+        stats: Optional[IngestStats]=None,
+    ):
+        self._ids_and_extents = ids_and_extents
+        self._leaf_id_to_data_blocks = leaf_id_to_data_blocks
+        self._stats = stats
+        self._id_to_leaf_idx_to_chunk_clones = None
+
+    def chunks(self, ino_id: InodeID, extent: Extent) -> Sequence[Chunk]:
+        'The `InodeID` must be one of the pre-`freeze` IDs we were given.'
+        if self._id_to_leaf_idx_to_chunk_clones is None:
+            self._id_to_leaf_idx_to_chunk_clones = sweep_clones(
+                self._ids_and_extents, stats=self._stats,
             )
-        # Future: `deepfrozen` was made for this:
-        yield ino_id, tuple(
-            Chunk(
-                kind=c.kind,
-                length=c.length,
-                chunk_clones=frozenset(c.chunk_clones),
-            ) for c in new_chunks
+            self._ids_and_extents = None  # No longer needed
+        return extent_to_chunks(
+            extent, self._id_to_leaf_idx_to_chunk_clones.get(ino_id, {}),
+            leaf_id_to_data_blocks=self._leaf_id_to_data_blocks,
         )
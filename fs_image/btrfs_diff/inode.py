@@ -203,10 +203,32 @@ class ChunkClone(NamedTuple):
         return f'{repr(self.clone)}@{self.offset}'
 
 
+class DataBlock(NamedTuple):
+    '''
+    A content digest of a block of bytes that a `write` stored.  These are
+    only computed on request, see `data_blocks.py`.
+    '''
+    offset: int  # Offset into the `Chunk` (or the `write`, before freezing)
+    length: int
+    digest: str  # Hex digest of the block's bytes
+    # `write_idx` numbers the `write`s in order of application, and
+    # `write_offset` is the block's offset within that `write`'s payload.
+    # Together, they identify one stored copy of these bytes: clones of the
+    # same `write` share storage, so they are not counted as duplicates.
+    write_idx: int
+    write_offset: int
+
+    def __repr__(self):
+        return f'{self.digest[:8]}@{self.offset}+{self.length}'
+
+
 class Chunk(NamedTuple):
     kind: Extent.Kind
     length: int
     chunk_clones: Set[ChunkClone]
+    # Only populated when `write` payloads were hashed, see `data_blocks.py`.
+    # A block is listed only if this chunk contains it in full.
+    data_blocks: Optional[Sequence[DataBlock]] = None
 
     def __repr__(self):
         return f'({self.kind.name}/{self.length}' + (
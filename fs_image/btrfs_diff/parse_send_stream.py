@@ -6,8 +6,9 @@ import struct
 import uuid
 
 from io import BytesIO
-from typing import NamedTuple, Iterable
+from typing import NamedTuple, Iterable, Optional
 
+from .ingest_stats import IngestStats, start_timer
 from .send_stream import SendStreamItem, SendStreamItems
 
 BTRFS_SEND_STREAM_MAGIC = b'btrfs-stream\0'
@@ -319,11 +320,44 @@ def read_command(infile):
     raise AssertionError(f'Fix me: unhandled {cmd_header}')  # pragma: no cover
 
 
-def parse_send_stream(infile) -> Iterable[SendStreamItem]:
+# Every `CommandKind`, except for `END`, is parsed into one item type.
+ITEM_TYPE_TO_COMMAND_KIND = {
+    getattr(SendStreamItems, kind.name.lower()): kind
+        for kind in CommandKind if kind is not CommandKind.END
+}
+
+
+class _ByteCountingReader:
+    'Lets `IngestStats` measure commands without `tell()`, which pipes lack.'
+
+    def __init__(self, infile):
+        self._infile = infile
+        self.bytes_read = 0
+
+    def read(self, size: int) -> bytes:
+        b = self._infile.read(size)
+        self.bytes_read += len(b)
+        return b
+
+
+def parse_send_stream(
+    infile, *, stats: Optional[IngestStats]=None,
+) -> Iterable[SendStreamItem]:
     check_magic(infile)
     check_version(infile)
+    if stats is not None:
+        infile = _ByteCountingReader(infile)
     while True:
-        cmd = read_command(infile)
+        if stats is None:
+            cmd = read_command(infile)
+        else:
+            timer = start_timer()
+            bytes_before = infile.bytes_read
+            cmd = read_command(infile)
+            stats.kind_to_parsed[
+                CommandKind.END if cmd is None
+                    else ITEM_TYPE_TO_COMMAND_KIND[type(cmd)]
+            ].add(timer, infile.bytes_read - bytes_before)
         if cmd is None:
             return
         yield cmd
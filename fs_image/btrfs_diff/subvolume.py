@@ -24,6 +24,7 @@ mutate its state.
 '''
 import os
 
+from collections import abc
 from types import MappingProxyType
 from typing import (
     Any, Coroutine, Iterator, Mapping, NamedTuple, Optional, Sequence,
@@ -31,8 +32,9 @@ from typing import (
 )
 
 from .coroutine_utils import while_not_exited
-from .extents_to_chunks import extents_to_chunks_with_clones
+from .extents_to_chunks import LazyCloneSweep, extents_to_chunks_with_clones
 from .freeze import freeze
+from .ingest_stats import IngestStats
 from .inode_id import InodeID, InodeIDMap
 from .incomplete_inode import (
     IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
@@ -51,6 +53,55 @@ _DUMP_ITEM_TO_INCOMPLETE_INODE = {
 }
 
 
+class LazyInodeMap(abc.Mapping):
+    '''
+    The `id_to_inode` of a `Subvolume` that was frozen with `lazy=True`.
+    It is keyed by frozen `InodeID`s, like the eager `MappingProxyType`,
+    but it only freezes an `IncompleteInode` -- and computes its `Chunk`s,
+    if it is a file -- the first time it is accessed.  So, any errors in
+    the inode are also only raised then.
+
+    IMPORTANT: This refers to the inodes of the unfrozen `Subvolume`, which
+    must not be mutated after `freeze`.
+    '''
+
+    def __init__(
+        self, *, id_to_inode: Mapping[InodeID, IncompleteInode],
+        clone_sweep: LazyCloneSweep, _memo,
+    ):
+        self._id_to_inode = id_to_inode
+        self._clone_sweep = clone_sweep
+        self._memo = _memo
+        # `freeze` memoizes, so the frozen `InodeID`s and inodes that we
+        # hand out will be the same objects on every access.
+        self._frozen_to_id = {
+            freeze(id, _memo=_memo): id for id in id_to_inode
+        }
+        # `_memo` is keyed on `id()`, so we must keep the `Chunk`s that we
+        # froze alive, lest a new object reuse the ID of a freed one.
+        self._id_to_chunks = {}
+
+    def __getitem__(self, frozen_id: InodeID) -> 'Inode':
+        id = self._frozen_to_id[frozen_id]
+        ino = self._id_to_inode[id]
+        chunks = None
+        if hasattr(ino, 'extent'):
+            chunks = self._id_to_chunks.get(id)
+            if chunks is None:
+                chunks = self._clone_sweep.chunks(id, ino.extent)
+                self._id_to_chunks[id] = chunks
+        return freeze(ino, _memo=self._memo, chunks=chunks)
+
+    def __contains__(self, frozen_id: InodeID) -> bool:
+        return frozen_id in self._frozen_to_id  # Does not freeze the inode
+
+    def __iter__(self) -> Iterator[InodeID]:
+        return iter(self._frozen_to_id)
+
+    def __len__(self) -> int:
+        return len(self._frozen_to_id)
+
+
 # Future: `deepfrozen` would let us lose the `new` methods on NamedTuples,
 # and avoid `deepcopy`.
 class Subvolume(NamedTuple):
@@ -205,20 +256,49 @@ class Subvolume(NamedTuple):
         *,
         _memo,
         id_to_chunks: Optional[Mapping[InodeID, Sequence['Chunk']]]=None,
+        leaf_id_to_data_blocks: Optional[
+            Mapping[int, Sequence['DataBlock']]
+        ]=None,
+        stats: Optional[IngestStats]=None,
+        lazy: bool=False,
+        clone_sweep: Optional[LazyCloneSweep]=None,
     ):
         '''
         Returns a recursively immutable copy of `self`, replacing
         `IncompleteInode`s by `Inode`s, using the provided `id_to_chunks` to
         populate them with `Chunk`s instead of `Extent`s.
 
-        If `id_to_chunks` is omitted, we'll detect clones only within `self`.
+        If `id_to_chunks` is omitted, we'll detect clones only within `self`,
+        and annotate `Chunk`s with `leaf_id_to_data_blocks` if given.  In
+        that case, `stats` also gets the timing of the clone sweep.
+
+        With `lazy=True`, or a `clone_sweep` (which replaces `id_to_chunks`),
+        the inodes are only frozen as they are accessed, see `LazyInodeMap`.
+        Then, `self` must not be mutated after `freeze`.
 
         IMPORTANT: Our lookups assume that the `id_to_chunks` has the
         pre-`freeze` variants of the `InodeID`s.
         '''
+        if lazy or clone_sweep is not None:
+            assert id_to_chunks is None, 'Use `clone_sweep` with `lazy`'
+            if clone_sweep is None:
+                clone_sweep = LazyCloneSweep(
+                    list(self._inode_ids_and_extents()),
+                    leaf_id_to_data_blocks=leaf_id_to_data_blocks,
+                    stats=stats,
+                )
+            return type(self)(
+                id_map=freeze(self.id_map, _memo=_memo),
+                id_to_inode=LazyInodeMap(
+                    id_to_inode=self.id_to_inode, clone_sweep=clone_sweep,
+                    _memo=_memo,
+                ),
+            )
         if id_to_chunks is None:
             id_to_chunks = dict(extents_to_chunks_with_clones(
                 list(self._inode_ids_and_extents()),
+                leaf_id_to_data_blocks=leaf_id_to_data_blocks,
+                stats=stats,
             ))
         return type(self)(
             id_map=freeze(self.id_map, _memo=_memo),
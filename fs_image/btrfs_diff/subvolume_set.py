@@ -16,11 +16,16 @@ from collections import Counter
 from types import MappingProxyType
 # Future: `deepfrozen` would let us lose the `new` methods on NamedTuples,
 # and avoid `deepcopy`.
-from typing import Iterator, Mapping, NamedTuple, Optional, Union
+from typing import (
+    Iterator, Mapping, NamedTuple, Optional, Sequence, Union,
+)
 
-from .extents_to_chunks import extents_to_chunks_with_clones
+from .extents_to_chunks import LazyCloneSweep, extents_to_chunks_with_clones
 from .freeze import freeze
+from .ingest_stats import IngestStats, maybe_phase, start_timer
+from .inode import DataBlock
 from .inode_id import InodeIDMap
+from .parse_send_stream import ITEM_TYPE_TO_COMMAND_KIND
 from .send_stream import SendStreamItem, SendStreamItems
 from .subvolume import Subvolume
 from .rendered_tree import RenderedTree
@@ -108,28 +113,66 @@ class SubvolumeSet(NamedTuple):
                 return subvol
         return None
 
-    def freeze(self, *, _memo) -> 'SubvolumeSet':
+    def _inode_ids_and_extents(self):
+        return list(itertools.chain.from_iterable(
+            subvol._inode_ids_and_extents()
+                for subvol in self.uuid_to_subvolume.values()
+        ))
+
+    def freeze(
+        self,
+        *,
+        _memo,
+        leaf_id_to_data_blocks: Optional[
+            Mapping[int, Sequence[DataBlock]]
+        ]=None,
+        stats: Optional[IngestStats]=None,
+        lazy: bool=False,
+    ) -> 'SubvolumeSet':
         '''
         Return a recursively immutable copy of `self`, replacing all
         `IncompleteInode`s by `Inode`s, and checking that all inode metadata
         are populated.  Correctly resolving cloned extents has to happen at
         the level of the `SubvolumeSet`.
+
+        Pass `WriteBlockHasher.leaf_id_to_data_blocks` to annotate the
+        `Chunk`s with content digests, see `data_blocks.py`.
+
+        Pass `stats` to time the `extents_to_chunks` and `freeze_subvolumes`
+        phases, see `ingest_stats.py`.
+
+        With `lazy=True`, inodes are only frozen, and checked, when they are
+        first accessed via `Subvolume.id_to_inode` (see `LazyInodeMap`), so
+        queries that touch few paths only pay for those.  The clone sweep
+        is still global, and runs when the first file is accessed.  Do NOT
+        mutate `self` after a lazy `freeze`, since the result refers to it.
         '''
-        id_to_chunks = dict(extents_to_chunks_with_clones(
-            list(itertools.chain.from_iterable(
-                subvol._inode_ids_and_extents()
-                    for subvol in self.uuid_to_subvolume.values()
-            ))
-        ))
-        return type(self)(
-            uuid_to_subvolume=MappingProxyType({
-                uuid: freeze(subvol, _memo=_memo, id_to_chunks=id_to_chunks)
-                    for uuid, subvol in self.uuid_to_subvolume.items()
-            }),
-            name_uuid_prefix_counts=freeze(
-                self.name_uuid_prefix_counts, _memo=_memo,
-            ),
-        )
+        if lazy:
+            clone_sweep = LazyCloneSweep(
+                self._inode_ids_and_extents(),
+                leaf_id_to_data_blocks=leaf_id_to_data_blocks,
+                stats=stats,
+            )
+            subvol_kwargs = {'clone_sweep': clone_sweep}
+        else:
+            with maybe_phase(stats, 'extents_to_chunks'):
+                subvol_kwargs = {'id_to_chunks': dict(
+                    extents_to_chunks_with_clones(
+                        self._inode_ids_and_extents(),
+                        leaf_id_to_data_blocks=leaf_id_to_data_blocks,
+                        stats=stats,
+                    )
+                )}
+        with maybe_phase(stats, 'freeze_subvolumes'):
+            return type(self)(
+                uuid_to_subvolume=MappingProxyType({
+                    uuid: freeze(subvol, _memo=_memo, **subvol_kwargs)
+                        for uuid, subvol in self.uuid_to_subvolume.items()
+                }),
+                name_uuid_prefix_counts=freeze(
+                    self.name_uuid_prefix_counts, _memo=_memo,
+                ),
+            )
 
     def inodes(self) -> Iterator[Union['Inode', 'IncompleteInode']]:
         return itertools.chain.from_iterable(
@@ -164,11 +207,15 @@ class SubvolumeSetMutator(NamedTuple):
     '''
     subvolume: Subvolume
     subvolume_set: SubvolumeSet
+    # Optional, records the time spent on each item, see `ingest_stats.py`
+    stats: Optional[IngestStats] = None
 
     @classmethod
     def new(
         cls, subvol_set: SubvolumeSet, subvol_item: SendStreamItem,
+        *, stats: Optional[IngestStats]=None,
     ) -> 'SubvolumeSetMutator':
+        timer = None if stats is None else start_timer()
         if not isinstance(subvol_item, (
             SendStreamItems.subvol, SendStreamItems.snapshot,
         )):
@@ -214,9 +261,22 @@ class SubvolumeSetMutator(NamedTuple):
             description.name_uuid_prefixes()
         )
 
-        return cls(subvolume=subvol, subvolume_set=subvol_set)
+        if stats is not None:
+            stats.kind_to_applied[
+                ITEM_TYPE_TO_COMMAND_KIND[type(subvol_item)]
+            ].add(timer)
+        return cls(subvolume=subvol, subvolume_set=subvol_set, stats=stats)
 
     def apply_item(self, item: SendStreamItem):
+        if self.stats is None:
+            return self._apply_item(item)
+        timer = start_timer()
+        self._apply_item(item)
+        self.stats.kind_to_applied[ITEM_TYPE_TO_COMMAND_KIND[type(item)]].add(
+            timer, len(getattr(item, 'data', b'')),
+        )
+
+    def _apply_item(self, item: SendStreamItem):
         if isinstance(item, SendStreamItems.clone):
             from_subvol = self.subvolume_set.uuid_to_subvolume.get(
                 item.from_uuid.decode()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''
+Unlike `tests/demo_sendstreams.py`, this needs neither btrfs nor root: it
+makes send-streams of any size by serializing `SendStreamItems` with
+`write_send_stream.py`.  The output is a chain of send-streams -- a full
+one, followed by incremental snapshots -- that is shaped by
+`SyntheticParams`.  This is meant for benchmarks, see
+`benchmarks/benchmark_ingest.py`, so it is not a test library.
+
+The streams are deterministic, and look roughly like what `btrfs send`
+would produce, except that we never use temporary `o123-4-5` names.
+'''
+import uuid
+
+from io import BytesIO
+from typing import Iterator, List, NamedTuple
+
+from .send_stream import SendStreamItem, SendStreamItems
+from .write_send_stream import write_send_stream
+
+# `btrfs send` splits file data into `write`s of at most this size.
+MAX_WRITE_SIZE = 48 * 1024
+# Each directory level has this many subdirectories.
+DIR_FANOUT = 4
+_TIME = (1500000000, 0)
+
+
+class SyntheticParams(NamedTuple):
+    num_files: int = 1000
+    # Files are spread over `DIR_FANOUT ** dir_depth` leaf directories.
+    dir_depth: int = 3
+    # Bytes of data per file, emitted in `MAX_WRITE_SIZE` `write`s
+    write_size: int = 4096
+    # Each file also gets this many whole-file clones.
+    clone_fanout: int = 0
+    # How many send-streams: 1 full send, plus incremental snapshots.
+    snapshot_chain: int = 1
+    # Each snapshot overwrites one block of every `churn_every`th file, and
+    # adds as many new files.
+    churn_every: int = 10
+
+
+def subvol_uuid(idx: int) -> bytes:
+    return str(uuid.UUID(int=idx + 1)).encode()
+
+
+def _subvol_name(idx: int) -> bytes:
+    return b'synthetic' if idx == 0 else f'synthetic-{idx}'.encode()
+
+
+def _dir_path(params: SyntheticParams, file_idx: int) -> bytes:
+    return b'/'.join(
+        f'd{(file_idx // DIR_FANOUT ** level) % DIR_FANOUT}'.encode()
+            for level in range(params.dir_depth)
+    )
+
+
+def _file_path(params: SyntheticParams, name: str, file_idx: int) -> bytes:
+    d = _dir_path(params, file_idx)
+    return (d + b'/' if d else b'') + name.encode()
+
+
+def _data(seed: int, length: int) -> bytes:
+    return bytes([seed % 251]) * length
+
+
+def _gen_metadata(path: bytes, mode: int) -> Iterator[SendStreamItem]:
+    yield SendStreamItems.chown(path=path, uid=0, gid=0)
+    yield SendStreamItems.chmod(path=path, mode=mode)
+    yield SendStreamItems.utimes(
+        path=path, ctime=_TIME, mtime=_TIME, atime=_TIME,
+    )
+
+
+def _gen_file(
+    params: SyntheticParams, path: bytes, seed: int,
+) -> Iterator[SendStreamItem]:
+    yield SendStreamItems.mkfile(path=path)
+    data = _data(seed, params.write_size)
+    for offset in range(0, len(data), MAX_WRITE_SIZE):
+        yield SendStreamItems.write(
+            path=path, offset=offset,
+            data=data[offset:offset + MAX_WRITE_SIZE],
+        )
+    yield from _gen_metadata(path, 0o644)
+
+
+def _gen_full_items(params: SyntheticParams) -> Iterator[SendStreamItem]:
+    yield SendStreamItems.subvol(
+        path=_subvol_name(0), uuid=subvol_uuid(0), transid=1,
+    )
+    yield from _gen_metadata(b'.', 0o755)
+
+    # Parents sort before their children, so make dirs in sorted order.
+    dirs = set()
+    num_leaf_dirs = DIR_FANOUT ** params.dir_depth
+    for file_idx in range(min(params.num_files, num_leaf_dirs)):
+        path = _dir_path(params, file_idx)
+        while path and path not in dirs:
+            dirs.add(path)
+            path = path.rpartition(b'/')[0]
+    for path in sorted(dirs):
+        yield SendStreamItems.mkdir(path=path)
+        yield from _gen_metadata(path, 0o755)
+
+    for file_idx in range(params.num_files):
+        path = _file_path(params, f'f{file_idx}', file_idx)
+        yield from _gen_file(params, path, file_idx)
+        if params.write_size == 0:
+            continue  # Cannot clone an empty file
+        for clone_idx in range(params.clone_fanout):
+            clone_path = path + f'.clone{clone_idx}'.encode()
+            yield SendStreamItems.mkfile(path=clone_path)
+            yield SendStreamItems.clone(
+                path=clone_path, offset=0, len=params.write_size,
+                from_uuid=subvol_uuid(0), from_transid=1, from_path=path,
+                clone_offset=0,
+            )
+            yield from _gen_metadata(clone_path, 0o644)
+
+
+def _gen_snapshot_items(
+    params: SyntheticParams, idx: int,
+) -> Iterator[SendStreamItem]:
+    yield SendStreamItems.snapshot(
+        path=_subvol_name(idx), uuid=subvol_uuid(idx), transid=idx + 1,
+        parent_uuid=subvol_uuid(idx - 1), parent_transid=idx,
+    )
+    for file_idx in range(
+        idx % params.churn_every, params.num_files, params.churn_every,
+    ):
+        path = _file_path(params, f'f{file_idx}', file_idx)
+        if params.write_size:
+            yield SendStreamItems.write(
+                path=path, offset=0,
+                data=_data(idx + file_idx, min(params.write_size, 4096)),
+            )
+        yield SendStreamItems.utimes(
+            path=path, ctime=_TIME, mtime=_TIME, atime=_TIME,
+        )
+        yield from _gen_file(
+            params, _file_path(params, f'new{idx}-{file_idx}', file_idx),
+            idx + file_idx,
+        )
+
+
+def gen_synthetic_items(
+    params: SyntheticParams,
+) -> Iterator[List[SendStreamItem]]:
+    'Yields the items of each send-stream in the chain.'
+    yield list(_gen_full_items(params))
+    for idx in range(1, params.snapshot_chain):
+        yield list(_gen_snapshot_items(params, idx))
+
+
+def gen_synthetic_sendstreams(params: SyntheticParams) -> Iterator[bytes]:
+    '''
+    Yields each send-stream in the chain.  Our parser ignores CRCs, so we
+    save time by not computing them -- `btrfs receive` would reject these.
+    '''
+    for items in gen_synthetic_items(params):
+        out = BytesIO()
+        write_send_stream(items, out.write, compute_crc=False)
+        yield out.getvalue()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import tempfile
+import unittest
+import unittest.mock
+
+from ..benchmarks.benchmark_ingest import (
+    _parse_param, compare, main, PHASES, SCENARIOS,
+)
+
+
+class BenchmarkIngestTestCase(unittest.TestCase):
+
+    def _run(self, *args):
+        with tempfile.NamedTemporaryFile(mode='r') as outfile:
+            main([
+                'benchmark_ingest', '--scale', '0.001', '--repeat', '2',
+                '--param', 'snapshot_chain=2', '--output', outfile.name,
+                *args,
+            ])
+            return json.load(outfile)
+
+    def test_benchmark(self):
+        results = self._run('--scenario', 'clone_fanout')
+        self.assertEqual(2, results['repeat'])
+        scenario, = results['scenarios'].values()
+        self.assertEqual(
+            SCENARIOS['clone_fanout']._replace(
+                num_files=1, snapshot_chain=2,
+            )._asdict(),
+            scenario['params'],
+        )
+        self.assertLess(0, scenario['sendstream_bytes'])
+        self.assertLess(0, scenario['num_items'])
+        self.assertEqual(set(PHASES), set(scenario['phases']))
+        for stats in scenario['phases'].values():
+            for kind in ['wall', 'cpu']:
+                self.assertLessEqual(
+                    stats[f'min_{kind}_sec'], stats[f'median_{kind}_sec'],
+                )
+
+        with tempfile.NamedTemporaryFile(mode='w') as old_file, \
+                unittest.mock.patch('sys.stderr', new=io.StringIO()) as err:
+            json.dump(results, old_file)
+            old_file.flush()
+            results = self._run(
+                '--scenario', 'clone_fanout', '--compare', old_file.name,
+            )
+        self.assertRegex(err.getvalue(), '^clone_fanout: parse: [0-9.]+x, ')
+
+    def test_compare(self):
+        phases = {p: {'min_wall_sec': 2.0} for p in PHASES}
+        old = {'scenarios': {
+            'a': {'params': {'x': 1}, 'phases': phases},
+            'b': {'params': {'x': 1}, 'phases': phases},
+        }}
+        new = {'scenarios': {
+            'a': {'params': {'x': 1}, 'phases': {
+                p: {'min_wall_sec': 1.0} for p in PHASES
+            }},
+            'b': {'params': {'x': 2}, 'phases': phases},
+            'c': {'params': {'x': 1}, 'phases': phases},
+        }}
+        out = io.StringIO()
+        compare(old, new, out)
+        self.assertEqual(
+            'a: parse: 0.50x, apply: 0.50x, freeze: 0.50x, render: 0.50x\n'
+            'b: parameters differ, not comparable\n',
+            out.getvalue(),
+        )
+
+    def test_parse_param(self):
+        self.assertEqual(('num_files', 7), _parse_param('num_files=7'))
+        for bad in ['num_files', 'bad=3']:
+            with self.assertRaisesRegex(argparse.ArgumentTypeError, 'KEY=INT'):
+                _parse_param(bad)
+
+
+if __name__ == '__main__':
+    unittest.main()
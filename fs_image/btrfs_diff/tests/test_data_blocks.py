@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import hashlib
+import random
+import unittest
+
+from ..data_blocks import (
+    content_defined_blocks, DataBlockIndex, fixed_size_blocks,
+    WriteBlockHasher,
+)
+from ..freeze import freeze
+from ..parse_dump import SendStreamItems
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+
+def _sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class DataBlocksTestCase(unittest.TestCase):
+
+    def test_fixed_size_blocks(self):
+        split = fixed_size_blocks(3)
+        self.assertEqual([], list(split(b'')))
+        self.assertEqual([3, 3], list(split(b'abcdef')))
+        self.assertEqual([3, 3, 1], list(split(b'abcdefg')))
+
+    def test_content_defined_blocks(self):
+        split = content_defined_blocks(min_size=64, avg_size=256, max_size=512)
+        data = random.Random(0).getrandbits(8 * 32768).to_bytes(32768, 'big')
+        lengths = list(split(data))
+        self.assertEqual(len(data), sum(lengths))
+        self.assertTrue(all(64 <= l <= 512 for l in lengths[:-1]), lengths)
+        self.assertLess(len(data) / 512, len(lengths))
+
+        # Inserting a byte at the front shifts only the first boundaries.
+        def offsets_from_end(data):
+            total = 0
+            for l in split(data):
+                total += l
+                yield len(data) - total
+        self.assertLess(0.9 * len(lengths), len(
+            set(offsets_from_end(data)) & set(offsets_from_end(b'!' + data))
+        ))
+
+        # Long runs of identical bytes are cut at `max_size`
+        self.assertEqual([512, 512, 76], list(split(b'\0' * 1100)))
+
+    def test_index(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        hasher = WriteBlockHasher(split=fixed_size_blocks(4))
+
+        mutator = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'cat', uuid=b'abe', transid=3,
+        ))
+        for item in [
+            si.mkfile(path=b'a'),
+            si.write(path=b'a', offset=0, data=b'abcdabcdxyz'),
+            si.mkfile(path=b'b'),
+            # Partly overwrite the 2nd block, and cut into the 3rd.
+            si.write(path=b'a', offset=5, data=b'__'),
+            si.truncate(path=b'a', size=9),
+            # `b` clones the intact part of the 1st block of `a`.
+            si.clone(
+                path=b'b', offset=0, from_uuid=b'abe', from_transid=3,
+                from_path=b'a', clone_offset=0, len=4,
+            ),
+        ]:
+            hasher.apply_item(mutator, item)
+
+        mutator = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'tiger', uuid=b'ee', transid=7,
+            parent_uuid=b'abe', parent_transid=3,
+        ))
+        for item in [
+            si.mkfile(path=b'c'),
+            si.write(path=b'c', offset=2, data=b'abcd'),
+        ]:
+            hasher.apply_item(mutator, item)
+
+        frozen = freeze(
+            subvols, leaf_id_to_data_blocks=hasher.leaf_id_to_data_blocks,
+        )
+
+        cat = frozen.get_by_rendered_id('cat')
+        a_chunks = cat.inode_at_path(b'a').chunks
+        self.assertEqual(['DATA'], [c.kind.name for c in a_chunks])
+        # The 2nd block was overwritten, and the 3rd was truncated.
+        self.assertEqual(
+            [(0, 4, _sha(b'abcd'), 0, 0), (5, 2, _sha(b'__'), 1, 0)],
+            [tuple(b) for b in a_chunks[0].data_blocks],
+        )
+        self.assertEqual(
+            [(0, 4, _sha(b'abcd'), 0, 0)],
+            [tuple(b) for b in cat.inode_at_path(b'b').chunks[0].data_blocks],
+        )
+
+        c_chunks = frozen.get_by_rendered_id('tiger').inode_at_path(
+            b'c'
+        ).chunks
+        self.assertEqual(['HOLE', 'DATA'], [c.kind.name for c in c_chunks])
+        self.assertEqual((), c_chunks[0].data_blocks)
+        self.assertEqual(
+            [(0, 4, _sha(b'abcd'), 2, 0)],
+            [tuple(b) for b in c_chunks[1].data_blocks],
+        )
+        self.assertEqual(
+            f'{_sha(b"abcd")[:8]}@0+4', repr(c_chunks[1].data_blocks[0]),
+        )
+
+        index = DataBlockIndex.from_subvolume_set(frozen)
+        # `b` and the snapshot share the storage of the 1st block of `a`,
+        # but `c` wrote a separate copy of the same bytes.
+        self.assertEqual(4, index.duplicate_bytes())
+        (digest, locations), = index.gen_duplicates()
+        self.assertEqual(_sha(b'abcd'), digest)
+        self.assertEqual(
+            ['cat@a:0+4', 'cat@b:0+4', 'tiger@a:0+4', 'tiger@b:0+4',
+             'tiger@c:2+4'],
+            sorted(repr(l) for l in locations),
+        )
+
+        with self.assertRaisesRegex(AssertionError, 'was not frozen with '):
+            DataBlockIndex.from_subvolume_set(freeze(subvols))
+
+
+if __name__ == '__main__':
+    unittest.main()
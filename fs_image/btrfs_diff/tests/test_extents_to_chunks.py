@@ -8,8 +8,11 @@ import unittest
 from typing import Iterable, Tuple
 
 from ..extent import Extent
+from ..inode import DataBlock
 from ..inode_id import InodeIDMap
-from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..extents_to_chunks import (
+    extents_to_chunks_with_clones, LazyCloneSweep,
+)
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
@@ -297,6 +300,22 @@ class ExtentsToChunksTestCase(unittest.TestCase):
             self._repr_chunks_from_figure(self.FIG1),
         )
 
+    def test_lazy_clone_sweep_FIG1(self):
+        ids_and_extents = list(self._gen_ids_and_extents_from_figure(
+            self.FIG1, slice_spacing=3,
+        ))
+        sweep = LazyCloneSweep(ids_and_extents)
+        self.assertEqual(
+            _repr_ids_and_chunks(
+                extents_to_chunks_with_clones(ids_and_extents)
+            ),
+            # Request the chunks in reverse, to show that order is moot.
+            _repr_ids_and_chunks([
+                (ino_id, sweep.chunks(ino_id, extent))
+                    for ino_id, extent in reversed(ids_and_extents)
+            ]),
+        )
+
     def test_finalize_FIG1_with_extent_left_and_right(self):
         self.assertEqual(
             self.FIG1_repr_chunks_no_spacing,
@@ -563,6 +582,53 @@ class ExtentsToChunksTestCase(unittest.TestCase):
             'e': [],
         }, _repr_ids_and_chunks(ids_and_chunks))
 
+    def test_data_blocks(self):
+        # Two 4-byte blocks per `write`, then cut into both writes.
+        a = Extent.empty().write(offset=0, length=8)
+        _, _, a_wr = next(a.gen_trimmed_leaves())
+        b = Extent.empty().write(offset=0, length=8)
+        _, _, b_wr = next(b.gen_trimmed_leaves())
+        a = a.truncate(length=12).write(offset=2, length=1).clone(
+            to_offset=8, from_extent=b, from_offset=0, length=4,
+        )
+
+        def blocks(write_idx):
+            return tuple(
+                DataBlock(
+                    offset=o, length=4, digest=f'{write_idx}/{o}',
+                    write_idx=write_idx, write_offset=o,
+                ) for o in (0, 4)
+            )
+
+        ((_, a_chunks),) = extents_to_chunks_with_clones(
+            [(self.id_map.add_file(self.id_map.next(), b'a'), a)],
+            leaf_id_to_data_blocks={id(a_wr): blocks(0), id(b_wr): blocks(1)},
+        )
+        self.assertEqual([(Extent.Kind.DATA, 12)], [
+            (c.kind, c.length) for c in a_chunks
+        ])
+        # The 1st block of `a_wr` was overwritten, and the 2nd block of
+        # `b_wr` was not cloned.  The 1-byte `write` had no blocks.
+        self.assertEqual(
+            (blocks(0)[1], blocks(1)[0]._replace(offset=8)),
+            a_chunks[0].data_blocks,
+        )
+
+        ((_, (hole,)),) = extents_to_chunks_with_clones(
+            [(self.id_map.add_file(self.id_map.next(), b'h'),
+              Extent.empty().truncate(length=3))],
+            leaf_id_to_data_blocks={},
+        )
+        self.assertEqual((Extent.Kind.HOLE, 3, ()), (
+            hole.kind, hole.length, hole.data_blocks,
+        ))
+
+        # Without `leaf_id_to_data_blocks`, there are no blocks.
+        ((_, (chunk,)),) = extents_to_chunks_with_clones(
+            [(self.id_map.add_file(self.id_map.next(), b'n'), a)],
+        )
+        self.assertIsNone(chunk.data_blocks)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import time
+import unittest
+
+from ..ingest_stats import IngestStats, maybe_phase, start_timer, Totals
+from ..parse_send_stream import CommandKind
+
+
+class IngestStatsTestCase(unittest.TestCase):
+
+    def test_totals(self):
+        t = Totals()
+        self.assertEqual(
+            {'count': 0, 'bytes': 0, 'wall_sec': 0.0, 'cpu_sec': 0.0},
+            t.to_json_dict(),
+        )
+        timer = start_timer()
+        time.sleep(0.01)
+        t.add(timer, 7)
+        t.add(start_timer())
+        self.assertEqual((2, 7), (t.count, t.bytes))
+        self.assertLessEqual(0.01, t.wall_sec)
+        self.assertLessEqual(0, t.cpu_sec)
+
+    def test_phases_and_json(self):
+        stats = IngestStats()
+        with maybe_phase(stats, 'a'):
+            pass
+        with self.assertRaisesRegex(RuntimeError, 'boom'):
+            with stats.phase('a'):
+                raise RuntimeError('boom')
+        with maybe_phase(None, 'b'):  # Not recorded
+            pass
+        stats.kind_to_parsed[CommandKind.WRITE].add(start_timer(), 3)
+        stats.kind_to_applied[CommandKind.MKDIR].add(start_timer())
+
+        d = stats.to_json_dict()
+        self.assertEqual({'WRITE'}, set(d['parse']))
+        self.assertEqual(3, d['parse']['WRITE']['bytes'])
+        self.assertEqual({'MKDIR'}, set(d['apply']))
+        self.assertEqual({'a'}, set(d['phase']))
+        self.assertEqual(2, d['phase']['a']['count'])
+
+
+if __name__ == '__main__':
+    unittest.main()
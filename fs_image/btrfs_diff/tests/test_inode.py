@@ -6,7 +6,7 @@ from ..extent import Extent
 from ..extents_to_chunks import extents_to_chunks_with_clones
 from ..inode import (
     _time_delta, _repr_time, _repr_time_delta,
-    Chunk, ChunkClone, Clone, Inode, InodeOwner, InodeUtimes,
+    Chunk, ChunkClone, Clone, DataBlock, Inode, InodeOwner, InodeUtimes,
 )
 from ..inode_id import InodeIDMap
 
@@ -142,6 +142,18 @@ class InodeTestCase(unittest.TestCase):
             ('(DATA/12: a:7+2@3, a:5+6@4)', '(DATA/12: a:5+6@4, a:7+2@3)'),
         )
 
+    def test_data_block(self):
+        block = DataBlock(
+            offset=3, length=5, digest='0123456789abcdef', write_idx=7,
+            write_offset=2,
+        )
+        self.assertEqual('01234567@3+5', repr(block))
+        chunk = Chunk(
+            kind=Extent.Kind.DATA, length=12, chunk_clones=set(),
+            data_blocks=(block,),
+        )
+        self.assertEqual('(DATA/12)', repr(chunk))
+
     def test_repr_owner(self):
         self.assertEqual('12:345', repr(InodeOwner(uid=12, gid=345)))
 
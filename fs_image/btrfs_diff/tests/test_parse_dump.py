@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 import io
+import os
+import random
+import re
 import sys
 import unittest
 
 from typing import List, Sequence
 
 from ..parse_dump import (
+    _ESCAPED_TO_UNESCAPED, _normalize_subvolume_path, _split_dump_line,
     NAME_TO_PARSER_TYPE, parse_btrfs_dump, unquote_btrfs_progs_path,
 )
 from ..send_stream import SendStreamItem, SendStreamItems
@@ -38,6 +42,57 @@ class ParseBtrfsDumpTestCase(unittest.TestCase):
             )
         )
 
+    def test_unquote_parity(self):
+        # The scanner must agree with this simple, but slow, regex.
+        escaped_regex = re.compile(
+            b'|'.join(re.escape(e) for e in _ESCAPED_TO_UNESCAPED)
+        )
+        rng = random.Random(0)
+        for _ in range(20000):
+            s = bytes(rng.choice(b'\\ 0137abenx') for _ in range(12))
+            self.assertEqual(escaped_regex.sub(
+                lambda m: _ESCAPED_TO_UNESCAPED[m.group(0)], s,
+            ), unquote_btrfs_progs_path(s), s)
+
+    def test_split_dump_line_parity(self):
+        line_regex = re.compile(br'([^ ]+) +((\\ |[^ ])+) *(.*)\n')
+        rng = random.Random(0)
+        for _ in range(20000):
+            l = bytes(rng.choice(b' \\\nab') for _ in range(10))
+            if rng.random() < 0.8:
+                l += b'\n'
+            m = line_regex.fullmatch(l)
+            self.assertEqual(
+                m.group(1, 2, 4) if m else None, _split_dump_line(l), l,
+            )
+
+    def test_normalize_subvolume_path_parity(self):
+        # The fast path must agree with this `relpath` implementation.
+        def slow_normalize(s, subvol_name):
+            stripped = os.path.relpath(s, subvol_name)
+            if len(stripped) >= len(s) or stripped.startswith(b'..'):
+                return None
+            return stripped
+
+        rng = random.Random(0)
+        for _ in range(5000):
+            s = b'/'.join(
+                rng.choice([b'', b'.', b'..', b's', b'x'])
+                    for _ in range(rng.randint(1, 5))
+            )
+            subvol_name = rng.choice([b's', b'x'])
+            try:
+                stripped = _normalize_subvolume_path(
+                    s, subvol_name=subvol_name,
+                )
+            except (RuntimeError, ValueError):  # ValueError: empty path
+                stripped = None
+            try:
+                expected = slow_normalize(s, subvol_name)
+            except ValueError:
+                expected = None
+            self.assertEqual(expected, stripped, (s, subvol_name))
+
     def test_ensure_demo_sendstreams_cover_all_operations(self):
         # Ensure we have implemented all the operations from here:
         # https://github.com/kdave/btrfs-progs/blob/master/send-dump.c#L319
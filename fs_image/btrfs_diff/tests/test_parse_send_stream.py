@@ -10,9 +10,10 @@ import unittest
 from .demo_sendstreams import gold_demo_sendstreams
 from .demo_sendstreams_expected import get_filtered_and_expected_items
 
+from ..ingest_stats import IngestStats
 from ..parse_send_stream import (
-    AttributeKind, check_magic, check_version, CommandKind, file_unpack,
-    parse_send_stream, read_attribute, read_command,
+    AttributeKind, BTRFS_SEND_STREAM_MAGIC, check_magic, check_version,
+    CommandKind, file_unpack, parse_send_stream, read_attribute, read_command,
 )
 
 # `unittest`'s output shortening makes tests much harder to debug.
@@ -41,6 +42,30 @@ class ParseSendStreamTestCase(unittest.TestCase):
         )
         self.assertEqual(filtered_items, expected_items)
 
+    def test_stats(self):
+        sendstream = gold_demo_sendstreams()['create_ops']['sendstream']
+        stats = IngestStats()
+        items = list(parse_send_stream(io.BytesIO(sendstream), stats=stats))
+        self.assertEqual(list(_parse_stream_bytes(sendstream)), items)
+
+        parsed = stats.kind_to_parsed
+        self.assertEqual(1, parsed[CommandKind.SUBVOL].count)
+        self.assertEqual(1, parsed[CommandKind.END].count)
+        self.assertEqual(
+            len(items) + 1, sum(t.count for t in parsed.values()),
+        )
+        # Everything but the magic & version is attributed to a command.
+        self.assertEqual(
+            len(sendstream) - len(BTRFS_SEND_STREAM_MAGIC) - 4,
+            sum(t.bytes for t in parsed.values()),
+        )
+        self.assertLess(
+            sum(len(i.data) for i in items if hasattr(i, 'data')),
+            parsed[CommandKind.WRITE].bytes + parsed[
+                CommandKind.SET_XATTR
+            ].bytes,
+        )
+
     def test_errors(self):
         with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
             check_magic(io.BytesIO(b'xxx'))
@@ -34,8 +34,9 @@ class SubvolumeTestCase(DeepCopyTestCase):
         self, expected_ser, subvol: Subvolume, path: str='.',
     ):
         self._check_render(expected_ser, subvol, path)
-        # Always check the frozen variant, too.
+        # Always check the frozen variants, too.
         self._check_render(expected_ser, freeze(subvol), path)
+        self._check_render(expected_ser, freeze(subvol, lazy=True), path)
 
     def _check_subvolume(self):
         '''
@@ -339,6 +340,17 @@ class SubvolumeTestCase(DeepCopyTestCase):
     def test_subvolume(self):
         self.check_deepcopy_at_each_step(self._check_subvolume)
 
+    def test_lazy_freeze_errors(self):
+        subvol = Subvolume.new(id_map=InodeIDMap.new())
+        with self.assertRaisesRegex(AssertionError, 'Use `clone_sweep`'):
+            freeze(subvol, lazy=True, id_to_chunks={})
+        # Files get their `Chunk`s on access, without a `SubvolumeSet`.
+        subvol.apply_item(SendStreamItems.mkfile(path=b'a'))
+        subvol.apply_item(SendStreamItems.truncate(path=b'a', size=3))
+        lazy = freeze(subvol, lazy=True)
+        self.assertEqual(2, len(lazy.id_to_inode))
+        self.assertEqual('(File h3)', repr(lazy.inode_at_path(b'a')))
+
     def test_rendered_tree(self):
         'Miscellaneous coverage over `rendered_tree.py`.'
         with self.assertRaisesRegex(RuntimeError, 'Unknown type in rendered'):
@@ -2,7 +2,9 @@
 import unittest
 
 from ..freeze import freeze
+from ..ingest_stats import IngestStats
 from ..parse_dump import SendStreamItems
+from ..parse_send_stream import CommandKind
 from ..rendered_tree import emit_all_traversal_ids
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 
@@ -183,6 +185,113 @@ class SubvolumeSetTestCase(unittest.TestCase):
         for expected, frozen in reprs_and_frozens:
             self._check_repr(expected, frozen)
 
+    def test_stats(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        stats = IngestStats()
+        mutator = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'cat', uuid=b'abe', transid=3,
+        ), stats=stats)
+        self.assertIs(stats, mutator.stats)
+        for item in [
+            si.mkfile(path=b'a'),
+            si.write(path=b'a', offset=0, data=b'hello'),
+            si.write(path=b'a', offset=5, data=b'!'),
+        ]:
+            mutator.apply_item(item)
+        freeze(subvols, stats=stats)
+
+        self.assertEqual(
+            {CommandKind.SUBVOL: (1, 0), CommandKind.MKFILE: (1, 0),
+             CommandKind.WRITE: (2, 6)},
+            {
+                kind: (t.count, t.bytes)
+                    for kind, t in stats.kind_to_applied.items()
+            },
+        )
+        self.assertEqual(
+            {'clone_sweep', 'extents_to_chunks', 'freeze_subvolumes'},
+            set(stats.phase_to_totals),
+        )
+        self.assertEqual(
+            [1, 1, 1], [t.count for t in stats.phase_to_totals.values()],
+        )
+        self.assertEqual({}, stats.kind_to_parsed)
+
+        # Without `stats`, nothing is recorded.
+        plain = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'dog', uuid=b'fed', transid=3,
+        ))
+        self.assertIsNone(plain.stats)
+        plain.apply_item(si.mkfile(path=b'a'))
+        self.assertEqual(1, stats.kind_to_applied[CommandKind.SUBVOL].count)
+        self.assertEqual(1, stats.kind_to_applied[CommandKind.MKFILE].count)
+
+    def test_lazy_freeze(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        cat_mutator = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'cat', uuid=b'abe', transid=3,
+        ))
+        for item in [
+            si.mkdir(path=b'dir'),
+            si.mkfile(path=b'from'),
+            si.write(path=b'from', offset=0, data=b'hi'),
+        ]:
+            cat_mutator.apply_item(item)
+        tiger_mutator = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'tiger', uuid=b'ee', transid=7,
+            parent_uuid=b'abe', parent_transid=3,
+        ))
+        for item in [
+            si.mkfile(path=b'to'),
+            si.clone(
+                path=b'to', offset=0, from_uuid=b'abe', from_transid=3,
+                from_path=b'from', clone_offset=0, len=2,
+            ),
+        ]:
+            tiger_mutator.apply_item(item)
+
+        stats = IngestStats()
+        lazy = freeze(subvols, lazy=True, stats=stats)
+        self.assertEqual({'freeze_subvolumes'}, set(stats.phase_to_totals))
+
+        # Looking at a directory does not need the clone sweep.
+        lazy_cat = lazy.get_by_rendered_id('cat')
+        dir_id = lazy_cat.id_map.get_id(b'dir')
+        self.assertIn(dir_id, lazy_cat.id_to_inode)
+        self.assertEqual('(Dir)', repr(lazy_cat.id_to_inode[dir_id]))
+        self.assertIs(
+            lazy_cat.id_to_inode[dir_id], lazy_cat.inode_at_path(b'dir'),
+        )
+        self.assertNotIn('clone_sweep', stats.phase_to_totals)
+
+        # The first file runs the sweep, the rest share it.
+        self.assertEqual(
+            '(File d2(tiger@from:0+2@0/tiger@to:0+2@0))',
+            repr(lazy_cat.inode_at_path(b'from')),
+        )
+        self.assertEqual(1, stats.phase_to_totals['clone_sweep'].count)
+        self.assertEqual(
+            '(File d2(cat@from:0+2@0/tiger@from:0+2@0))',
+            repr(lazy.get_by_rendered_id('tiger').inode_at_path(b'to')),
+        )
+        self.assertEqual(1, stats.phase_to_totals['clone_sweep'].count)
+
+        # The lazy view renders just like the eager one.
+        self.assertEqual(*[
+            frozen.map(lambda sv: emit_all_traversal_ids(sv.render()))
+                for frozen in [freeze(subvols), lazy]
+        ])
+        self.assertEqual(
+            sorted(repr(ino) for ino in freeze(subvols).inodes()),
+            sorted(repr(ino) for ino in lazy.inodes()),
+        )
+        self.assertEqual(
+            len(subvols.get_by_rendered_id('cat').id_to_inode),
+            len(lazy_cat.id_to_inode),
+        )
+
     def test_errors(self):
         si = SendStreamItems
         subvols = SubvolumeSet.new()
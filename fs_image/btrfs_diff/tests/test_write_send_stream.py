@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import io
+import struct
+import unittest
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+from ..parse_send_stream import (
+    AttributeKind, check_magic, check_version, CommandHeader,
+    parse_send_stream,
+)
+from ..send_stream import SendStreamItems
+from ..synthetic_sendstreams import gen_synthetic_items, SyntheticParams
+from ..write_send_stream import (
+    crc32c, serialize_attribute, serialize_item, write_send_stream,
+)
+
+
+def _write_to_bytes(items, **kwargs) -> bytes:
+    out = io.BytesIO()
+    write_send_stream(items, out.write, **kwargs)
+    return out.getvalue()
+
+
+class WriteSendStreamTestCase(unittest.TestCase):
+
+    def test_crc_matches_btrfs(self):
+        stream_dict = gold_demo_sendstreams()['create_ops']
+        infile = io.BytesIO(stream_dict['sendstream'])
+        check_magic(infile)
+        check_version(infile)
+        num_commands = 0
+        while True:
+            header_bytes = infile.read(10)
+            if not header_bytes:
+                break
+            header = CommandHeader.from_file(io.BytesIO(header_bytes))
+            # The CRC is computed with the CRC field zeroed out.
+            self.assertEqual(header.crc, crc32c(
+                header_bytes[:6] + b'\0\0\0\0' + infile.read(header.length)
+            ))
+            num_commands += 1
+        self.assertLess(50, num_commands)
+
+    def test_round_trip_gold(self):
+        for stream_dict in gold_demo_sendstreams().values():
+            items = list(parse_send_stream(io.BytesIO(
+                stream_dict['sendstream']
+            )))
+            self.assertEqual(items, list(parse_send_stream(io.BytesIO(
+                _write_to_bytes(items)
+            ))))
+
+    def test_round_trip_synthetic(self):
+        streams_items = list(gen_synthetic_items(SyntheticParams(
+            num_files=3, dir_depth=2, write_size=100000, clone_fanout=1,
+            snapshot_chain=2,
+        )))
+        item_types = set()
+        for items in streams_items:
+            item_types.update(type(i) for i in items)
+            self.assertEqual(items, list(parse_send_stream(io.BytesIO(
+                _write_to_bytes(items, compute_crc=False)
+            ))))
+        self.assertIn(SendStreamItems.clone, item_types)
+        self.assertIn(SendStreamItems.snapshot, item_types)
+
+    def test_serialize(self):
+        self.assertEqual(
+            struct.pack('<HH', AttributeKind.PATH.value, 3) + b'cat',
+            serialize_attribute(AttributeKind.PATH, b'cat'),
+        )
+        with self.assertRaisesRegex(RuntimeError, 'PATH is too long'):
+            serialize_attribute(AttributeKind.PATH, b'x' * 2 ** 16)
+
+        item = SendStreamItems.mkfile(path=b'cat')
+        with_crc = serialize_item(item)
+        without_crc = serialize_item(item, compute_crc=False)
+        self.assertEqual(with_crc[:6] + with_crc[10:], (
+            without_crc[:6] + without_crc[10:]
+        ))
+        self.assertEqual(b'\0\0\0\0', without_crc[6:10])
+        self.assertNotEqual(b'\0\0\0\0', with_crc[6:10])
+
+
+if __name__ == '__main__':
+    unittest.main()
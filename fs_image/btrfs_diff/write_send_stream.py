@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+'''
+Serializes `SendStreamItems` into the btrfs send-stream binary format, i.e.
+the inverse of `parse_send_stream.py`.  Only version 1 is supported.
+
+This lets us make send-streams without btrfs or root, e.g. for benchmarks.
+Items round-trip through `parse_send_stream`, but the bytes will usually
+differ from what the kernel emits, since the attribute order is ours.
+
+The format is also understood by `btrfs receive`, provided that the UUIDs
+in the items are valid (they are `bytes` of the `str(uuid.UUID)` form).
+'''
+import struct
+import uuid
+
+from typing import Callable, Iterable, Tuple
+
+from .parse_send_stream import (
+    AttributeKind, BTRFS_SEND_STREAM_MAGIC, CommandKind,
+    ITEM_TYPE_TO_COMMAND_KIND,
+)
+from .send_stream import SendStreamItem, SendStreamItems
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data: bytes, crc: int=0) -> int:
+    '''
+    btrfs uses the "raw" Castagnoli CRC: it is seeded with 0, and omits the
+    customary final inversion.  Pure Python, so this is slow for big data.
+    '''
+    for b in data:
+        crc = _CRC32C_TABLE[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def conv_uuid(s: bytes) -> bytes:
+    return uuid.UUID(s.decode()).bytes
+
+
+def conv_uint64(i: int) -> bytes:
+    return struct.pack('<Q', i)
+
+
+def conv_time(t: Tuple[int, int]) -> bytes:
+    return struct.pack('<QI', *t)
+
+
+def _raw(s: bytes) -> bytes:
+    return s
+
+
+# For each item type, the attributes of its command, and how to encode the
+# item fields that hold them.
+_ITEM_TYPE_TO_ATTRIBUTES = {
+    SendStreamItems.subvol: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.UUID, 'uuid', conv_uuid),
+        (AttributeKind.CTRANSID, 'transid', conv_uint64),
+    ],
+    SendStreamItems.snapshot: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.UUID, 'uuid', conv_uuid),
+        (AttributeKind.CTRANSID, 'transid', conv_uint64),
+        (AttributeKind.CLONE_UUID, 'parent_uuid', conv_uuid),
+        (AttributeKind.CLONE_CTRANSID, 'parent_transid', conv_uint64),
+    ],
+    SendStreamItems.mkfile: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.mkdir: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.mknod: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.MODE, 'mode', conv_uint64),
+        (AttributeKind.RDEV, 'dev', conv_uint64),
+    ],
+    SendStreamItems.mkfifo: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.mksock: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.symlink: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.PATH_LINK, 'dest', _raw),
+    ],
+    SendStreamItems.rename: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.PATH_TO, 'dest', _raw),
+    ],
+    SendStreamItems.link: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.PATH_LINK, 'dest', _raw),
+    ],
+    SendStreamItems.unlink: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.rmdir: [(AttributeKind.PATH, 'path', _raw)],
+    SendStreamItems.write: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.FILE_OFFSET, 'offset', conv_uint64),
+        (AttributeKind.DATA, 'data', _raw),
+    ],
+    SendStreamItems.clone: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.FILE_OFFSET, 'offset', conv_uint64),
+        (AttributeKind.CLONE_LEN, 'len', conv_uint64),
+        (AttributeKind.CLONE_UUID, 'from_uuid', conv_uuid),
+        (AttributeKind.CLONE_CTRANSID, 'from_transid', conv_uint64),
+        (AttributeKind.CLONE_PATH, 'from_path', _raw),
+        (AttributeKind.CLONE_OFFSET, 'clone_offset', conv_uint64),
+    ],
+    SendStreamItems.set_xattr: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.XATTR_NAME, 'name', _raw),
+        (AttributeKind.XATTR_DATA, 'data', _raw),
+    ],
+    SendStreamItems.remove_xattr: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.XATTR_NAME, 'name', _raw),
+    ],
+    SendStreamItems.truncate: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.SIZE, 'size', conv_uint64),
+    ],
+    SendStreamItems.chmod: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.MODE, 'mode', conv_uint64),
+    ],
+    SendStreamItems.chown: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.UID, 'uid', conv_uint64),
+        (AttributeKind.GID, 'gid', conv_uint64),
+    ],
+    SendStreamItems.utimes: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.CTIME, 'ctime', conv_time),
+        (AttributeKind.MTIME, 'mtime', conv_time),
+        (AttributeKind.ATIME, 'atime', conv_time),
+    ],
+    SendStreamItems.update_extent: [
+        (AttributeKind.PATH, 'path', _raw),
+        (AttributeKind.FILE_OFFSET, 'offset', conv_uint64),
+        (AttributeKind.SIZE, 'len', conv_uint64),
+    ],
+}
+assert set(_ITEM_TYPE_TO_ATTRIBUTES) == set(ITEM_TYPE_TO_COMMAND_KIND)
+
+
+def serialize_attribute(kind: AttributeKind, data: bytes) -> bytes:
+    if len(data) >= 2 ** 16:
+        raise RuntimeError(f'{kind} is too long: {len(data)} bytes')
+    return struct.pack('<HH', kind.value, len(data)) + data
+
+
+def serialize_command(
+    kind: CommandKind, attrs: Iterable[Tuple[AttributeKind, bytes]],
+    *, compute_crc: bool=True,
+) -> bytes:
+    '''
+    Our parser ignores the CRC, so `compute_crc=False` is a faster way to
+    make streams for it -- but `btrfs receive` will reject them.
+    '''
+    body = b''.join(serialize_attribute(k, v) for k, v in attrs)
+    header = struct.pack('<IH', len(body), kind.value)
+    crc = crc32c(body, crc32c(header + b'\0\0\0\0')) if compute_crc else 0
+    return header + struct.pack('<I', crc) + body
+
+
+def serialize_item(item: SendStreamItem, **kwargs) -> bytes:
+    'kwargs are as for `serialize_command`'
+    return serialize_command(ITEM_TYPE_TO_COMMAND_KIND[type(item)], (
+        (kind, conv(getattr(item, field)))
+            for kind, field, conv in _ITEM_TYPE_TO_ATTRIBUTES[type(item)]
+    ), **kwargs)
+
+
+def write_send_stream(
+    items: Iterable[SendStreamItem], write: Callable[[bytes], None],
+    **kwargs,
+) -> None:
+    '''
+    Writes a complete stream, including the trailing `END` command, via
+    `write`, e.g. `outfile.write`.  kwargs are as for `serialize_command`.
+    '''
+    write(BTRFS_SEND_STREAM_MAGIC + struct.pack('<I', 1))
+    for item in items:
+        write(serialize_item(item, **kwargs))
+    write(serialize_command(CommandKind.END, (), **kwargs))
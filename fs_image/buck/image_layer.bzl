@@ -361,6 +361,7 @@ def _compile_image_features(
           {maybe_quoted_yum_from_repo_snapshot_args} \
           --child-layer-target {current_target_quoted} \
           --child-feature-json $(location {my_feature_target}) \
+          {maybe_trace_args} \
           --child-dependencies {dep_features_query_macro} \
               > "$layer_json"
     '''.format(
@@ -371,6 +372,11 @@ def _compile_image_features(
         current_target_quoted = shell.quote(current_target),
         my_feature_target = feature_target,
         dep_features_query_macro = dep_features_query_macro,
+        # `buck build -c fs_image.compiler_trace=1` puts a timeline of the
+        # build next to `layer.json`, see `compiler/tracing.py`.
+        maybe_trace_args = (
+            "--trace-file \"$TMP/out/compiler_trace.json\""
+        ) if native.read_config("fs_image", "compiler_trace") else "",
         maybe_quoted_build_appliance_args = (
             "" if not build_appliance else "--build-appliance-json $(location {})/layer.json".format(
                 build_appliance,
@@ -3,11 +3,12 @@
 import array
 import logging
 import os
+import shutil
 import socket
 import subprocess
 import tempfile
 
-from typing import AnyStr, Iterable, Iterator, Tuple
+from typing import AnyStr, Iterable, Iterator, List, Optional, Tuple
 from contextlib import AbstractContextManager, contextmanager
 
 
@@ -118,6 +119,51 @@ def run_stdout_to_err(
     return subprocess.run(args, **kwargs, stdout=2)  # Redirect to stderr
 
 
+def decompress_command(path: AnyStr) -> Optional[List[str]]:
+    '''
+    Returns a command decompressing stdin to stdout if `path` is a `.zst`
+    or gzip file, or None for any other file.  We prefer `pzstd` and `pigz`
+    if they are installed -- the former decompresses the frames of `pzstd`
+    archives in parallel, and the latter reads, writes & checksums in
+    threads separate from the decompression.
+    '''
+    path = os.fsdecode(path)
+    if path.endswith('.zst'):
+        tool = 'pzstd' if shutil.which('pzstd') else 'zstd'
+    elif path.endswith(('.gz', '.tgz')):
+        tool = 'pigz' if shutil.which('pigz') else 'gzip'
+    else:
+        return None
+    return [tool, '--decompress', '--stdout']
+
+
+def is_same_inode(fd: int, path: AnyStr) -> bool:
+    '''
+    Is `path` still the file or directory that `fd` refers to?  On-disk
+    caches use this after they lock an entry, in case a concurrent process
+    deleted or replaced it in the meantime.
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fd_st = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fd_st.st_dev, fd_st.st_ino)
+
+
+class HashingReader:
+    'A file-like for `tarfile` streams, which hashes everything read.'
+
+    def __init__(self, f, hasher):
+        self._f = f
+        self._hasher = hasher
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._hasher.update(data)
+        return data
+
+
 @contextmanager
 def pipe():
     r_fd, w_fd = os.pipe2(os.O_CLOEXEC)
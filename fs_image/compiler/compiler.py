@@ -11,19 +11,32 @@ and invokes `.build()` to apply each item to actually construct the subvol.
 '''
 
 import argparse
+import enum
 import itertools
+import json
 import os
 import sys
 
 from contextlib import ExitStack
 
+from common import get_file_logger, init_logging
 from subvol_utils import Subvol, get_subvolume_path
 
 from .dep_graph import DependencyGraph
-from .items import gen_parent_layer_items, LayerOpts
+from .generator_tarball_cache import use_generator_tarball_cache_dir
+from .items import (
+    apply_stat_options, gen_parent_layer_items, HasStatOptions, LayerOpts,
+    TarballExtractor, update_provides_manifest_after_phases,
+    use_tarball_extractor, write_provides_manifest,
+)
 from .items_for_features import gen_items_for_features
+from .layer_cache import DEFAULT_MAX_AGE_SEC, LayerCache
+from .tarball_cache import use_tarball_cache_dir
+from .tracing import span, use_tracer
 from .subvolume_on_disk import SubvolumeOnDisk
 
+log = get_file_logger(__file__)
+
 
 # At the moment, the target names emitted by `image_feature` targets seem to
 # be normalized the same way as those provided to us by `image_layer`.  If
@@ -87,33 +100,141 @@ def parse_args(args):
             'The argument immediately following each target name must be a '
             'path to the output of that target on disk.',
     )
+    parser.add_argument(
+        '--item-build-workers', type=int, default=1,
+        help='Build up to this many independent items at a time. Items '
+            'only start once their dependencies are built, so the result '
+            'does not depend on this setting.',
+    )
+    parser.add_argument(
+        '--batch-item-ops', action='store_true',
+        help='Send the root helper operations of all `copy_files`, '
+            '`make_dirs`, and `symlinks_*` items that are ready at the same '
+            'time as one request, instead of one request per item.  The '
+            'image is the same, but an error only names the failing '
+            'operation, not its item.',
+    )
+    parser.add_argument(
+        '--single-rpm-transaction', action='store_true',
+        help='Remove & install the RPMs of this layer in one `yum shell` '
+            'transaction, instead of one `yum` run for removes, and one '
+            'for installs.  This starts `yum` & its repo server, and loads '
+            'the repo metadata, once instead of twice.',
+    )
+    parser.add_argument(
+        '--incremental-provides', action='store_true',
+        help='After phases like RPM installs, find what changed versus the '
+            'parent layer via `btrfs send --no-data -p`, instead of walking '
+            'the whole new layer.  Only helps if the parent was built with '
+            'a provides manifest.',
+    )
+    parser.add_argument(
+        '--tarball-extractor', default=TarballExtractor.TAR.value,
+        choices=[e.value for e in TarballExtractor],
+        help='How to extract `tarballs`: `tar` runs `sudo tar`, while '
+            '`root-helper` extracts in the privileged helper, which never '
+            'follows symlinks already in the image, and writes in large '
+            'chunks.  The helper runs one request at a time, so it delays '
+            'other items while it extracts.  Either way, `.zst` and gzip '
+            'tarballs are decompressed by `pzstd` or `pigz`, if installed.',
+    )
+    parser.add_argument(
+        '--tarball-cache-dir',
+        help='Remember the hashes & member lists of `tarballs` in this '
+            'directory, so that builds reusing a large tarball need not '
+            'read it again.  Entries are keyed on the identity of the '
+            'tarball file, including its size and modification time.',
+    )
+    parser.add_argument(
+        '--generator-tarball-cache-dir',
+        help='Keep the outputs of `tarballs` generators in this directory, '
+            'normally inside the per-repo artifacts dir, so that later '
+            'builds with the same generator, arguments, and tarball hash '
+            'need not rerun it.  Entries that no build has used for a week '
+            'are deleted when the compiler exits.',
+    )
+    parser.add_argument(
+        '--layer-cache-dir',
+        help='Keep a read-only snapshot of each layer that we build in this '
+            'directory, keyed on a hash of all of the inputs of the layer. '
+            'If a later build has the same inputs, snapshot the cached '
+            'layer instead of building it.  Must be on the same btrfs '
+            'volume as --subvolumes-dir.  Layers with mounts are not cached. '
+            'Entries that no build has used for a week are deleted when '
+            'the compiler exits.',
+    )
+    parser.add_argument(
+        '--yum-warm-cache-dir',
+        help='Passed to --yum-from-repo-snapshot as `--warm-cache-dir`, '
+            'normally inside the per-repo artifacts dir.  RPM phases that '
+            'start without `yum` caches then reuse the warm caches that an '
+            'earlier build made for the same repo snapshot, instead of '
+            'fetching all the repodata.  Not used with '
+            '--build-appliance-json, whose `yum` keeps its own cache.',
+    )
+    parser.add_argument(
+        '--trace-file',
+        help='Write a timeline of the build to this file, with the wall '
+            'time, CPU time, subprocesses, and bytes written of each phase, '
+            'item, and compiler step.  The format is Chrome trace-event '
+            'JSON, as shown by `chrome://tracing` or ui.perfetto.dev.',
+    )
+    parser.add_argument(
+        '--plan-only', action='store_true',
+        help='Instead of building the layer, print a JSON plan of how it '
+            'would be built: the phases with their items, the other items '
+            'in dependency order, and the paths that they provide.  This '
+            'makes & validates the items, but creates no subvolume.  Since '
+            'it does not run phases like RPM installs, requirements that '
+            'only a phase could satisfy are listed as `unverified_requires` '
+            'rather than failing.',
+    )
     return parser.parse_args(args)
 
 
-def build_item(item, *, subvol, target_to_path, subvolumes_dir):
+def build_item(
+    item, *, subvol, target_to_path, subvolumes_dir, stat_options=None,
+):
     '''
     Hack to avoid updating ALL items' build() to take unused args.
     Future: hide all these args inside a BuildContext struct instead,
     pass it to `Item.build`, and remove this function.
+
+    If `stat_options` is a list, `HasStatOptions` items append to it
+    instead of applying their stat options -- see `build_image`.
     '''
-    if hasattr(item, 'build_resolves_targets'):
-        assert not hasattr(item, 'build'), item
-        item.build_resolves_targets(
-            subvol=subvol,
-            target_to_path=target_to_path,
-            subvolumes_dir=subvolumes_dir,
-        )
-    else:
-        item.build(subvol)
+    with span(type(item).__name__, cat='item', item=repr(item)):
+        if stat_options is not None and isinstance(item, HasStatOptions):
+            subvol.run_root_helper_ops(item.build_ops())
+            stat_options.extend(item.stat_options())
+        elif hasattr(item, 'build_resolves_targets'):
+            assert not hasattr(item, 'build'), item
+            item.build_resolves_targets(
+                subvol=subvol,
+                target_to_path=target_to_path,
+                subvolumes_dir=subvolumes_dir,
+            )
+        else:
+            item.build(subvol)
 
 
-def build_image(args):
-    subvol = Subvol(os.path.join(args.subvolumes_dir, args.subvolume_rel_path))
-    target_to_path = make_target_path_map(args.child_dependencies)
+def build_item_batch(items, *, subvol, stat_options):
+    '''
+    Like `build_item` with a `stat_options` list, but for many independent
+    `HasStatOptions` items, in one round-trip to the root helper.
+    '''
+    with span('batch', cat='item', items=[repr(i) for i in items]):
+        subvol.run_root_helper_ops(
+            [op for item in items for op in item.build_ops()]
+        )
+        for item in items:
+            stat_options.extend(item.stat_options())
 
-    # This stack allows build items to hold temporary state on disk.
-    with ExitStack() as exit_stack:
-        dep_graph = DependencyGraph(itertools.chain(
+
+def _make_dep_graph(args, *, target_to_path, exit_stack):
+    # Includes making the items, e.g. hashing their tarballs.
+    with span('DependencyGraph', cat='compiler'):
+        return DependencyGraph(itertools.chain(
             gen_parent_layer_items(
                 args.child_layer_target,
                 args.parent_layer_json,
@@ -125,37 +246,178 @@ def build_image(args):
                 target_to_path=target_to_path,
             ),
         ))
-        layer_opts = LayerOpts(
-            layer_target=args.child_layer_target,
-            yum_from_snapshot=args.yum_from_repo_snapshot,
-            build_appliance=None
-            if not args.build_appliance_json
-            else get_subvolume_path(
-                    args.build_appliance_json, args.subvolumes_dir),
+
+
+def _layer_opts(args):
+    return LayerOpts(
+        layer_target=args.child_layer_target,
+        yum_from_snapshot=args.yum_from_repo_snapshot,
+        build_appliance=None
+        if not args.build_appliance_json
+        else get_subvolume_path(
+                args.build_appliance_json, args.subvolumes_dir),
+        yum_warm_cache_dir=args.yum_warm_cache_dir,
+    )
+
+
+def _layer_cache_options(args):
+    '''
+    The options that can change the layer made from the same inputs.  With
+    the `input_key` arguments, these cover all of `LayerOpts`.  Caches,
+    tracing & `--item-build-workers` do not affect the result.
+    '''
+    return {
+        'batch_item_ops': args.batch_item_ops,
+        'incremental_provides': args.incremental_provides,
+        'single_rpm_transaction': args.single_rpm_transaction,
+        'tarball_extractor': args.tarball_extractor,
+        'yum_warm_cache_dir': args.yum_warm_cache_dir,
+    }
+
+
+def _phase_name(items):
+    'Phases merged by `--single-rpm-transaction` are named like `A+B`.'
+    return '+'.join(o.name for o in sorted(
+        {i.phase_order() for i in items}, key=lambda o: o.value,
+    ))
+
+
+def _enter_tarball_caches(args, exit_stack):
+    if args.tarball_cache_dir is not None:
+        exit_stack.enter_context(
+            use_tarball_cache_dir(args.tarball_cache_dir)
         )
-        # Creating all the builders up-front lets phases validate their input
-        for builder in [
-            builder_maker(items, layer_opts)
-                for builder_maker, items in dep_graph.ordered_phases()
+    if args.generator_tarball_cache_dir is not None:
+        exit_stack.enter_context(use_generator_tarball_cache_dir(
+            args.generator_tarball_cache_dir,
+        ))
+
+
+def _build_subvol(args, subvol, *, target_to_path, exit_stack):
+    dep_graph = _make_dep_graph(
+        args, target_to_path=target_to_path, exit_stack=exit_stack,
+    )
+    layer_opts = _layer_opts(args)
+    phase_items = list(itertools.chain.from_iterable(
+        dep_graph.order_to_phase_items.values()
+    ))
+    # One privileged helper serves the filesystem operations of all
+    # phases & items, instead of a `sudo` per operation.
+    with subvol.root_helper():
+        # Creating all the builders up-front lets phases validate their
+        # input.
+        for builder, items in [
+            (builder_maker(items, layer_opts), items)
+                for builder_maker, items in dep_graph.ordered_phases(
+                    merge_same_builder=args.single_rpm_transaction,
+                )
         ]:
-            builder(subvol)
+            with span(
+                _phase_name(items), cat='phase',
+                items=[repr(i) for i in items],
+            ):
+                builder(subvol)
+        if args.incremental_provides:
+            with span('update_provides_manifest_after_phases', cat='compiler'):
+                update_provides_manifest_after_phases(
+                    subvol, phase_items=phase_items,
+                )
         # We cannot validate or sort `ImageItem`s until the phases are
-        # materialized since the items may depend on the output of the phases.
-        for item in dep_graph.gen_dependency_order_items(
-            subvol.path().decode()
-        ):
-            build_item(
-                item,
-                subvol=subvol,
-                target_to_path=target_to_path,
-                subvolumes_dir=args.subvolumes_dir,
+        # materialized since the items may depend on the output of the
+        # phases.
+        stat_options = []
+        with span('build_in_dependency_order', cat='compiler'):
+            stats = dep_graph.build_in_dependency_order(
+                subvol.path().decode(),
+                lambda item: build_item(
+                    item,
+                    subvol=subvol,
+                    target_to_path=target_to_path,
+                    subvolumes_dir=args.subvolumes_dir,
+                    stat_options=stat_options,
+                ),
+                max_workers=args.item_build_workers,
+                is_batchable=lambda item: isinstance(item, HasStatOptions),
+                build_batch_fn=(lambda items: build_item_batch(
+                    items, subvol=subvol, stat_options=stat_options,
+                )) if args.batch_item_ops else None,
+            )
+        log.info(
+            f'Built {stats.num_items} items in {stats.wall_sec:.3f}s '
+            f'with {stats.max_workers} workers: {stats.total_work_sec:.3f}'
+            f's of work, {stats.critical_path_sec:.3f}s critical path'
+        )
+        # Ownership & modes do not affect later items, since the helper
+        # is `root`.  So, we apply them all at once, resolving the names
+        # just once, against the image's own `/etc/passwd` & `/etc/group`
+        # -- some of which may have been installed by the items.
+        with span('apply_stat_options', cat='compiler'):
+            apply_stat_options(subvol, stat_options)
+        # Lets child layers skip walking this one.
+        with span('write_provides_manifest', cat='compiler'):
+            write_provides_manifest(
+                subvol, phase_items=phase_items, items=dep_graph.items,
+            )
+
+
+def build_image(args):
+    if args.trace_file is None:
+        return _build_image(args)
+    with use_tracer() as tracer:
+        try:
+            with span(
+                'build_image', cat='compiler', layer=args.child_layer_target,
+            ):
+                return _build_image(args)
+        finally:
+            with open(args.trace_file, 'w') as outfile:
+                tracer.write(outfile)
+
+
+def _build_image(args):
+    subvol = Subvol(os.path.join(args.subvolumes_dir, args.subvolume_rel_path))
+    target_to_path = make_target_path_map(args.child_dependencies)
+
+    # This stack allows build items to hold temporary state on disk.
+    with ExitStack() as exit_stack:
+        _enter_tarball_caches(args, exit_stack)
+        exit_stack.enter_context(use_tarball_extractor(
+            TarballExtractor(args.tarball_extractor),
+        ))
+        layer_cache = None
+        is_cache_hit = False
+        if args.layer_cache_dir is not None:
+            layer_cache = LayerCache(args.layer_cache_dir)
+            exit_stack.callback(
+                layer_cache.collect_garbage, DEFAULT_MAX_AGE_SEC,
+            )
+            with span('input_key', cat='layer_cache'):
+                input_key = layer_cache.input_key(
+                    layer_target=args.child_layer_target,
+                    parent_layer_json=args.parent_layer_json,
+                    build_appliance_json=args.build_appliance_json,
+                    yum_from_repo_snapshot=args.yum_from_repo_snapshot,
+                    child_feature_json=args.child_feature_json,
+                    target_to_path=target_to_path,
+                    options=_layer_cache_options(args),
+                )
+            with span('snapshot_cached', cat='layer_cache'):
+                is_cache_hit = layer_cache.snapshot_cached(input_key, subvol)
+        if not is_cache_hit:
+            _build_subvol(
+                args, subvol, target_to_path=target_to_path,
+                exit_stack=exit_stack,
             )
         # Build artifacts should never change. Run this BEFORE the exit_stack
         # cleanup to enforce that the cleanup does not touch the image.
-        subvol.set_readonly(True)
+        with span('set_readonly', cat='compiler'):
+            subvol.set_readonly(True)
+        if layer_cache is not None and not is_cache_hit:
+            with span('store', cat='layer_cache'):
+                layer_cache.store(input_key, subvol)
 
     try:
-        return SubvolumeOnDisk.from_subvolume_path(
+        subvol_on_disk = SubvolumeOnDisk.from_subvolume_path(
             # Converting to a path here does not seem too risky since this
             # class shouldn't have a reason to follow symlinks in the subvol.
             subvol.path().decode(),
@@ -165,7 +427,86 @@ def build_image(args):
     # go wrong is a typo in the f-string.
     except Exception as ex:  # pragma: no cover
         raise RuntimeError(f'Serializing subvolume {subvol.path()}') from ex
+    if layer_cache is not None:
+        # Lets the children of this layer hit the cache, even though its
+        # UUID differs from that of the cached layer.
+        layer_cache.remember_uuid(subvol_on_disk.btrfs_uuid, input_key)
+    return subvol_on_disk
+
+
+def _plan_json(x):
+    'Items, and their fields, as JSON types.'
+    if hasattr(x, '_asdict'):
+        return {
+            k: _plan_json(v) for k, v in x._asdict().items()
+                if k != 'DO_NOT_USE_type'
+        }
+    elif isinstance(x, enum.Enum):
+        return x.value
+    elif type(x) in (tuple, list):
+        return [_plan_json(v) for v in x]
+    return x
+
+
+def _item_plan(item):
+    return {'type': type(item).__name__, **_plan_json(item)}
+
+
+def plan_image(args):
+    '''
+    Implements `--plan-only`.  Like `build_image`, makes the items, and
+    validates the phases & dependencies, but returns a plan of the build
+    instead of creating a subvolume.
+    '''
+    target_to_path = make_target_path_map(args.child_dependencies)
+    with ExitStack() as exit_stack:
+        _enter_tarball_caches(args, exit_stack)
+        dep_graph = _make_dep_graph(
+            args, target_to_path=target_to_path, exit_stack=exit_stack,
+        )
+        layer_opts = _layer_opts(args)
+        phases = []
+        for builder_maker, items in dep_graph.ordered_phases(
+            merge_same_builder=args.single_rpm_transaction,
+        ):
+            builder_maker(items, layer_opts)  # Validates the phase
+            phases.append({
+                'phase': _phase_name(items),
+                'items': [_item_plan(i) for i in items],
+            })
+        unverified_requires = []
+        item_order = dep_graph.plan_dependency_order(
+            # With just PARENT_LAYER, the plan checks all requirements.
+            unmatched_reqs=unverified_requires if len(phases) > 1 else None,
+        )
+    item_to_idx = {item: idx for idx, (item, _) in enumerate(item_order)}
+    return {
+        'layer_target': args.child_layer_target,
+        'phases': phases,
+        # `after` has the indexes of the items that must be built first.
+        'items': [{
+            'item': _item_plan(item),
+            'after': sorted(item_to_idx[i] for i in predecessors),
+        } for item, predecessors in item_order],
+        # What the items add on top of the parent layer & the phases
+        'provides': sorted((
+            {'type': type(prov).__name__, 'path': prov.path}
+                for item, _ in item_order for prov in item.provides()
+        ), key=lambda p: p['path']),
+        'unverified_requires': sorted((
+            {
+                'type': type(req.requires.predicate).__name__,
+                'path': req.requires.path,
+                'item_index': item_to_idx[req.item],
+            } for req in unverified_requires
+        ), key=lambda r: (r['path'], r['item_index'])),
+    }
 
 
 if __name__ == '__main__':  # pragma: no cover
-    build_image(parse_args(sys.argv[1:])).to_json_file(sys.stdout)
+    init_logging()
+    args = parse_args(sys.argv[1:])
+    if args.plan_only:
+        json.dump(plan_image(args), sys.stdout)
+    else:
+        build_image(args).to_json_file(sys.stdout)
@@ -7,10 +7,17 @@ Item is installed only after all of the Items that match its Requires have
 already been installed.  This is known as dependency order or topological
 sort.
 '''
+import concurrent.futures
+import heapq
+import time
+
 from collections import namedtuple
-from typing import Iterator
+from typing import (
+    Callable, FrozenSet, Iterator, List, NamedTuple, Optional, Tuple,
+)
 
 from .items import ImageItem, ParentLayerItem, PhaseOrder, MountItem
+from .tracing import span
 
 
 # To build the item-to-item dependency graph, we need to first build up a
@@ -38,8 +45,11 @@ class ValidatedReqsProvs:
      - No one item provides or requires the same path twice,
      - Each path is provided by at most one item (could be relaxed later),
      - Every Requires is matched by a Provides at that path.
+
+    If `unmatched_reqs` is a list, requirements that nothing matches are
+    appended to it, instead of raising.
     '''
-    def __init__(self, items):
+    def __init__(self, items, *, unmatched_reqs: Optional[list] = None):
         self.path_to_reqs_provs = {}
 
         for item in items:
@@ -79,6 +89,9 @@ class ValidatedReqsProvs:
                         ):
                             break
                     else:
+                        if unmatched_reqs is not None:
+                            unmatched_reqs.append(item_req)
+                            continue
                         raise RuntimeError(
                             'At {}: nothing in {} matches the requirement {}'
                             .format(path, reqs_provs.item_provs, item_req)
@@ -120,6 +133,21 @@ class ValidatedReqsProvs:
         )
 
 
+class ItemBuildStats(NamedTuple):
+    '''
+    Returned by `DependencyGraph.build_in_dependency_order`.  The ratio of
+    `total_work_sec` to `critical_path_sec` is the speedup that unlimited
+    workers could get, if they did not contend for resources.
+    '''
+    num_items: int
+    max_workers: int
+    wall_sec: float
+    # The sum of the build times of all the items.
+    total_work_sec: float
+    # The longest sum of build times along a chain of dependent items.
+    critical_path_sec: float
+
+
 class DependencyGraph:
     '''
     Given an iterable of ImageItems, validates their requires / provides
@@ -143,7 +171,13 @@ class DependencyGraph:
                 ).append(item)
 
     # Like ImageItems, the generated phases have a build(s: Subvol) operation.
-    def ordered_phases(self):
+    #
+    # With `merge_same_builder`, consecutive phases with the same builder
+    # factory become one -- e.g. RPM_REMOVE & RPM_INSTALL can then run as
+    # one `yum` transaction.
+    def ordered_phases(self, *, merge_same_builder: bool = False):
+        prev_builder_maker = None
+        prev_items = ()
         for _, items in sorted(
             self.order_to_phase_items.items(),
             key=lambda kv: kv[0].value,
@@ -151,17 +185,30 @@ class DependencyGraph:
             # We assume that all items in one phase share a builder factory
             all_builder_makers = {i.get_phase_builder for i in items}
             assert len(all_builder_makers) == 1, all_builder_makers
-            yield all_builder_makers.pop(), tuple(items)
+            builder_maker = all_builder_makers.pop()
+            if merge_same_builder and builder_maker == prev_builder_maker:
+                prev_items += tuple(items)
+                continue
+            if prev_items:
+                yield prev_builder_maker, prev_items
+            prev_builder_maker, prev_items = builder_maker, tuple(items)
+        if prev_items:
+            yield prev_builder_maker, prev_items
 
     # Separated so that unit tests can check the internal state.
-    def _prep_item_predecessors(self, sv_path: str):
+    def _prep_item_predecessors(
+        self, sv_path: Optional[str], *, unmatched_reqs=None,
+    ):
         # The `ImageItem` part of the build needs a PARENT_LAYER to know
         # what is provided by the parent layer, and any subsequent phases.
         parent_layer, = self.order_to_phase_items[PhaseOrder.PARENT_LAYER]
         self.items.add(
             # If there are no other phases, `ImageItem`s would only have
             # access to what is provided by the existing PARENT_LAYER.
-            parent_layer if len(self.order_to_phase_items) == 1 else
+            # Without a subvolume (`sv_path` is None), we plan as if the
+            # other phases did not change the parent layer.
+            parent_layer
+            if len(self.order_to_phase_items) == 1 or sv_path is None else
             # Hack: Phases may change the original parent layer, so we'll
             # compute `provides()` for dependency resolution using the
             # mutated subvolume.  This isn't too scary since the rest of
@@ -186,7 +233,7 @@ class DependencyGraph:
         # For each path, treat items that provide something at that path as
         # predecessors of items that require something at the path.
         for _path, rp in ValidatedReqsProvs(
-            self.items
+            self.items, unmatched_reqs=unmatched_reqs,
         ).path_to_reqs_provs.items():
             for item_prov in rp.item_provs:
                 requiring_items = ns.predecessor_to_items.setdefault(
@@ -203,6 +250,32 @@ class DependencyGraph:
 
         return ns
 
+    @staticmethod
+    def _mark_built(ns, item) -> Iterator[ImageItem]:
+        '''
+        Updates `ns` now that `item` is built, and yields the items that
+        this made ready to build.
+        '''
+        # All items, which had `item` was a dependency, must have their
+        # "predecessors" sets updated
+        for requiring_item in ns.predecessor_to_items[item]:
+            predecessors = ns.item_to_predecessors[requiring_item]
+            predecessors.remove(item)
+            if not predecessors:
+                yield requiring_item
+                # With no more predecessors, this will no longer be used.
+                del ns.item_to_predecessors[requiring_item]
+
+        # We won't need this value again, and this lets us detect cycles.
+        del ns.predecessor_to_items[item]
+
+    @staticmethod
+    def _assert_no_cycle(ns):
+        # Initially, every item was indexed here. If there's anything left,
+        # we must have a cycle. Future: print a cycle to simplify debugging.
+        assert not ns.predecessor_to_items, \
+            'Cycle in {}'.format(ns.predecessor_to_items)
+
     def gen_dependency_order_items(self, sv_path: str) -> Iterator[ImageItem]:
         '''
         IMPORTANT: See the docblock of Subvol.path before using `sv_path`,
@@ -220,21 +293,136 @@ class DependencyGraph:
             else:
                 yield item
             yield_idx += 1
+            ns.items_without_predecessors.update(self._mark_built(ns, item))
+        self._assert_no_cycle(ns)
 
-            # All items, which had `item` was a dependency, must have their
-            # "predecessors" sets updated
-            for requiring_item in ns.predecessor_to_items[item]:
-                predecessors = ns.item_to_predecessors[requiring_item]
-                predecessors.remove(item)
-                if not predecessors:
-                    ns.items_without_predecessors.add(requiring_item)
-                    # With no more predecessors, this will no longer be used.
-                    del ns.item_to_predecessors[requiring_item]
+    def plan_dependency_order(
+        self, *, unmatched_reqs: Optional[list] = None,
+    ) -> List[Tuple[ImageItem, FrozenSet[ImageItem]]]:
+        '''
+        Without a subvolume, returns the non-phase items in a dependency
+        order, each with the set of items that must be built before it.
+        Phases besides PARENT_LAYER are assumed not to change what the
+        items depend on -- see `unmatched_reqs` in `ValidatedReqsProvs`.
 
-            # We won't need this value again, and this lets us detect cycles.
-            del ns.predecessor_to_items[item]
+        Unlike `gen_dependency_order_items`, the order is deterministic:
+        of the items that are ready, the one with the least `repr` is next.
+        '''
+        ns = self._prep_item_predecessors(None, unmatched_reqs=unmatched_reqs)
+        item_to_predecessors = {
+            item: frozenset(
+                i for i in predecessors if i.phase_order() is None
+            ) for item, predecessors in ns.item_to_predecessors.items()
+        }
+        ready = [(repr(i), i) for i in ns.items_without_predecessors]
+        heapq.heapify(ready)
+        plan = []
+        while ready:
+            _, item = heapq.heappop(ready)
+            if item.phase_order() is not PhaseOrder.PARENT_LAYER:
+                plan.append(
+                    (item, item_to_predecessors.get(item, frozenset())),
+                )
+            for i in self._mark_built(ns, item):
+                heapq.heappush(ready, (repr(i), i))
+        self._assert_no_cycle(ns)
+        return plan
 
-        # Initially, every item was indexed here. If there's anything left,
-        # we must have a cycle. Future: print a cycle to simplify debugging.
-        assert not ns.predecessor_to_items, \
-            'Cycle in {}'.format(ns.predecessor_to_items)
+    def build_in_dependency_order(
+        self, sv_path: str, build_fn: Callable[[ImageItem], None], *,
+        max_workers: int,
+        is_batchable: Callable[[ImageItem], bool] = lambda item: False,
+        build_batch_fn: Optional[Callable[[List[ImageItem]], None]] = None,
+    ) -> ItemBuildStats:
+        '''
+        Like `gen_dependency_order_items`, but calls `build_fn` on up to
+        `max_workers` items at a time, each from a worker thread.  An item
+        is started only once all of its predecessors are built, so
+        dependent items see the same subvolume as with the serial order.
+        Items that are ready at the same time are independent -- no path
+        is provided by one and required by the other -- so building them
+        concurrently does not change the result.
+
+        If a `build_fn` raises, no more items are started, and we re-raise
+        once the running ones finish.
+
+        Instead of `build_fn`, the ready items satisfying `is_batchable` go
+        to a single `build_batch_fn` call -- e.g. so that many file copies
+        cost just one round-trip to the root helper.
+        '''
+        # Evaluates `provides()` and `requires()` of all items, which may
+        # walk the subvolume.
+        with span('prep_item_predecessors', cat='compiler'):
+            ns = self._prep_item_predecessors(sv_path)
+        start_time = time.monotonic()
+        # For each item, when it would finish with unlimited workers.
+        item_to_critical_end = {}
+        # For ready items, the `item_to_critical_end` of their predecessors
+        item_to_critical_start = {}
+        total_work_sec = 0.0
+        num_items = 0
+
+        def timed_build(build, arg):
+            t = time.monotonic()
+            build(arg)
+            return time.monotonic() - t
+
+        ready = []
+        for item in ns.items_without_predecessors:
+            # The parent layer is built as part of `ordered_phases()`, so
+            # it is done by the time we get here.
+            if item.phase_order() is PhaseOrder.PARENT_LAYER:
+                item_to_critical_end[item] = 0.0
+                ready.extend(self._mark_built(ns, item))
+            else:
+                ready.append(item)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            future_to_items = {}
+            error = None
+            while ready or future_to_items:
+                if error is None:
+                    batch = []
+                    # Make the start order deterministic, for debuggability.
+                    for item in sorted(ready, key=repr):
+                        if build_batch_fn is not None and is_batchable(item):
+                            batch.append(item)
+                            continue
+                        future = executor.submit(timed_build, build_fn, item)
+                        future_to_items[future] = [item]
+                    if batch:
+                        future = executor.submit(
+                            timed_build, build_batch_fn, batch,
+                        )
+                        future_to_items[future] = batch
+                ready = []
+                done, _ = concurrent.futures.wait(
+                    future_to_items,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    items = future_to_items.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    build_sec = future.result()
+                    num_items += len(items)
+                    total_work_sec += build_sec
+                    for item in items:
+                        end = item_to_critical_start.pop(item, 0.0) + build_sec
+                        item_to_critical_end[item] = end
+                        for requiring_item in ns.predecessor_to_items[item]:
+                            item_to_critical_start[requiring_item] = max(
+                                end,
+                                item_to_critical_start.get(requiring_item, 0),
+                            )
+                        ready.extend(self._mark_built(ns, item))
+            if error is not None:
+                raise error
+        self._assert_no_cycle(ns)
+        return ItemBuildStats(
+            num_items=num_items,
+            max_workers=max_workers,
+            wall_sec=time.monotonic() - start_time,
+            total_work_sec=total_work_sec,
+            critical_path_sec=max(item_to_critical_end.values(), default=0),
+        )
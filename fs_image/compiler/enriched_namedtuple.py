@@ -83,6 +83,8 @@ hierarchy) of related record types.  Each of the types will behave much like
    inheritance, so it might be best to forbit it.  Instead, add `.items()`?
 
 '''
+import operator
+
 from collections import namedtuple
 
 
@@ -208,22 +210,72 @@ def metaclass_new_enriched_namedtuple(
         ],
     )
 
-    class EnrichedNamedtupleBase(
-        namedtuple(class_name, field_to_base_and_default.keys())
-    ):
+    # Items & provides are constructed in bulk, so we do as much as
+    # possible of the work of `_normalize_enriched_namedtuple_fields` once
+    # per class, here, leaving just a few set & dict operations per object.
+    fields = tuple(field_to_base_and_default.keys())
+    required_fields = frozenset(
+        f for f, (_, d) in field_to_base_and_default.items()
+            if d is RequiredField
+    )
+    constructible_fields = frozenset(
+        f for f, (_, d) in field_to_base_and_default.items()
+            if d is not NonConstructibleField
+    )
+    field_defaults = [
+        (f, d) for f, (_, d) in field_to_base_and_default.items()
+            if d is not RequiredField and f != 'DO_NOT_USE_type'
+    ]
+    has_non_constructible_fields = any(
+        d is NonConstructibleField
+            for f, (_, d) in field_to_base_and_default.items()
+                if f != 'DO_NOT_USE_type'
+    )
+    # `itemgetter` of one key returns a value, not a tuple.
+    get_values = operator.itemgetter(*fields) if len(fields) > 1 \
+        else (lambda d: (d[fields[0]],))
+
+    class EnrichedNamedtupleBase(namedtuple(class_name, fields)):
         __slots__ = ()  # Forbid adding new attributes
 
         def __new__(cls, **field_to_value):  # Forbid positional arguments
             # MUTATES field_to_value, OK since ** always makes a new dict
-            _normalize_enriched_namedtuple_fields(
-                cls, field_to_value, field_to_base_and_default
-            )
-            return super(EnrichedNamedtupleBase, cls).__new__(
-                cls,
-                **_assert_all_fields_constructible(
-                    class_name, customize_fields_fn(field_to_value),
-                ),
-            )
+            if not (
+                required_fields <= field_to_value.keys()
+                    <= constructible_fields
+            ):
+                # Raises a helpful error
+                _normalize_enriched_namedtuple_fields(
+                    cls, field_to_value, field_to_base_and_default
+                )
+            for field, default in field_defaults:
+                if field not in field_to_value:
+                    field_to_value[field] = default
+            field_to_value['DO_NOT_USE_type'] = cls
+            field_to_value = customize_fields_fn(field_to_value)
+            if has_non_constructible_fields:
+                _assert_all_fields_constructible(class_name, field_to_value)
+            try:
+                values = get_values(field_to_value)
+            except KeyError:
+                values = None
+            if values is None or len(field_to_value) != len(fields):
+                # `customize_fields_fn` added or removed fields, let
+                # `namedtuple` explain the problem.
+                return super(EnrichedNamedtupleBase, cls).__new__(
+                    cls, **field_to_value,
+                )
+            return tuple.__new__(cls, values)
+
+        @classmethod
+        def _new_trusted(cls, *values):
+            '''
+            A fast path for internal code that makes many objects from
+            values that are already valid & normalized.  Takes the fields
+            after `DO_NOT_USE_type` positionally, in `_fields` order, and
+            skips all checks, defaults, and `customize_fields_fn`.
+            '''
+            return tuple.__new__(cls, (cls, *values))
 
         def __repr__(self):
             return class_name + '(' + ', '.join(
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+'''
+`tarball_item_factory` can run a `generator` to make the tarball for a
+`TarballItem`.  Generators can be slow, and the same invocation tends to
+recur -- in several features of one layer, or in successive builds.
+`GeneratorTarballCache` runs each distinct invocation just once.
+
+An invocation is keyed on the content hash of the generator, its
+arguments, and the expected hash of the tarball, so we never reuse the
+output of an edited generator, or of an older TARGETS.  Identical keys
+yield the same tarball path, so the resulting `TarballItem`s compare
+equal, and deduplicate.
+
+Each use of a tarball holds a reference, which is released when the
+caller's `exit_stack` exits.  Without a cache directory, the tarball is
+deleted once its last reference is gone.  With a cache directory (in the
+per-repo artifacts dir, normally), tarballs persist across builds, and
+every process holds a shared `flock` on each entry it uses.  In that case,
+`collect_garbage` deletes the entries that no process holds, and which
+have not been used for a while.
+
+Items find the cache via `get_generator_tarball_cache()`, like with
+`tarball_cache.py`.  The compiler opts into persistence via
+`use_generator_tarball_cache_dir`.
+'''
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from common import is_same_inode
+
+from .tarball_cache import hash_file
+
+# Entries not used for this long are garbage-collected when the compiler
+# exits.
+DEFAULT_MAX_AGE_SEC = 7 * 24 * 3600
+
+_OUTPUT_DIR = 'out'  # The generator writes here
+_TARBALL_NAME = 'tarball_name'  # Stores the name the generator printed
+_TEMP_PREFIX = '.tmp'  # Not yet populated, or about to be deleted
+
+
+class _Entry:
+    __slots__ = ('tarball', 'refcount', 'close')
+
+    def __init__(self, tarball: str, close: Callable[[], None]):
+        self.tarball = tarball
+        self.refcount = 0
+        self.close = close
+
+
+class GeneratorTarballCache:
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self._cache_dir = cache_dir
+        self._key_to_entry = {}
+
+    def get(
+        self, exit_stack, *, generator: str, generator_args: List[str],
+        tarball_hash: str, generate: Callable[[str], str],
+    ) -> str:
+        '''
+        Returns the path of the tarball that `generate(output_dir)` makes,
+        running it only if no live or cached tarball has the same key.  The
+        path remains valid until `exit_stack` exits.
+        '''
+        key = hashlib.sha256(json.dumps([
+            hash_file(generator, 'sha256'), generator_args, tarball_hash,
+        ]).encode()).hexdigest()
+        entry = self._key_to_entry.get(key)
+        if entry is None:
+            entry = (
+                self._make_temporary_entry(generate)
+                    if self._cache_dir is None
+                    else self._open_cached_entry(key, generate)
+            )
+            self._key_to_entry[key] = entry
+        entry.refcount += 1
+        exit_stack.callback(self._release, key)
+        return entry.tarball
+
+    def _release(self, key: str):
+        entry = self._key_to_entry[key]
+        entry.refcount -= 1
+        if entry.refcount == 0:
+            del self._key_to_entry[key]
+            entry.close()
+
+    def _make_temporary_entry(self, generate: Callable[[str], str]) -> _Entry:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tarball = generate(temp_dir)
+        except BaseException:
+            shutil.rmtree(temp_dir)
+            raise
+        return _Entry(tarball, lambda: shutil.rmtree(temp_dir))
+
+    def _populate(self, entry_dir: str, generate: Callable[[str], str]):
+        temp_dir = tempfile.mkdtemp(dir=self._cache_dir, prefix=_TEMP_PREFIX)
+        try:
+            output_dir = os.path.join(temp_dir, _OUTPUT_DIR)
+            os.mkdir(output_dir)
+            tarball = generate(output_dir)
+            with open(os.path.join(temp_dir, _TARBALL_NAME), 'w') as f:
+                f.write(os.path.relpath(tarball, output_dir))
+            # Readers never see a partial entry, since we rename it into
+            # place only once it is complete.
+            try:
+                os.rename(temp_dir, entry_dir)
+            except OSError as ex:
+                # A concurrent compiler already populated this entry.
+                if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise  # pragma: no cover
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _open_cached_entry(
+        self, key: str, generate: Callable[[str], str],
+    ) -> _Entry:
+        os.makedirs(self._cache_dir, exist_ok=True)
+        entry_dir = os.path.join(self._cache_dir, key)
+        while True:
+            try:
+                fd = os.open(entry_dir, os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:
+                self._populate(entry_dir, generate)
+                continue
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # `collect_garbage` may have removed the entry before we locked.
+            if is_same_inode(fd, entry_dir):
+                break
+            os.close(fd)
+        try:
+            os.utime(fd)  # `collect_garbage` keeps recently used entries
+            with open(os.path.join(entry_dir, _TARBALL_NAME)) as f:
+                tarball_name = f.read()
+        except BaseException:
+            os.close(fd)
+            raise
+        return _Entry(
+            os.path.join(entry_dir, _OUTPUT_DIR, tarball_name),
+            lambda: os.close(fd),
+        )
+
+    def collect_garbage(self, max_age_sec: float) -> List[str]:
+        '''
+        Deletes the entries that no process holds, and that were last used
+        over `max_age_sec` ago.  Returns the deleted keys.
+        '''
+        if self._cache_dir is None or not os.path.exists(self._cache_dir):
+            return []
+        now = time.time()
+        deleted_keys = []
+        for name in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, name)
+            if name.startswith(_TEMP_PREFIX):
+                # Left behind by a compiler that crashed mid-generation.
+                try:
+                    if now - os.stat(path).st_mtime > max_age_sec:
+                        shutil.rmtree(path, ignore_errors=True)
+                except FileNotFoundError:  # pragma: no cover
+                    pass  # Renamed or deleted concurrently
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:  # pragma: no cover
+                continue  # Deleted by a concurrent `collect_garbage`
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # In use
+                if now - os.fstat(fd).st_mtime <= max_age_sec:
+                    continue
+                # Move the entry out of the way first, so that no process
+                # can find it partly deleted.
+                doomed_dir = tempfile.mkdtemp(
+                    dir=self._cache_dir, prefix=_TEMP_PREFIX,
+                )
+                os.rename(path, os.path.join(doomed_dir, name))
+                shutil.rmtree(doomed_dir)
+                deleted_keys.append(name)
+            finally:
+                os.close(fd)
+        return deleted_keys
+
+
+_generator_tarball_cache = GeneratorTarballCache()
+
+
+def get_generator_tarball_cache() -> GeneratorTarballCache:
+    return _generator_tarball_cache
+
+
+@contextmanager
+def use_generator_tarball_cache_dir(
+    cache_dir: str, max_age_sec: float = DEFAULT_MAX_AGE_SEC,
+) -> Iterator[GeneratorTarballCache]:
+    '''
+    While active, `get_generator_tarball_cache` is persisted to
+    `cache_dir`.  On exit, collects entries unused for `max_age_sec`.
+    '''
+    global _generator_tarball_cache
+    orig_cache = _generator_tarball_cache
+    _generator_tarball_cache = GeneratorTarballCache(cache_dir)
+    try:
+        yield _generator_tarball_cache
+    finally:
+        _generator_tarball_cache.collect_garbage(max_age_sec)
+        _generator_tarball_cache = orig_cache
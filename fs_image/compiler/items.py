@@ -11,14 +11,21 @@ top of `provides.py`.
 '''
 import enum
 import hashlib
+import io
 import itertools
 import json
 import os
+import shlex
+import stat
 import subprocess
-import tempfile
+import threading
 import sys
 
-from typing import Iterable, List, Mapping, NamedTuple, Optional, Set
+from contextlib import contextmanager
+from typing import (
+    Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Set,
+    Tuple,
+)
 
 from . import mount_item
 from . import procfs_serde
@@ -26,13 +33,24 @@ from . import procfs_serde
 from .enriched_namedtuple import (
     metaclass_new_enriched_namedtuple, NonConstructibleField,
 )
+from .generator_tarball_cache import get_generator_tarball_cache
+from .path_trie import PathTrie
 from .provides import ProvidesDirectory, ProvidesDoNotAccess, ProvidesFile
 from .requires import require_directory, require_file
+from .sendstream_manifest import apply_sendstream_to_manifest
 from .subvolume_on_disk import SubvolumeOnDisk
+from .tarball_cache import get_tarball_cache
 
-from common import nullcontext
+from common import (
+    check_popen_returncode, decompress_command, HashingReader, nullcontext,
+)
+from root_helper import (
+    Chmod, Chown, CopyFile, ExtractTarball, Lstat, MakeDirs, RemovePaths,
+    SetStatOptions, StatOptions, Symlink,
+)
 from subvol_utils import Subvol
 from artifacts_dir import find_repo_root
+from btrfs_diff.parse_send_stream import parse_send_stream
 
 # This path is off-limits to regular image operations, it exists only to
 # record image metadata and configuration.  This is at the root, instead of
@@ -43,6 +61,8 @@ from artifacts_dir import find_repo_root
 # NB: The trailing slash is significant, making this a protected directory,
 # not a protected file.
 META_DIR = 'meta/'
+# The sorted `find` output for a built layer -- see `write_provides_manifest`.
+PROVIDES_MANIFEST = META_DIR + 'private/provides.bin'
 
 @enum.unique
 class PhaseOrder(enum.Enum):
@@ -111,6 +131,12 @@ class LayerOpts(NamedTuple):
     layer_target: str
     yum_from_snapshot: str
     build_appliance: str
+    # Passed to `yum_from_snapshot` as `--warm-cache-dir`, if set.
+    yum_warm_cache_dir: Optional[str] = None
+
+
+# `HasStatOptions` items must define these -- see its docstring.
+_STAT_OPTIONS_METHODS = ('stat_options_paths', 'build_ops')
 
 
 class ImageItem(type):
@@ -133,6 +159,15 @@ class ImageItem(type):
             def phase_order(self):
                 return None
 
+        # Fail as soon as the class is defined, not when the item is built.
+        if any(issubclass(b, HasStatOptions) for b in bases):
+            for name in _STAT_OPTIONS_METHODS:
+                if name in dct or any(hasattr(b, name) for b in bases):
+                    continue
+                raise AssertionError(
+                    f'{classname} must define `{name}` for HasStatOptions'
+                )
+
         return metaclass_new_enriched_namedtuple(
             __class__,
             ['from_target'],
@@ -181,32 +216,115 @@ def _make_rsync_style_dest_path(dest: str, source: str) -> str:
     )
 
 
-def _maybe_popen_zstd(path):
-    'Use this as a context manager.'
+def _maybe_popen_zstd(path, *, stdin=None):
+    'Use this as a context manager.  Decompresses `stdin` if set, or `path`.'
     if path.endswith('.zst'):
         return subprocess.Popen([
-            'zstd', '--decompress', '--stdout', path,
-        ], stdout=subprocess.PIPE)
+            'zstd', '--decompress', '--stdout',
+            *([path] if stdin is None else []),
+        ], stdin=stdin, stdout=subprocess.PIPE)
     return nullcontext()
 
 
+@contextmanager
 def _open_tarfile(path):
-    'Wraps tarfile.open to add .zst support. Use this as a context manager.'
+    'Wraps tarfile.open to add .zst support.'
     import tarfile  # Lazy since only this method needs it.
     with _maybe_popen_zstd(path) as maybe_proc:
+        # Yield inside the `with`, since `zstd` must outlive the reads.
         if maybe_proc is None:
-            return tarfile.open(path)
+            with tarfile.open(path) as f:
+                yield f
         else:
-            return tarfile.open(fileobj=maybe_proc.stdout, mode='r|')
+            with tarfile.open(fileobj=maybe_proc.stdout, mode='r|') as f:
+                yield f
 
 
 def _hash_tarball(tarball: str, algorithm: str) -> str:
     'Returns the hex digest'
-    algo = hashlib.new(algorithm)
+    return get_tarball_cache().hexdigest(tarball, algorithm)
+
+
+def _list_tarball(tarball: str) -> List[Tuple[str, bool]]:
+    'Returns the (name, is_dir) pairs of the members of the tarball'
+    with _open_tarfile(tarball) as f:
+        return [(item.name, item.isdir()) for item in f]
+
+
+_TARBALL_CHUNK_SIZE = 2 ** 20
+
+
+def _hash_and_list_tarball(
+    tarball: str, algorithm: str,
+) -> Tuple[str, List[Tuple[str, bool]]]:
+    '''
+    Returns the hex digest & the output of `_list_tarball`, reading the
+    file only once -- the hasher sees each chunk as `tarfile` consumes it.
+    '''
+    import tarfile  # Lazy, like in `_open_tarfile`
+    hasher = hashlib.new(algorithm)
     with open(tarball, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            algo.update(chunk)
-    return algo.hexdigest()
+        reader = HashingReader(f, hasher)
+        if not tarball.endswith('.zst'):
+            with tarfile.open(
+                fileobj=reader, mode='r|*', bufsize=_TARBALL_CHUNK_SIZE,
+            ) as tf:
+                members = [(item.name, item.isdir()) for item in tf]
+        else:
+            with _maybe_popen_zstd(tarball, stdin=subprocess.PIPE) as proc:
+                def feed():
+                    try:
+                        for chunk in iter(
+                            lambda: reader.read(_TARBALL_CHUNK_SIZE), b'',
+                        ):
+                            proc.stdin.write(chunk)
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass  # `zstd` failed, we check its exit code below
+
+                feeder = threading.Thread(target=feed)
+                feeder.start()
+                try:
+                    with tarfile.open(
+                        fileobj=proc.stdout, mode='r|',
+                        bufsize=_TARBALL_CHUNK_SIZE,
+                    ) as tf:
+                        members = [(item.name, item.isdir()) for item in tf]
+                finally:
+                    # Drain the output, so that `feed` can finish hashing.
+                    while proc.stdout.read(_TARBALL_CHUNK_SIZE):
+                        pass
+                    feeder.join()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        # Hash what `tarfile` did not need to read, e.g. trailing padding.
+        while reader.read(_TARBALL_CHUNK_SIZE):
+            pass
+    return hasher.hexdigest(), members
+
+
+class TarballExtractor(enum.Enum):
+    # `sudo tar`, fed by the fastest available `decompress_command`.
+    TAR = 'tar'
+    # The root helper's `ExtractTarball`, which never follows the symlinks
+    # already in the image.  Its `tarfile` parser is pure Python, so `tar`
+    # is faster for tarballs with very many small files.
+    ROOT_HELPER = 'root-helper'
+
+
+_tarball_extractor = TarballExtractor.TAR
+
+
+@contextmanager
+def use_tarball_extractor(extractor: TarballExtractor) -> Iterator[None]:
+    'While active, `TarballItem.build` extracts tarballs via `extractor`.'
+    global _tarball_extractor
+    orig_extractor = _tarball_extractor
+    _tarball_extractor = extractor
+    try:
+        yield
+    finally:
+        _tarball_extractor = orig_extractor
 
 
 class TarballItem(metaclass=ImageItem):
@@ -214,7 +332,20 @@ class TarballItem(metaclass=ImageItem):
 
     def customize_fields(kwargs):  # noqa: B902
         algorithm, expected_hash = kwargs['hash'].split(':')
-        actual_hash = _hash_tarball(kwargs['tarball'], algorithm)
+        tarball = kwargs['tarball']
+        try:
+            # Hashing & listing in one pass saves reading the file again
+            # for `provides`.
+            actual_hash, _ = get_tarball_cache().hexdigest_and_members(
+                tarball, algorithm,
+                lambda: _hash_and_list_tarball(tarball, algorithm),
+            )
+        except Exception:
+            # An unreadable tarball may just be the wrong file, and the
+            # hash validation error below explains that better.
+            actual_hash = _hash_tarball(tarball, algorithm)
+            if actual_hash == expected_hash:
+                raise
         if actual_hash != expected_hash:
             raise AssertionError(
                 f'{kwargs} failed hash validation, got {actual_hash}'
@@ -223,28 +354,63 @@ class TarballItem(metaclass=ImageItem):
         assert kwargs['force_root_ownership'] in [True, False], kwargs
 
     def provides(self):
-        with _open_tarfile(self.tarball) as f:
-            for item in f:
-                path = os.path.join(
-                    self.into_dir, _make_path_normal_relative(item.name),
-                )
-                if item.isdir():
-                    # We do NOT provide the installation directory, and the
-                    # image build script tarball extractor takes pains (e.g.
-                    # `tar --no-overwrite-dir`) not to touch the extraction
-                    # directory.
-                    if os.path.normpath(
-                        os.path.relpath(path, self.into_dir)
-                    ) != '.':
-                        yield ProvidesDirectory(path=path)
-                else:
-                    yield ProvidesFile(path=path)
+        # Large tarballs have many members, so we make image-absolute,
+        # normal paths here, and skip the normalization of `PathObject`.
+        into_dir = os.path.normpath(os.path.join('/', self.into_dir))
+        # The listing is cached, since large tarballs are slow to scan.
+        for name, is_dir in get_tarball_cache().members(
+            self.tarball, lambda: _list_tarball(self.tarball),
+        ):
+            relpath = _make_path_normal_relative(name)
+            if relpath in ('', '.'):
+                # We do NOT provide the installation directory, and the
+                # image build script tarball extractor takes pains (e.g.
+                # `tar --no-overwrite-dir`) not to touch the extraction
+                # directory.
+                continue
+            path = os.path.join(into_dir, relpath)
+            if is_dir:
+                yield ProvidesDirectory._new_trusted(path)
+            else:
+                yield ProvidesFile._new_trusted(path)
 
     def requires(self):
         yield require_directory(self.into_dir)
 
     def build(self, subvol: Subvol):
-        with _maybe_popen_zstd(self.tarball) as maybe_proc:
+        if _tarball_extractor is TarballExtractor.ROOT_HELPER:
+            # The helper hashes the tarball before extracting the same open
+            # file, and fails if it changed since `customize_fields`.
+            subvol.run_root_helper_ops([ExtractTarball(
+                source=self.tarball,
+                into_dir=self.into_dir,
+                hash=self.hash,
+                force_root_ownership=self.force_root_ownership,
+            )])
+            return
+        algorithm, expected_hash = self.hash.split(':')
+        with open(self.tarball, 'rb') as f:
+            # Extract from the same open file whose hash we check, so the
+            # tarball cannot be swapped out after validation.  Unless the
+            # file changed since `customize_fields`, the hash is cached.
+            actual_hash = get_tarball_cache().hexdigest_of_open_file(
+                f, self.tarball, algorithm,
+            )
+            if actual_hash != expected_hash:
+                raise AssertionError(
+                    f'{self} failed hash validation, got {actual_hash}'
+                )
+            self._extract(subvol, f)
+
+    def _extract(self, subvol: Subvol, f):
+        decompress = decompress_command(self.tarball)
+        # We decompress `.zst` and `.gz` tarballs with the fastest tool
+        # available.  For other formats, `tar` must detect the compression,
+        # which it cannot do when reading a pipe, so we give it a path to
+        # the validated file instead of `-f -`.
+        with nullcontext() if decompress is None else subprocess.Popen(
+            decompress, stdin=f, stdout=subprocess.PIPE,
+        ) as maybe_proc:
             subvol.run_as_root([
                 'tar',
                 # Future: Bug: `tar` unfortunately FOLLOWS existing symlinks
@@ -254,6 +420,7 @@ class TarballItem(metaclass=ImageItem):
                 # collide with whatever is already present.  However, it's
                 # hard to state that with complete confidence, especially if
                 # we start adding support for following directory symlinks.
+                # `TarballExtractor.ROOT_HELPER` does not have this bug.
                 '-C', subvol.path(self.into_dir),
                 '-x',
                 # Block tar's weird handling of paths containing colons.
@@ -304,8 +471,16 @@ class TarballItem(metaclass=ImageItem):
                 #        drwx------. 2 lesha users 17 Sep 11 21:50 IN
                 #        drwxr-xr-x. 2 lesha users 17 Sep 11 21:54 OUT
                 '--keep-old-files',
-                '-f', ('-' if maybe_proc else self.tarball),
-            ], stdin=(maybe_proc.stdout if maybe_proc else None))
+                # `tar` writes a file's data in pieces no larger than its
+                # records, which are only 10KiB by default.  Full records
+                # keep the pieces large when reading from a pipe.
+                f'--record-size={_TARBALL_CHUNK_SIZE}', '--read-full-records',
+                # Under `sudo`, only `stdin` is sure to stay open, and
+                # reopening it via `/proc` yields the same validated file.
+                '-f', '-' if maybe_proc else '/proc/self/fd/0',
+            ], stdin=(maybe_proc.stdout if maybe_proc else f))
+        if maybe_proc:
+            check_popen_returncode(maybe_proc)
 
 
 def _generate_tarball(
@@ -347,21 +522,21 @@ def tarball_item_factory(
     generator_args: List[str] = None, **kwargs,
 ):
     assert (generator is not None) ^ (tarball is not None)
-    # Uses `generator` to generate a temporary `tarball` for `TarballItem`.
-    # The file is deleted when the `exit_stack` context exits.
-    #
-    # NB: With `generator`, identical constructor arguments to this factory
-    # will create different `TarballItem`s, so if we needed item
-    # deduplication to work across inputs, this is broken.  However, I don't
-    # believe the compiler relies on that.  If we need it, it should not be
-    # too hard to share the same tarball for all generates with the same
-    # command -- you'd add a global map of ('into_dir', 'command') ->
-    # tarball, perhaps using weakref hooks to refcount tarballs and GC them.
+    # Uses `generator` to generate a `tarball` for `TarballItem`.  Identical
+    # generator invocations share one tarball, so their items deduplicate.
+    # It stays valid until the `exit_stack` context exits, after which it
+    # is deleted, or kept for later builds if the compiler set a cache
+    # directory -- see `generator_tarball_cache.py`.
     if generator:
-        tarball = _generate_tarball(
-            exit_stack.enter_context(tempfile.TemporaryDirectory()),
-            generator,
-            generator_args or [],
+        generator_args = generator_args or []
+        tarball = get_generator_tarball_cache().get(
+            exit_stack,
+            generator=generator,
+            generator_args=generator_args,
+            tarball_hash=kwargs['hash'],
+            generate=lambda output_dir: _generate_tarball(
+                output_dir, generator, generator_args,
+            ),
         )
     return TarballItem(**kwargs, tarball=tarball)
 
@@ -371,6 +546,10 @@ class HasStatOptions:
     Helper for setting `stat (2)` options on files, directories, etc, which
     we are creating inside the image.  Interfaces with `StatOptions` in the
     image build tool.
+
+    Items must define `stat_options_paths()`, the paths that they create,
+    which get their stat options, and `build_ops()`, the `root_helper` ops
+    that create these paths.  `ImageItem` checks this.
     '''
     __slots__ = ()
     # `mode` can be an integer fully specifying the bits, or a symbolic
@@ -385,26 +564,43 @@ class HasStatOptions:
 
     def _mode_impl(self):
         return (  # The symbolic mode must be applied after 0ing all bits.
-            f'{self.mode:04o}' if isinstance(self.mode, int)
+            self.mode if isinstance(self.mode, int)
                 else f'a-rwxXst,{self.mode}'
         )
 
-    def build_stat_options(self, subvol: Subvol, full_target_path: str):
-        # `chmod` lacks a --no-dereference flag to protect us from following
-        # `full_target_path` if it's a symlink.  As far as I know, this
-        # should never occur, so just let the exception fly.
-        subvol.run_as_root(['test', '!', '-L', full_target_path])
-        # -R is not a problem since it cannot be the case that we are
-        # creating a directory that already has something inside it.  On
-        # the plus side, it helps with nested directory creation.
-        subvol.run_as_root([
-            'chmod', '-R', self._mode_impl(),
-            full_target_path
-        ])
-        subvol.run_as_root([
-            'chown', '--no-dereference', '-R', f'{self.user}:{self.group}',
-            full_target_path,
-        ])
+    def stat_options(self) -> List[StatOptions]:
+        # `SetStatOptions` refuses to follow symlinks.  As far as I know,
+        # this should never occur, so just let the exception fly.
+        return [
+            StatOptions(
+                path=p, mode=self._mode_impl(), user=self.user,
+                group=self.group,
+            ) for p in self.stat_options_paths()
+        ]
+
+    def build(self, subvol: Subvol):
+        '''
+        `build_image` instead runs `build_ops()` for all the items, and
+        then applies all their `stat_options()` with `apply_stat_options`.
+        '''
+        apply_stat_options(subvol, self.stat_options(), ops=self.build_ops())
+
+
+def apply_stat_options(
+    subvol: Subvol, stat_options: Iterable[StatOptions], *,
+    ops: Iterable[NamedTuple]=(),
+):
+    '''
+    Runs `ops`, and then applies `stat_options` in the same batch.  Since
+    there is no recursion, each item has to list every path it creates.
+    The sort makes the batch deterministic, regardless of build order.
+    '''
+    ops = list(ops)
+    stat_options = sorted(stat_options, key=lambda so: so.path)
+    if stat_options:
+        ops.append(SetStatOptions(entries=stat_options))
+    if ops:
+        subvol.run_root_helper_ops(ops)
 
 
 class CopyFileItem(HasStatOptions, metaclass=ImageItem):
@@ -421,10 +617,11 @@ class CopyFileItem(HasStatOptions, metaclass=ImageItem):
     def requires(self):
         yield require_directory(os.path.dirname(self.dest))
 
-    def build(self, subvol: Subvol):
-        dest = subvol.path(self.dest)
-        subvol.run_as_root(['cp', self.source, dest])
-        self.build_stat_options(subvol, dest)
+    def stat_options_paths(self):
+        return [self.dest]
+
+    def build_ops(self):
+        return [CopyFile(source=self.source, dest=self.dest)]
 
 
 class SymlinkItem(HasStatOptions):
@@ -437,13 +634,14 @@ class SymlinkItem(HasStatOptions):
             kwargs['dest'], kwargs['source']
         )
 
-    def build(self, subvol: Subvol):
-        dest = subvol.path(self.dest)
+    def stat_options_paths(self):
+        return []  # Symlinks do not have meaningful stat options.
+
+    def build_ops(self):
         # Source is always absolute inside the image subvolume
-        source = os.path.join('/', self.source)
-        subvol.run_as_root(
-            ['ln', '--symbolic', '--no-dereference', source, dest]
-        )
+        return [
+            Symlink(source=os.path.join('/', self.source), dest=self.dest),
+        ]
 
 
 class SymlinkToDirItem(SymlinkItem, metaclass=ImageItem):
@@ -475,22 +673,21 @@ class MakeDirsItem(HasStatOptions, metaclass=ImageItem):
         _coerce_path_field_normal_relative(kwargs, 'into_dir')
         _coerce_path_field_normal_relative(kwargs, 'path_to_make')
 
-    def provides(self):
+    def stat_options_paths(self):
         inner_dir = os.path.join(self.into_dir, self.path_to_make)
         while inner_dir != self.into_dir:
-            yield ProvidesDirectory(path=inner_dir)
+            yield inner_dir
             inner_dir = os.path.dirname(inner_dir)
 
+    def provides(self):
+        for path in self.stat_options_paths():
+            yield ProvidesDirectory(path=path)
+
     def requires(self):
         yield require_directory(self.into_dir)
 
-    def build(self, subvol: Subvol):
-        outer_dir = self.path_to_make.split('/', 1)[0]
-        inner_dir = subvol.path(os.path.join(self.into_dir, self.path_to_make))
-        subvol.run_as_root(['mkdir', '-p', inner_dir])
-        self.build_stat_options(
-            subvol, subvol.path(os.path.join(self.into_dir, outer_dir)),
-        )
+    def build_ops(self):
+        return [MakeDirs(path=os.path.join(self.into_dir, self.path_to_make))]
 
 
 # NB: When we split `items.py`, this can just be merged with `mount_item.py`.
@@ -549,7 +746,10 @@ class MountItem(metaclass=ImageItem):
             assert build_source['source'] is None, (f'source: '
                                                     '{build_source["source"]} '
                                                     'must not be set')
-            build_source['source'] = os.path.join('/', kwargs['mountpoint'])
+            build_source = {
+                **build_source,
+                'source': os.path.join('/', kwargs['mountpoint']),
+            }
 
         kwargs['build_source'] = mount_item.BuildSource(
             **build_source
@@ -657,23 +857,233 @@ def _protected_path_set(subvol: Optional[Subvol]) -> Set[str]:
     return paths
 
 
-def _is_path_protected(path: str, protected_paths: Set[str]) -> bool:
-    # NB: The O-complexity could obviously be lots better, if needed.
-    for prot_path in protected_paths:
-        # Handle both protected files and directories.  This test is written
-        # to return True even if `prot_path` is `/path/to/file` while `path`
-        # is `/path/to/file/oops`.
-        if (path + '/').startswith(
-            prot_path + ('' if prot_path.endswith('/') else '/')
-        ):
-            return True
-    return False
+def _is_path_protected(path: str, protected_paths: PathTrie) -> bool:
+    '''
+    `protected_paths` should be built once per subvolume via
+    `_protected_path_trie`, so that each check costs O(depth of `path`).
+    '''
+    # Handle both protected files and directories.  This test returns True
+    # even if the protected path is `/path/to/file` while `path` is
+    # `/path/to/file/oops`.
+    return protected_paths.has_prefix_of(path)
 
 
-def _ensure_meta_dir_exists(subvol: Subvol):
-    subvol.run_as_root([
-        'mkdir', '--mode=0755', '--parents', subvol.path(META_DIR),
-    ])
+def _protected_path_trie(protected_paths: Set[str]) -> PathTrie:
+    # The trie ignores the trailing / of protected directories, since
+    # `_is_path_protected` treats files and directories alike.
+    return PathTrie((p, p) for p in protected_paths)
+
+
+def _find_provides_manifest(
+    subvol: Subvol, protected_paths: Set[str],
+) -> List[Tuple[str, str]]:
+    '''
+    Walks `subvol` as root, returning the `find` filetype and the
+    image-relative path of everything outside of `protected_paths`, sorted
+    by path.  The image root is `.`.
+    '''
+    root = subvol.path().decode()
+    # We need to traverse the image as root, so that we have permission to
+    # access everything.
+    return sorted(_parse_provides_manifest(subvol.run_as_root([
+        # -P is the analog of --no-dereference in GNU tools
+        #
+        # Filter out the protected paths at traversal time.  If one of the
+        # paths has a very large or very slow mount, traversing it would
+        # have a devastating effect on build times, so let's avoid looking
+        # inside protected paths entirely.  An alternative would be to
+        # `send` and to parse the sendstream, but this is ok too.
+        'find', '-P', root, '(', *itertools.dropwhile(
+            lambda x: x == '-o',  # Drop the initial `-o`
+            itertools.chain.from_iterable([
+                # `normpath` removes the trailing / for protected dirs
+                '-o', '-path', os.path.join(root, os.path.normpath(p)),
+            ] for p in protected_paths),
+        ), ')', '-prune', '-o', '-printf', '%y %P\\0',
+    ], stdout=subprocess.PIPE).stdout), key=lambda e: e[1])
+
+
+def _parse_provides_manifest(data: bytes) -> Iterator[Tuple[str, str]]:
+    'Parses the output of `find -printf "%y %P\\0"`, which we also store.'
+    for type_and_path in data.split(b'\0'):
+        if not type_and_path:  # after the trailing \0
+            continue
+        filetype, relpath = type_and_path.decode().split(' ', 1)
+        yield filetype, relpath or '.'  # `%P` is empty for the root
+
+
+def _load_or_find_provides_manifest(
+    subvol: Subvol, protected_paths: Set[str],
+) -> List[Tuple[str, str]]:
+    '''
+    Layers built by this compiler store their `find` output, so that their
+    children need not walk them.  Older layers get walked.
+    '''
+    # NB: `subvol.path` prevents the use of symlinks that take us outside
+    # the subvol.  The file is world-readable, like all of `meta/`.
+    try:
+        with open(subvol.path(PROVIDES_MANIFEST), 'rb') as f:
+            return list(_parse_provides_manifest(f.read()))
+    except FileNotFoundError:
+        return _find_provides_manifest(subvol, protected_paths)
+
+
+_FILETYPE_FROM_MODE = [
+    (stat.S_ISBLK, 'b'), (stat.S_ISCHR, 'c'), (stat.S_ISDIR, 'd'),
+    (stat.S_ISFIFO, 'p'), (stat.S_ISREG, 'f'), (stat.S_ISLNK, 'l'),
+    (stat.S_ISSOCK, 's'),
+]
+
+
+def _filetype_from_mode(mode: int) -> str:
+    for is_type, filetype in _FILETYPE_FROM_MODE:
+        if is_type(mode):
+            return filetype
+    raise AssertionError(f'Unknown file type in mode {mode:o}')
+
+
+def _serialize_provides_manifest(
+    subvol: Subvol, entries: Iterable[Tuple[str, str]],
+):
+    procfs_serde.serialize(b''.join(
+        f'{filetype} {relpath}\0'.encode() for filetype, relpath in entries
+    ), subvol, PROVIDES_MANIFEST)
+
+
+def update_provides_manifest_after_phases(
+    subvol: Subvol, *, phase_items: Iterable['ImageItem'],
+):
+    '''
+    Optional: call after the phases, before `DependencyGraph` evaluates
+    `provides()` for `subvol`.  If any phase changed the snapshot of a
+    parent layer that has a manifest, this stores the post-phase manifest
+    of `subvol`, so that `DependencyGraph` and `write_provides_manifest`
+    need not walk it.
+
+    Rather than walking `subvol`, we patch the parent's manifest using the
+    paths that changed, per `btrfs send --no-data -p PARENT`.  This is
+    much cheaper when the phases change a small part of a large parent.
+    '''
+    phase_items = list(phase_items)
+    if len(phase_items) == 1:
+        return  # Only PARENT_LAYER ran, so `write_provides_manifest` is fast
+    parent, = (
+        i for i in phase_items if i.phase_order() == PhaseOrder.PARENT_LAYER
+    )
+    if not isinstance(parent, ParentLayerItem):
+        return  # There is nothing to diff against.
+    parent_subvol = Subvol(parent.path, already_exists=True)
+    try:
+        with open(parent_subvol.path(PROVIDES_MANIFEST), 'rb') as f:
+            parent_entries = list(_parse_provides_manifest(f.read()))
+    except FileNotFoundError:
+        return  # Walking the parent would cost as much as walking `subvol`
+    # `btrfs send` requires a read-only subvolume.
+    sendstream = subvol.mark_readonly_and_get_sendstream(
+        no_data=True, parent=parent_subvol,
+    )
+    subvol.set_readonly(False)
+    protected_trie = _protected_path_trie(_protected_path_set(subvol))
+    _serialize_provides_manifest(subvol, apply_sendstream_to_manifest(
+        parent_entries,
+        parse_send_stream(io.BytesIO(sendstream)),
+        lambda path: _is_path_protected(path, protected_trie),
+    ))
+
+
+def write_provides_manifest(
+    subvol: Subvol, *,
+    phase_items: Iterable['ImageItem'],
+    items: Iterable['ImageItem'],
+):
+    '''
+    Call after `subvol` is fully built, to store its `provides` manifest,
+    which lets child layers skip walking `subvol`.
+
+    If the only phase was PARENT_LAYER, the result is just the parent's
+    manifest, plus `lstat`s of the paths that `items` provide, so the
+    compiler never walks a layer that only adds regular items.  After any
+    other phase (e.g. RPMs or `remove_paths`), we must walk `subvol`,
+    unless `update_provides_manifest_after_phases` stored a manifest.
+    '''
+    phase_items = list(phase_items)
+    entries = None
+    if len(phase_items) == 1:
+        base, = phase_items
+        assert base.phase_order() == PhaseOrder.PARENT_LAYER, base
+        if isinstance(base, ParentLayerItem):
+            parent_subvol = Subvol(base.path, already_exists=True)
+            entries = _load_or_find_provides_manifest(
+                parent_subvol, _protected_path_set(parent_subvol),
+            )
+        else:
+            assert isinstance(base, FilesystemRootItem), base
+            entries = [('d', '.')]
+    else:
+        try:
+            with open(subvol.path(PROVIDES_MANIFEST), 'rb') as f:
+                entries = list(_parse_provides_manifest(f.read()))
+        except FileNotFoundError:
+            pass
+        else:  # Replace the post-phase manifest with the final one.
+            subvol.run_as_root(['rm', subvol.path(PROVIDES_MANIFEST)])
+    if entries is not None:
+        entries = _add_provided_paths(
+            subvol, {path: filetype for filetype, path in entries}, items,
+        )
+    if entries is None:
+        entries = _find_provides_manifest(
+            subvol, _protected_path_set(subvol),
+        )
+    _serialize_provides_manifest(subvol, entries)
+
+
+def _add_provided_paths(
+    subvol: Subvol,
+    relpath_to_filetype: Dict[str, str],
+    items: Iterable['ImageItem'],
+) -> Optional[List[Tuple[str, str]]]:
+    '''
+    Returns the sorted manifest entries of `relpath_to_filetype` plus the
+    paths provided by the regular `items`, or `None` if the latter might
+    not match `find`.  This can happen if an item wrote through a symlink.
+    '''
+    new_relpaths = set()
+    for item in items:
+        if item.phase_order() is not None:
+            continue  # The parent layer was already accounted for
+        for prov in item.provides():
+            if not isinstance(prov, (ProvidesDirectory, ProvidesFile)):
+                continue  # e.g. mountpoints are protected, and not listed
+            relpath = os.path.relpath(prov.path, '/')
+            # Also add any directories that were implicitly created, e.g.
+            # by a tarball without entries for some of its directories.
+            while relpath not in relpath_to_filetype and relpath != '.':
+                new_relpaths.add(relpath)
+                relpath = os.path.dirname(relpath) or '.'
+    new_relpaths = sorted(new_relpaths)
+    results = subvol.run_root_helper_ops(
+        [Lstat(path=p) for p in new_relpaths]
+    ) if new_relpaths else []
+    for relpath, res in zip(new_relpaths, results):
+        if res is None:  # Not where `provides` said, maybe due to a symlink
+            return None
+        relpath_to_filetype[relpath] = _filetype_from_mode(res['mode'])
+    # `find` does not descend into symlinks, so an item that wrote via a
+    # symlink to a directory made paths that `find` would list elsewhere.
+    for relpath in new_relpaths:
+        d = os.path.dirname(relpath)
+        while d:
+            if relpath_to_filetype.get(d) == 'l':
+                return None
+            d = os.path.dirname(d)
+    return sorted(
+        ((t, p) for p, t in relpath_to_filetype.items()), key=lambda e: e[1],
+    )
+
+
+# Phase builders batch this with their other `root_helper` ops.
+_ENSURE_META_DIR_EXISTS = MakeDirs(path=META_DIR, mode=0o755)
 
 
 class ParentLayerItem(metaclass=ImageItem):
@@ -686,46 +1096,30 @@ class ParentLayerItem(metaclass=ImageItem):
         parent_subvol = Subvol(self.path, already_exists=True)
 
         protected_paths = _protected_path_set(parent_subvol)
+        protected_trie = _protected_path_trie(protected_paths)
         for prot_path in protected_paths:
             yield ProvidesDoNotAccess(path=prot_path)
 
         provided_root = False
-        # We need to traverse the parent image as root, so that we have
-        # permission to access everything.
-        for type_and_path in parent_subvol.run_as_root([
-            # -P is the analog of --no-dereference in GNU tools
-            #
-            # Filter out the protected paths at traversal time.  If one of
-            # the paths has a very large or very slow mount, traversing it
-            # would have a devastating effect on build times, so let's avoid
-            # looking inside protected paths entirely.  An alternative would
-            # be to `send` and to parse the sendstream, but this is ok too.
-            'find', '-P', self.path, '(', *itertools.dropwhile(
-                lambda x: x == '-o',  # Drop the initial `-o`
-                itertools.chain.from_iterable([
-                    # `normpath` removes the trailing / for protected dirs
-                    '-o', '-path', os.path.join(self.path, os.path.normpath(p))
-                ] for p in protected_paths),
-            ), ')', '-prune', '-o', '-printf', '%y %p\\0',
-        ], stdout=subprocess.PIPE).stdout.split(b'\0'):
-            if not type_and_path:  # after the trailing \0
-                continue
-            filetype, abspath = type_and_path.decode().split(' ', 1)
-            relpath = os.path.relpath(abspath, self.path)
-
+        for filetype, relpath in _load_or_find_provides_manifest(
+            parent_subvol, protected_paths,
+        ):
             # We already "provided" this path above, and it should have been
             # filtered out by `find`.
-            assert not _is_path_protected(relpath, protected_paths), relpath
+            assert not _is_path_protected(relpath, protected_trie), relpath
 
+            # Manifest paths are normal, so we skip the normalization of
+            # `PathObject`, which would dominate for large parent layers.
+            path = '/' if relpath == '.' else '/' + relpath
             # Future: This provides all symlinks as files, while we should
             # probably provide symlinks to valid directories inside the
             # image as directories to be consistent with SymlinkToDirItem.
             if filetype in ['b', 'c', 'p', 'f', 'l', 's']:
-                yield ProvidesFile(path=relpath)
+                yield ProvidesFile._new_trusted(path)
             elif filetype == 'd':
-                yield ProvidesDirectory(path=relpath)
+                yield ProvidesDirectory._new_trusted(path)
             else:  # pragma: no cover
-                raise AssertionError(f'Unknown {filetype} for {abspath}')
+                raise AssertionError(f'Unknown {filetype} for {relpath}')
             if relpath == '.':
                 assert filetype == 'd'
                 provided_root = True
@@ -745,9 +1139,14 @@ class ParentLayerItem(metaclass=ImageItem):
         def builder(subvol: Subvol):
             parent_subvol = Subvol(parent.path, already_exists=True)
             subvol.snapshot(parent_subvol)
+            # The parent's manifest goes stale as soon as we change the
+            # snapshot.  `write_provides_manifest` will make a new one.
+            subvol.run_as_root([
+                'rm', '-f', subvol.path(PROVIDES_MANIFEST),
+            ])
             # This assumes that the parent has everything mounted already.
             mount_item.clone_mounts(parent_subvol, subvol)
-            _ensure_meta_dir_exists(subvol)
+            subvol.run_root_helper_ops([_ENSURE_META_DIR_EXISTS])
 
         return builder
 
@@ -778,9 +1177,11 @@ class FilesystemRootItem(metaclass=ImageItem):
             subvol.create()
             # Guarantee standard / permissions.  This could be a setting,
             # but in practice, probably any other choice would be wrong.
-            subvol.run_as_root(['chmod', '0755', subvol.path()])
-            subvol.run_as_root(['chown', 'root:root', subvol.path()])
-            _ensure_meta_dir_exists(subvol)
+            subvol.run_root_helper_ops([
+                Chmod(path='/', mode=0o755),
+                Chown(path='/', user='root', group='root'),
+                _ENSURE_META_DIR_EXISTS,
+            ])
 
         return builder
 
@@ -838,42 +1239,38 @@ class RemovePathItem(metaclass=ImageItem):
 
         def builder(subvol: Subvol):
             protected_paths = _protected_path_set(subvol)
+            protected_trie = _protected_path_trie(protected_paths)
             # Reverse-lexicographic order deletes inner paths before
             # deleting the outer paths, thus minimizing conflicts between
             # `remove_paths` items.
-            for item in sorted(
+            sorted_items = sorted(
                 items, reverse=True, key=lambda i: i.__sort_key(),
-            ):
-                if _is_path_protected(item.path, protected_paths):
+            )
+            for item in sorted_items:
+                if _is_path_protected(item.path, protected_trie):
                     # For META_DIR, this is never reached because of
                     # _make_path_normal_relative's check, but for other
                     # protected paths, this is required.
                     raise AssertionError(
                         f'Cannot remove protected {item}: {protected_paths}'
                     )
-                # This ensures that there are no symlinks in item.path that
-                # might take us outside of the subvolume.  Since recursive
-                # `rm` does not follow symlinks, it is OK if the inode at
-                # `item.path` is a symlink (or one of its sub-paths).
-                path = subvol.path(item.path, no_dereference_leaf=True)
-                if not os.path.lexists(path):
-                    if item.action == RemovePathAction.assert_exists:
-                        raise AssertionError(f'Path does not exist: {item}')
-                    elif item.action == RemovePathAction.if_exists:
-                        continue
-                    else:  # pragma: no cover
-                        raise AssertionError(f'Unknown {item.action}')
-                subvol.run_as_root([
-                    'rm', '-r',
-                    # This prevents us from making removes outside of the
-                    # per-repo loopback, which is an important safeguard.
-                    # It does not stop us from reaching into other subvols,
-                    # but since those have random IDs in the path, this is
-                    # nearly impossible to do by accident.
-                    '--one-file-system',
-                    path,
-                ])
-            pass
+            # One privileged pass removes all the paths.  Like `rm -r
+            # --one-file-system`, it does not follow symlinks, nor leave
+            # the subvolume, but it also refuses to remove any directory
+            # that contains a protected path, and deletes nested btrfs
+            # subvolumes with one ioctl, instead of walking them.
+            results = subvol.run_root_helper_ops([RemovePaths(
+                paths=[
+                    (i.path, i.action == RemovePathAction.assert_exists)
+                        for i in sorted_items
+                ],
+                protected_paths=sorted(protected_paths),
+            )])
+            for idx in results[0]:
+                if sorted_items[idx].action == RemovePathAction.assert_exists:
+                    raise AssertionError(
+                        f'Path does not exist: {sorted_items[idx]}'
+                    )
 
         return builder
 
@@ -942,10 +1339,35 @@ class RpmActionItem(metaclass=ImageItem):
                     f'RPM action conflict for {item.name}: {actions}'
                 )
 
+        # Removes go first, as with the RPM_REMOVE & RPM_INSTALL phases.
+        # Sort ensures determinism even if `yum` is order-dependent.
+        action_rpms = [
+            (action, sorted(action_to_rpms[action]))
+                for action in [RpmAction.remove_if_exists, RpmAction.install]
+                    if action_to_rpms[action]
+        ]
+        if len(action_rpms) > 1:
+            # The compiler merged the RPM phases (`--single-rpm-transaction`),
+            # so we make one `yum shell` transaction.  This starts the repo
+            # server & `yum` sandbox, and loads the repo metadata, just once.
+            yum_invocations = [(['--assumeyes', 'shell'], ''.join(
+                f'{RPM_ACTION_TYPE_TO_YUM_CMD[action]} {" ".join(rpms)}\n'
+                    for action, rpms in action_rpms
+            ) + 'run\n')]
+            # Unlike `yum install`, `yum shell` just warns about the RPMs
+            # that it cannot find, and exits 0.  So, the `yum` sandbox then
+            # checks that the transaction installed them all.
+            verify_installed = sorted(action_to_rpms[RpmAction.install])
+        else:
+            yum_invocations = [
+                ([RPM_ACTION_TYPE_TO_YUM_CMD[action], '--assumeyes', '--',
+                  *rpms], None) for action, rpms in action_rpms
+            ]
+            verify_installed = []
+
         def builder(subvol: Subvol):
-            for action, rpms in action_to_rpms.items():
-                if not rpms:
-                    continue
+            # `yum_shell_script`, if set, is the standard input of `yum`.
+            for yum_args, yum_shell_script in yum_invocations:
                 # Future: `yum-from-snapshot` is actually designed to run
                 # unprivileged (but we have no nice abstraction for this).
                 if layer_opts.build_appliance is None:
@@ -969,12 +1391,15 @@ class RpmActionItem(metaclass=ImageItem):
                             ['--protected-path', d]
                                 for d in _protected_path_set(subvol)
                         ), []),
-                        '--install-root', subvol.path(), '--',
-                        RPM_ACTION_TYPE_TO_YUM_CMD[action],
-                        # Sort ensures determinism even if `yum` is
-                        # order-dependent
-                        '--assumeyes', '--', *sorted(rpms),
-                    ])
+                        *([] if layer_opts.yum_warm_cache_dir is None else [
+                            '--warm-cache-dir', layer_opts.yum_warm_cache_dir,
+                        ]),
+                        *sum((
+                            ['--verify-installed', name]
+                                for name in verify_installed
+                        ), []),
+                        '--install-root', subvol.path(), '--', *yum_args,
+                    ], input=yum_shell_script and yum_shell_script.encode())
                 else:
                     '''
                     ## Future
@@ -997,6 +1422,18 @@ class RpmActionItem(metaclass=ImageItem):
                         ['--protected-path', d]
                             for d in _protected_path_set(subvol)
                     ), []))
+                    # `nspawn` need not pass our stdin to `yum`, so we pipe
+                    # the script from inside the container.
+                    yum_shell_pipe = '' if yum_shell_script is None else (
+                        'printf %s ' + shlex.quote(yum_shell_script) + ' | '
+                    )
+                    # The appliance's `rpm` reads the RPM database that
+                    # its `yum` wrote.
+                    rpm_query = '' if not verify_installed else (
+                        ' && rpm --root /mnt --query -- ' + ' '.join(
+                            shlex.quote(name) for name in verify_installed
+                        )
+                    )
                     # Without this, nspawn would look for the host systemd's
                     # cgroup setup, which breaks us in continuous integration
                     # containers, which may not have a `systemd` in the host
@@ -1022,12 +1459,12 @@ class RpmActionItem(metaclass=ImageItem):
                         (
                             'mkdir -p /mnt/var/cache/yum; '
                             'mount --bind /var/cache/yum /mnt/var/cache/yum; '
+                            f'{yum_shell_pipe}'
                             '/usr/bin/yum-from-fb-snapshot '
                             f'{protected_path_args}'
                             ' --install-root /mnt -- '
-                            f'{RPM_ACTION_TYPE_TO_YUM_CMD[action]} '
-                            '--assumeyes -- '
-                            f'{" ".join(sorted(rpms))}'
+                            f'{" ".join(yum_args)}'
+                            f'{rpm_query}'
                         )
                     ])
 
@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
 'Makes Items from the JSON that was produced by the Buck target image_feature'
 import json
+import os
 
-from typing import Iterable, Mapping, Optional
+from typing import Iterable, Mapping
 
 from .items import (
     CopyFileItem, MakeDirsItem, MountItem, RemovePathItem, RpmActionItem,
     SymlinkToDirItem, SymlinkToFileItem, tarball_item_factory,
 )
 
+# Maps the path of a feature JSON to the identity of the file that we
+# parsed, and its content.  The layers of one build share many features,
+# so this saves re-reading & re-parsing them.  The content is shared by
+# all callers, so it must never be mutated.
+_PATH_TO_FEATURE = {}
+
+
+def _load_feature(path: str):
+    with open(path) as f:
+        st = os.fstat(f.fileno())
+        file_id = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        file_id_and_feature = _PATH_TO_FEATURE.get(path)
+        if file_id_and_feature is None or file_id_and_feature[0] != file_id:
+            file_id_and_feature = (file_id, json.load(f))
+            _PATH_TO_FEATURE[path] = file_id_and_feature
+    return file_id_and_feature[1]
+
 
 def replace_targets_by_paths(x, target_to_path: Mapping[str, str]):
     '''
@@ -19,6 +37,9 @@ def replace_targets_by_paths(x, target_to_path: Mapping[str, str]):
     compiler receives a dictionary of target-to-path mappings as
     `--child-dependencies`, and performs the substitution in any image
     feature JSON it consumes.
+
+    Only the dicts & lists that contain targets are copied, the rest of
+    the result is shared with `x`, so neither may be mutated.
     '''
     if type(x) is dict:
         if '__BUCK_TARGET' in x:
@@ -28,12 +49,23 @@ def replace_targets_by_paths(x, target_to_path: Mapping[str, str]):
             if not path:
                 raise RuntimeError(f'{target} not in {target_to_path}')
             return path
-        return {
-            k: replace_targets_by_paths(v, target_to_path)
-                for k, v in x.items()
-        }
+        replaced = None
+        for k, v in x.items():
+            new_v = replace_targets_by_paths(v, target_to_path)
+            if new_v is not v:
+                if replaced is None:
+                    replaced = x.copy()
+                replaced[k] = new_v
+        return x if replaced is None else replaced
     elif type(x) is list:
-        return [replace_targets_by_paths(v, target_to_path) for v in x]
+        replaced = None
+        for i, v in enumerate(x):
+            new_v = replace_targets_by_paths(v, target_to_path)
+            if new_v is not v:
+                if replaced is None:
+                    replaced = x.copy()
+                replaced[i] = new_v
+        return x if replaced is None else replaced
     elif type(x) in [int, float, str, bool, type(None)]:
         return x
     assert False, f'Unknown {type(x)} for {x}'  # pragma: no cover
@@ -53,26 +85,39 @@ def gen_items_for_features(
         'symlinks_to_files': SymlinkToFileItem,
         'tarballs': lambda **kwargs: tarball_item_factory(exit_stack, **kwargs),
     }
+    # A feature that is reachable via several paths, as in a diamond,
+    # only makes its items once.
+    visited_paths = set()
+
+    def gen_items(feature_paths):
+        for feature_path in feature_paths:
+            if feature_path in visited_paths:
+                continue
+            visited_paths.add(feature_path)
+            feature = _load_feature(feature_path)
 
-    for feature_path in feature_paths:
-        with open(feature_path) as f:
-            items = replace_targets_by_paths(json.load(f), target_to_path)
+            yield from gen_items(replace_targets_by_paths(
+                feature.get('features', []), target_to_path,
+            ))
 
-        yield from gen_items_for_features(
-            exit_stack=exit_stack,
-            feature_paths=items.pop('features', []),
-            target_to_path=target_to_path,
-        )
+            target = feature['target']
+            for key, item_factory in key_to_item_factory.items():
+                for dct in feature.get(key, []):
+                    # Substitute just before use, item by item.
+                    dct = replace_targets_by_paths(dct, target_to_path)
+                    try:
+                        yield item_factory(from_target=target, **dct)
+                    except Exception as ex:  # pragma: no cover
+                        raise RuntimeError(
+                            f'Failed to process {key}: {dct} from target '
+                            f'{target}, please read the exception above.'
+                        ) from ex
 
-        target = items.pop('target')
-        for key, item_factory in key_to_item_factory.items():
-            for dct in items.pop(key, []):
-                try:
-                    yield item_factory(from_target=target, **dct)
-                except Exception as ex:  # pragma: no cover
-                    raise RuntimeError(
-                        f'Failed to process {key}: {dct} from target '
-                        f'{target}, please read the exception above.'
-                    ) from ex
+            items = {
+                k: v for k, v in feature.items()
+                    if k not in key_to_item_factory
+                        and k not in ('features', 'target')
+            }
+            assert not items, f'Unsupported items: {items}'
 
-        assert not items, f'Unsupported items: {items}'
+    yield from gen_items(feature_paths)
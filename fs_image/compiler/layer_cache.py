@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+'''
+`build_image` normally builds each layer from scratch, even if nothing it
+consumes has changed since a previous build on this host.  `LayerCache`
+keeps a read-only snapshot of each layer it builds, keyed on a hash of all
+of the compiler's inputs, so that a rebuild with the same inputs is just a
+`btrfs subvolume snapshot`.
+
+The input key covers:
+  - the source of the compiler modules that are loaded,
+  - the layer target,
+  - the parent layer & the build appliance -- see below,
+  - the content of `--yum-from-repo-snapshot`,
+  - the feature JSONs, and the content of every target that they refer to,
+    including tarballs, and the outputs of other layers,
+  - the compiler options that change how the layer is built, like
+    `--single-rpm-transaction` -- see `_layer_cache_options` in
+    `compiler.py`.
+
+A snapshot gets a new btrfs UUID, so if we keyed child layers on the UUID
+of their parent, a cache hit for the parent would be a miss for all of its
+children.  Instead, the cache remembers the input key of every layer that
+it built or restored, and children use that when it is available.
+
+Layers with mounts are never cached, since their mounts would be missing
+from the snapshot.
+
+The cache directory must be on the same btrfs volume as the subvolumes
+directory.  Concurrent compilers may share it: entries are populated
+under a temporary name and renamed into place, and each use holds a
+shared `flock`, as in `generator_tarball_cache.py`.  `collect_garbage`
+deletes entries that nobody used for a while.
+'''
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+
+from typing import Any, List, Mapping, Optional
+
+from common import get_file_logger, is_same_inode
+from subvol_utils import Subvol
+
+from . import mount_item
+from .tarball_cache import get_tarball_cache
+
+log = get_file_logger(__file__)
+
+# Entries not used for this long are garbage-collected when the compiler
+# exits.
+DEFAULT_MAX_AGE_SEC = 7 * 24 * 3600
+
+_SUBVOL_NAME = 'layer'  # The cached subvolume inside each entry
+_UUIDS_DIR = 'uuids'  # Maps the UUIDs of layers to their input keys
+_TEMP_PREFIX = '.tmp'  # Not yet populated, or about to be deleted
+
+
+def _compiler_sources_hash() -> str:
+    'Any change to the compiler may change the layers that it builds.'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    algo = hashlib.sha256()
+    for name, module in sorted(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path is None or not os.path.abspath(path).startswith(root + '/'):
+            continue
+        source = module.__loader__.get_source(name)
+        if source is None:
+            # Bytecode-only PARs lack sources, so we hash the bytecode --
+            # otherwise, all compiler versions would share cache entries.
+            source = hashlib.sha256(
+                module.__loader__.get_data(path),
+            ).hexdigest()
+        algo.update(json.dumps([name, source]).encode())
+    return algo.hexdigest()
+
+
+def _hash_path(path: str) -> Any:
+    '''
+    Describes the content of a file, or of a directory tree.  Symlinks
+    inside directories are not followed.
+    '''
+    if not os.path.isdir(path):
+        return get_tarball_cache().hexdigest(path, 'sha256')
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            entry_path = os.path.join(dirpath, name)
+            st = os.lstat(entry_path)
+            if stat.S_ISLNK(st.st_mode):
+                content = os.readlink(entry_path)
+            elif stat.S_ISREG(st.st_mode):
+                content = get_tarball_cache().hexdigest(entry_path, 'sha256')
+            else:
+                content = None
+            entries.append([
+                os.path.relpath(entry_path, path), st.st_mode, content,
+            ])
+    return entries
+
+
+def _referenced_targets(x) -> List[str]:
+    'The targets of the `__BUCK_TARGET` dicts in a feature JSON'
+    if type(x) is dict:
+        if '__BUCK_TARGET' in x:
+            return [x['__BUCK_TARGET']]
+        return [t for v in x.values() for t in _referenced_targets(v)]
+    elif type(x) is list:
+        return [t for v in x for t in _referenced_targets(v)]
+    return []
+
+
+def _target_path(target: str, target_to_path: Mapping[str, str]) -> str:
+    path = target_to_path.get(target)
+    if not path:
+        raise RuntimeError(f'{target} not in {target_to_path}')
+    return path
+
+
+class LayerCache:
+
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir
+
+    def _layer_identity(self, layer_json: Optional[str]) -> Any:
+        if not layer_json:
+            return None
+        with open(layer_json) as f:
+            uuid = json.load(f)['btrfs_uuid']
+        try:
+            with open(os.path.join(self._cache_dir, _UUIDS_DIR, uuid)) as f:
+                return {'key': f.read()}
+        except FileNotFoundError:
+            return {'uuid': uuid}
+
+    def input_key(
+        self, *,
+        layer_target: str,
+        parent_layer_json: Optional[str],
+        build_appliance_json: Optional[str],
+        yum_from_repo_snapshot: Optional[str],
+        child_feature_json: str,
+        target_to_path: Mapping[str, str],
+        options: Mapping[str, Any],
+    ) -> str:
+        '''
+        Hashes everything that `gen_parent_layer_items` and
+        `gen_items_for_features` consume to make the layer, plus the
+        JSON-serializable `options` that affect how its items are built.
+        '''
+        target_to_hash = {}
+        feature_paths = [child_feature_json]
+        while feature_paths:
+            with open(feature_paths.pop()) as f:
+                feature = json.load(f)
+            for target in _referenced_targets(feature.get('features', [])):
+                # Features reachable via several paths are hashed once.
+                if target not in target_to_hash:
+                    feature_paths.append(_target_path(target, target_to_path))
+            for target in _referenced_targets(feature):
+                if target not in target_to_hash:
+                    target_to_hash[target] = _hash_path(
+                        _target_path(target, target_to_path),
+                    )
+        return hashlib.sha256(json.dumps({
+            'compiler': _compiler_sources_hash(),
+            'layer_target': layer_target,
+            'parent_layer': self._layer_identity(parent_layer_json),
+            'build_appliance': self._layer_identity(build_appliance_json),
+            'yum_from_repo_snapshot': yum_from_repo_snapshot
+                and _hash_path(yum_from_repo_snapshot),
+            'child_feature': _hash_path(child_feature_json),
+            'targets': sorted(target_to_hash.items()),
+            'options': sorted(options.items()),
+        }).encode()).hexdigest()
+
+    def snapshot_cached(self, key: str, subvol: Subvol) -> bool:
+        '''
+        If the cache has a layer for `key`, snapshots it as `subvol`, and
+        returns True.  The snapshot is writable, like a new subvolume.
+        '''
+        entry_dir = os.path.join(self._cache_dir, key)
+        try:
+            fd = os.open(entry_dir, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # `collect_garbage` may have removed the entry before we locked.
+            if not is_same_inode(fd, entry_dir):
+                return False
+            os.utime(fd)  # `collect_garbage` keeps recently used entries
+            subvol.snapshot(Subvol(
+                os.path.join(entry_dir, _SUBVOL_NAME), already_exists=True,
+            ))
+        finally:
+            os.close(fd)
+        log.info(f'Snapshotted layer {key} from {self._cache_dir}')
+        return True
+
+    def store(self, key: str, subvol: Subvol):
+        'Adds the fully built, read-only `subvol` to the cache as `key`.'
+        if any(mount_item.mountpoints_from_subvol_meta(subvol)):
+            log.info(f'Not caching {subvol.path()}, since it has mounts')
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=self._cache_dir, prefix=_TEMP_PREFIX)
+        cached = Subvol(os.path.join(temp_dir, _SUBVOL_NAME))
+        cached.snapshot(subvol)
+        cached.set_readonly(True)
+        # Readers never see a partial entry, since we rename it into place
+        # only once it is complete.
+        try:
+            os.rename(temp_dir, os.path.join(self._cache_dir, key))
+        except OSError as ex:
+            # A concurrent compiler already populated this entry.
+            if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise  # pragma: no cover
+            cached.delete()
+            os.rmdir(temp_dir)
+
+    def remember_uuid(self, uuid: str, key: str):
+        'Lets children of the layer with this UUID use its input key.'
+        uuids_dir = os.path.join(self._cache_dir, _UUIDS_DIR)
+        os.makedirs(uuids_dir, exist_ok=True)
+        # Write & rename, so concurrent readers never see a partial file.
+        with tempfile.NamedTemporaryFile(
+            'w', dir=uuids_dir, prefix=_TEMP_PREFIX, delete=False,
+        ) as tf:
+            tf.write(key)
+        os.replace(tf.name, os.path.join(uuids_dir, uuid))
+
+    def _delete_entry(self, path: str):
+        cached_path = os.path.join(path, _SUBVOL_NAME)
+        if os.path.exists(cached_path):
+            Subvol(cached_path, already_exists=True).delete()
+        os.rmdir(path)
+
+    def collect_garbage(self, max_age_sec: float) -> List[str]:
+        '''
+        Deletes the entries that no process holds, and that were last used
+        over `max_age_sec` ago, and forgets UUIDs as old.  Returns the
+        deleted keys.
+        '''
+        if not os.path.exists(self._cache_dir):
+            return []
+        now = time.time()
+        deleted_keys = []
+        uuids_dir = os.path.join(self._cache_dir, _UUIDS_DIR)
+        for name in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, name)
+            if name == _UUIDS_DIR:
+                for uuid in os.listdir(uuids_dir):
+                    uuid_path = os.path.join(uuids_dir, uuid)
+                    if now - os.stat(uuid_path).st_mtime > max_age_sec:
+                        os.unlink(uuid_path)
+                continue
+            if name.startswith(_TEMP_PREFIX):
+                # Left behind by a compiler that crashed mid-`store`.
+                if now - os.stat(path).st_mtime > max_age_sec:
+                    self._delete_entry(path)
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:  # pragma: no cover
+                continue  # Deleted by a concurrent `collect_garbage`
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # In use
+                if now - os.fstat(fd).st_mtime <= max_age_sec:
+                    continue
+                # Move the entry out of the way first, so that no process
+                # can find it partly deleted.
+                doomed_dir = tempfile.mkdtemp(
+                    dir=self._cache_dir, prefix=_TEMP_PREFIX,
+                )
+                os.rename(path, os.path.join(doomed_dir, name))
+                self._delete_entry(os.path.join(doomed_dir, name))
+                os.rmdir(doomed_dir)
+                deleted_keys.append(name)
+            finally:
+                os.close(fd)
+        return deleted_keys
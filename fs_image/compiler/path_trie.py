@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+'''
+`PathTrie` is a mapping from paths to values, which is stored as a tree of
+path components.  Besides the usual dict operations, it can tell whether
+any of its keys is a path prefix (i.e. the path itself, or one of its
+ancestor directories) of a given path.  All operations on a single path
+cost O(depth of that path), independent of the number of keys.
+
+Paths are split on '/' with empty and '.' components ignored, so '/a/b',
+'a/b/', and 'a/./b' are all the same key.  Both image-absolute and
+image-relative paths work, but a given trie should stick to one style,
+since iteration yields each key exactly as it was first inserted.  Paths
+are NOT otherwise normalized -- '..' is an ordinary component, so
+callers should normalize first (as `PathObject` and `_protected_path_set`
+already do).
+'''
+from collections.abc import MutableMapping
+from typing import Any, Iterable, Iterator, List, Tuple
+
+
+class _Node:
+    __slots__ = ('key', 'value', 'children')
+
+    _NO_VALUE = object()
+
+    def __init__(self):
+        self.key = None  # The path that was used to store `value`
+        self.value = self._NO_VALUE
+        self.children = {}
+
+    def has_value(self) -> bool:
+        return self.value is not self._NO_VALUE
+
+
+def _split(path: str) -> List[str]:
+    return [c for c in path.split('/') if c and c != '.']
+
+
+class PathTrie(MutableMapping):
+
+    def __init__(self, items: Iterable[Tuple[str, Any]] = ()):
+        self._root = _Node()
+        self._len = 0
+        for path, value in items:
+            self[path] = value
+
+    def _find(self, path: str) -> _Node:
+        node = self._root
+        for component in _split(path):
+            node = node.children.get(component)
+            if node is None:
+                raise KeyError(path)
+        if not node.has_value():
+            raise KeyError(path)
+        return node
+
+    def __getitem__(self, path: str) -> Any:
+        return self._find(path).value
+
+    def __setitem__(self, path: str, value: Any):
+        node = self._root
+        for component in _split(path):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _Node()
+            node = child
+        if not node.has_value():
+            node.key = path
+            self._len += 1
+        node.value = value
+
+    def __delitem__(self, path: str):
+        node = self._find(path)
+        node.key = None
+        node.value = _Node._NO_VALUE
+        self._len -= 1
+        # Leave childless nodes in place -- deletions are rare, and a stale
+        # branch costs nothing but memory.
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        # Pre-order, with siblings sorted, so parents precede their children
+        # and the order is deterministic.
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.has_value():
+                yield node.key
+            stack.extend(
+                node.children[c] for c in sorted(node.children, reverse=True)
+            )
+
+    def setdefault(self, path: str, default: Any = None) -> Any:
+        # Overridden to walk the path once, not twice, since this is the
+        # hot operation in `ValidatedReqsProvs`.
+        node = self._root
+        for component in _split(path):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _Node()
+            node = child
+        if not node.has_value():
+            node.key = path
+            node.value = default
+            self._len += 1
+        return node.value
+
+    def has_prefix_of(self, path: str) -> bool:
+        '''
+        True if `path` or one of its ancestors is a key.  E.g. with the key
+        'a/b', this holds for 'a/b' and 'a/b/c', but not for 'a' or 'a/bc'.
+        '''
+        node = self._root
+        if node.has_value():
+            return True
+        for component in _split(path):
+            node = node.children.get(component)
+            if node is None:
+                return False
+            if node.has_value():
+                return True
+        return False
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self.items())!r})'
@@ -87,40 +87,22 @@ Invariants:
 
 Convention: in Python identifiers, the . of the extension maps to __.
 '''
+import base64
 import os
-import shlex
-
-from typing import Any, List
-
-
-def _make_script(dest: bytes, cmds: List[str]):
-    return [
-        # Write with `noclobber` to ensure that we fail if the file exists.
-        'bash', '-ue', '-o', 'noclobber', '-c',
-        ' ; '.join([
-            # Set umask to 0022 because bash's redirect mode is 0666, and we
-            # want file permissiosn to be 0644.
-            'umask 0022',
-            'dest=' + shlex.quote(dest.decode()),
-            'dest_dir=$(dirname "$dest")',
-            # This won't make any directories outside the subvolume, since
-            # `run_as_root` asserts that the subvolume exists.  The presumed
-            # use-case is to make `/meta/private/whatever/parent` inside a
-            # subvolume, without the client code having to worry about it.
-            # This auto-creation is OK since all metadata at present is
-            # supposed to be 0755 root:root.
-            'mkdir -p --mode=0755 "$dest_dir"',
-        ] + cmds),
-    ]
+import stat
 
+from typing import Any, List, Optional, Tuple
 
-def serialize(data: Any, subvol, path_with_ext: str):
-    '''
-    Writes `data` to `path_with_ext` inside `subvol`.  The extension
-    part of `path_with_ext` determines the serialization mechanism.
+from root_helper import WriteTree
 
-    Fails if the output file or directory exists.  Creates files with mode
-    0644, directories with mode 0755.  Both get root:root ownership.
+
+def _plan_serialization(
+    data: Any, path_with_ext: str, relpath: str,
+    plan: List[Tuple[str, Optional[bytes]]],
+):
+    '''
+    Appends to `plan` the `(relpath, content)` pairs to write for `data`,
+    with `None` content for directories.  Parents precede their children.
     '''
     if data is None:
         return  # Write nothing, `None` corresponds to the "no such file".
@@ -143,12 +125,12 @@ def serialize(data: Any, subvol, path_with_ext: str):
         raise AssertionError(f'Unsupported extension {path_with_ext}')
 
     if isinstance(data, dict):
-        subvol.run_as_root(_make_script(subvol.path(path_with_ext), [
-            # Lacks -p since we want to fail if the dir exists
-            'mkdir --mode=0755 "$dest"',
-        ]))
+        plan.append((relpath, None))
         for k, v in data.items():
-            serialize(v, subvol, os.path.join(path_with_ext, k))
+            _plan_serialization(
+                v, os.path.join(path_with_ext, k), os.path.join(relpath, k),
+                plan,
+            )
         return
 
     if isinstance(data, bool):  # bool is a subclass of int, so check this first
@@ -162,40 +144,112 @@ def serialize(data: Any, subvol, path_with_ext: str):
     else:
         raise AssertionError(f'unhandled type {type(data)} {data}')
 
-    subvol.run_as_root(
-        _make_script(subvol.path(path_with_ext), ['cat > "$dest"']),
-        input=(out_bytes + trailing_newline),
-    )
+    plan.append((relpath, out_bytes + trailing_newline))
 
 
-def deserialize(subvol, path_with_ext: str) -> Any:
-    # NB: while `isdir` and `isfile` do follow symbolic links, `subvol.path`
-    # will prevent the use of symlinks that take us outside the subvol.
-    if os.path.isdir(subvol.path(path_with_ext)):
-        return {
-            k: deserialize(subvol, os.path.join(path_with_ext, k))
-                for k in os.listdir(subvol.path(path_with_ext).decode())
-        }
-    elif os.path.isfile(subvol.path(path_with_ext)):
-        with open(subvol.path(path_with_ext), 'rb') as f:
-            s = f.read()
-
-        _, ext = os.path.splitext(path_with_ext)
-        if ext == '.bin':
-            return s
-
-        # All other extensions had a trailing newline appended.
-        if not s.endswith(b'\n'):
-            raise AssertionError(
-                f'{path_with_ext} must have had a trailing newline, got {s}'
-            )
-        s = s[:-1]
+def serialize(data: Any, subvol, path_with_ext: str):
+    '''
+    Writes `data` to `path_with_ext` inside `subvol`.  The extension
+    part of `path_with_ext` determines the serialization mechanism.
 
-        if ext == '.image_path' or ext == '.host_path':
-            return s
-        elif ext == '':
-            return s.decode()
+    Fails if the output file or directory exists.  Creates files with mode
+    0644, directories with mode 0755.  Both get root:root ownership.
+
+    The whole tree is written by one root helper op, rather than by a
+    privileged process per directory & file.  Missing parents of
+    `path_with_ext` are created with mode 0755 -- the presumed use-case is
+    to make `/meta/private/whatever/parent` inside a subvolume, without the
+    client code having to worry about it.  This is OK since all metadata at
+    present is supposed to be 0755 root:root.
+    '''
+    plan = []
+    _plan_serialization(data, path_with_ext, '', plan)
+    if not plan:
+        return
+    subvol.run_root_helper_ops([WriteTree(path=path_with_ext, entries=[
+        (relpath, None if content is None else base64.b64encode(
+            content
+        ).decode()) for relpath, content in plan
+    ])])
+
+
+def _deserialize_file(s: bytes, path_with_ext: str) -> Any:
+    _, ext = os.path.splitext(path_with_ext)
+    if ext == '.bin':
+        return s
+
+    # All other extensions had a trailing newline appended.
+    if not s.endswith(b'\n'):
+        raise AssertionError(
+            f'{path_with_ext} must have had a trailing newline, got {s}'
+        )
+    s = s[:-1]
+
+    if ext == '.image_path' or ext == '.host_path':
+        return s
+    elif ext == '':
+        return s.decode()
+    else:
+        raise AssertionError(f'Unsupported extension {path_with_ext}')
+
+
+def _read_file(name: Any, *, dir_fd: Optional[int] = None) -> bytes:
+    fd = os.open(
+        name,
+        os.O_RDONLY | os.O_CLOEXEC | (0 if dir_fd is None else os.O_NOFOLLOW),
+        dir_fd=dir_fd,
+    )
+    with open(fd, 'rb') as f:
+        return f.read()
+
+
+def _deserialize_dir(dir_fd: int, path_with_ext: str) -> dict:
+    res = {}
+    # `os.scandir` only accepts FDs as of Python 3.7.
+    for name in os.listdir(dir_fd):
+        path = os.path.join(path_with_ext, name)
+        # Below the top, never follow symlinks -- they could lead outside
+        # of the subvolume.
+        mode = os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode
+        if stat.S_ISDIR(mode):
+            fd = os.open(
+                name,
+                os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC,
+                dir_fd=dir_fd,
+            )
+            try:
+                res[name] = _deserialize_dir(fd, path)
+            finally:
+                os.close(fd)
+        elif stat.S_ISREG(mode):
+            res[name] = _deserialize_file(
+                _read_file(name, dir_fd=dir_fd), path,
+            )
         else:
-            raise AssertionError(f'Unsupported extension (path_with_ext)')
+            raise AssertionError(f'{path} is neither a file nor a dir')
+    return res
+
+
+def deserialize(subvol, path_with_ext: str) -> Any:
+    '''
+    Reads the data at `path_with_ext` in one walk.  Paths beneath it are
+    opened relative to their parent's FD, so we only pay for the safety
+    checks of `subvol.path` once.
+    '''
+    # NB: `subvol.path` will prevent the use of symlinks that take us
+    # outside the subvol, so it is OK for `stat` to follow them.
+    path = subvol.path(path_with_ext)
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:  # Like `os.path.isdir` & `os.path.isfile`
+        mode = 0
+    if stat.S_ISDIR(mode):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        try:
+            return _deserialize_dir(fd, path_with_ext)
+        finally:
+            os.close(fd)
+    elif stat.S_ISREG(mode):
+        return _deserialize_file(_read_file(path), path_with_ext)
     else:
         raise AssertionError(f'{path_with_ext} is neither a file nor a dir')
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+Applies the path-level operations of a `btrfs send -p PARENT` stream to
+the provides manifest of PARENT (see `write_provides_manifest` in
+`items.py`), yielding the manifest of the sent subvolume.
+
+This lets the compiler account for what the phases (e.g. RPM installs) did
+to a snapshot of a large parent layer without walking all of it -- the
+cost is proportional to the size of the change.  Passing `--no-data` to
+`btrfs send` keeps the stream small, since we ignore file contents.
+
+Protected paths are absent from manifests, so operations on them are
+ignored.  If an operation refers to a path that the manifest lacks, and
+that is not protected, the manifest cannot have matched PARENT, and we
+raise a `RuntimeError`.
+'''
+import os
+import stat
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from btrfs_diff.send_stream import SendStreamItem, SendStreamItems
+
+# `find -printf %y` filetypes of the inodes made by these commands
+_ITEM_TYPE_TO_FILETYPE = {
+    SendStreamItems.mkfile: 'f',
+    SendStreamItems.mkdir: 'd',
+    SendStreamItems.mkfifo: 'p',
+    SendStreamItems.mksock: 's',
+    SendStreamItems.symlink: 'l',
+}
+# The `path` of these commands is a subvolume name, not a path inside it.
+_NEW_SUBVOL_ITEMS = (SendStreamItems.subvol, SendStreamItems.snapshot)
+
+
+class _Node:
+    __slots__ = ('filetype', 'children')
+
+    def __init__(self, filetype: str):
+        self.filetype = filetype
+        self.children: Optional[Dict[str, '_Node']] = \
+            {} if filetype == 'd' else None
+
+
+class _Tree:
+
+    def __init__(self, entries: Iterable[Tuple[str, str]]):
+        self.root = None
+        for filetype, path in entries:
+            if path == '.':
+                self.root = _Node(filetype)
+            else:
+                self.add(path, _Node(filetype))
+        if self.root is None or self.root.filetype != 'd':
+            raise RuntimeError('The manifest lacks a root directory')
+
+    def _parent(self, path: str) -> Tuple[Dict[str, _Node], str]:
+        parent = self.root
+        dirname, basename = os.path.split(path)
+        for name in dirname.split('/') if dirname else ():
+            parent = (parent.children or {}).get(name)
+            if parent is None:
+                break
+        if parent is None or parent.children is None:
+            raise RuntimeError(f'{path} is not in a directory of the manifest')
+        return parent.children, basename
+
+    def get(self, path: str) -> _Node:
+        children, name = self._parent(path)
+        node = children.get(name)
+        if node is None:
+            raise RuntimeError(f'{path} is not in the manifest')
+        return node
+
+    def add(self, path: str, node: _Node, *, replace: bool = False):
+        children, name = self._parent(path)
+        if not replace and name in children:
+            raise RuntimeError(f'{path} is already in the manifest')
+        children[name] = node
+
+    def pop(self, path: str) -> _Node:
+        children, name = self._parent(path)
+        node = children.pop(name, None)
+        if node is None:
+            raise RuntimeError(f'{path} is not in the manifest')
+        return node
+
+    def entries(self) -> List[Tuple[str, str]]:
+        res = []
+        stack = [('.', self.root)]
+        while stack:
+            path, node = stack.pop()
+            res.append((node.filetype, path))
+            for name, child in (node.children or {}).items():
+                stack.append(
+                    (name if path == '.' else f'{path}/{name}', child)
+                )
+        return sorted(res, key=lambda e: e[1])
+
+
+def _filetype_of_mknod(mode: int) -> str:
+    if stat.S_ISBLK(mode):
+        return 'b'
+    if stat.S_ISCHR(mode):
+        return 'c'
+    raise RuntimeError(f'mknod with unexpected mode {mode:o}')
+
+
+def apply_sendstream_to_manifest(
+    entries: Iterable[Tuple[str, str]],
+    send_items: Iterable[SendStreamItem],
+    is_protected: Callable[[str], bool],
+) -> List[Tuple[str, str]]:
+    '''
+    `entries` are the (filetype, image-relative path) pairs of the parent's
+    manifest, and `send_items` come from `parse_send_stream`.  Returns the
+    sorted entries of the sent subvolume.
+    '''
+    tree = _Tree(entries)
+    for item in send_items:
+        if isinstance(item, _NEW_SUBVOL_ITEMS):
+            continue
+        path = item.path.decode()
+        filetype = _ITEM_TYPE_TO_FILETYPE.get(type(item))
+        if filetype is None and isinstance(item, SendStreamItems.mknod):
+            filetype = _filetype_of_mknod(item.mode)
+        if filetype is not None:
+            if not is_protected(path):
+                tree.add(path, _Node(filetype))
+        elif isinstance(item, SendStreamItems.rename):
+            dest = item.dest.decode()
+            if is_protected(path):
+                if not is_protected(dest):
+                    raise RuntimeError(f'{item} moves a protected path')
+                continue
+            node = tree.pop(path)
+            if not is_protected(dest):
+                # Like `rename(2)`, this overwrites any inode at `dest`.
+                tree.add(dest, node, replace=True)
+        elif isinstance(item, SendStreamItems.link):
+            # NB: `path` is the new link, `dest` is the existing inode.
+            if not is_protected(path):
+                tree.add(path, _Node(tree.get(item.dest.decode()).filetype))
+        elif isinstance(
+            item, (SendStreamItems.unlink, SendStreamItems.rmdir),
+        ):
+            if not is_protected(path):
+                tree.pop(path)
+        # All other commands change inode contents or metadata, which the
+        # manifest does not record.
+    return tree.entries()
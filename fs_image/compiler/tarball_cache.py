@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+'''
+`TarballItem` needs two expensive facts about its tarball: the content
+hash, and the member listing for `provides()`.  Both require reading the
+whole file -- and decompressing it, for the listing -- so for multi-GB
+tarballs, we do not want to recompute them on every compiler run.
+
+`TarballCache` remembers these facts, keyed by the identity of the file:
+its real path, device, inode, size, and modification time.  Any write to
+the file, or replacing it by another, changes the key.  The cache always
+lives in memory for the duration of the compiler run, and may also be
+persisted to a directory of JSON files, one per tarball identity.  That
+directory can be shared by concurrent compilers, since each file is
+replaced atomically.
+
+Items find the cache via `get_tarball_cache()`, since `customize_fields`
+takes no context.  The compiler opts into persistence via
+`use_tarball_cache_dir`.
+'''
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+from contextlib import contextmanager
+from typing import (
+    Any, BinaryIO, Callable, Iterator, List, Optional, Tuple,
+)
+
+
+def _hash_fd(fd: int, algorithm: str) -> str:
+    algo = hashlib.new(algorithm)
+    # `mmap` avoids copying the file through small `read` buffers, and
+    # `hashlib` releases the GIL while hashing large inputs.
+    if os.fstat(fd).st_size:  # Cannot `mmap` an empty file
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+            algo.update(m)
+    return algo.hexdigest()
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    'Returns the hex digest'
+    with open(path, 'rb') as f:
+        return _hash_fd(f.fileno(), algorithm)
+
+
+def _file_identity(path: str, st: os.stat_result) -> str:
+    return json.dumps([
+        os.path.realpath(path), st.st_dev, st.st_ino, st.st_size,
+        st.st_mtime_ns,
+    ])
+
+
+class TarballCache:
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self._cache_dir = cache_dir
+        # The in-memory layer: {json.dumps(identity): {fact: value}}
+        self._key_to_facts = {}
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(
+            self._cache_dir,
+            hashlib.sha256(key.encode()).hexdigest() + '.json',
+        )
+
+    def _load_facts(self, key: str) -> dict:
+        facts = self._key_to_facts.get(key)
+        if facts is not None:
+            return facts
+        facts = {}
+        if self._cache_dir is not None:
+            try:
+                with open(self._cache_path(key)) as f:
+                    entry = json.load(f)
+                # Guard against hash collisions in the filename.
+                if entry['key'] == key:
+                    facts = entry['facts']
+            except FileNotFoundError:
+                pass
+        self._key_to_facts[key] = facts
+        return facts
+
+    def _store_facts(self, key: str, facts: dict):
+        if self._cache_dir is None:
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        # Write & rename, so concurrent readers never see a partial file.
+        with tempfile.NamedTemporaryFile(
+            'w', dir=self._cache_dir, delete=False,
+        ) as tf:
+            json.dump({'key': key, 'facts': facts}, tf)
+        os.replace(tf.name, self._cache_path(key))
+
+    def _get(
+        self, path: str, fact_names: List[str],
+        compute: Callable[[], List[Any]], *, fd: Optional[int] = None,
+    ) -> List[Any]:
+        '''
+        Returns the values of `fact_names`, calling `compute` if any is
+        missing.  If `fd` is set, the cache key is for this open file
+        description, rather than for whatever is currently at `path`.
+        '''
+        def identity():
+            return _file_identity(
+                path, os.stat(path) if fd is None else os.fstat(fd),
+            )
+
+        key = identity()
+        facts = self._load_facts(key)
+        if any(name not in facts for name in fact_names):
+            values = compute()
+            # Only remember the values if the file did not change while we
+            # were computing them.
+            if identity() != key:
+                return values
+            facts.update(zip(fact_names, values))
+            self._store_facts(key, facts)
+        return [facts[name] for name in fact_names]
+
+    def hexdigest(self, path: str, algorithm: str) -> str:
+        return self._get(
+            path, [f'hash:{algorithm}'],
+            lambda: [hash_file(path, algorithm)],
+        )[0]
+
+    def hexdigest_of_open_file(
+        self, f: BinaryIO, path: str, algorithm: str,
+    ) -> str:
+        '''
+        Like `hexdigest`, but for the already-open `f`, found at `path`.
+        Use this to ensure that you consume the same bytes that you hashed.
+        '''
+        return self._get(
+            path, [f'hash:{algorithm}'],
+            lambda: [_hash_fd(f.fileno(), algorithm)], fd=f.fileno(),
+        )[0]
+
+    def members(
+        self, path: str, list_members: Callable[[], List[Tuple[str, bool]]],
+    ) -> List[Tuple[str, bool]]:
+        '`list_members` returns the (name, is_dir) pairs of the tarball.'
+        members, = self._get(
+            path, ['members'], lambda: [[list(m) for m in list_members()]],
+        )
+        return [(name, is_dir) for name, is_dir in members]
+
+    def hexdigest_and_members(
+        self, path: str, algorithm: str,
+        hash_and_list: Callable[[], Tuple[str, List[Tuple[str, bool]]]],
+    ) -> Tuple[str, List[Tuple[str, bool]]]:
+        '''
+        For callers that can compute both facts in one pass over the file.
+        `hash_and_list` returns the hex digest & the output of `members`.
+        '''
+        def compute():
+            hexdigest, members = hash_and_list()
+            return [hexdigest, [list(m) for m in members]]
+
+        hexdigest, members = self._get(
+            path, [f'hash:{algorithm}', 'members'], compute,
+        )
+        return hexdigest, [(name, is_dir) for name, is_dir in members]
+
+
+_tarball_cache = TarballCache()
+
+
+def get_tarball_cache() -> TarballCache:
+    return _tarball_cache
+
+
+@contextmanager
+def use_tarball_cache_dir(cache_dir: str) -> Iterator[TarballCache]:
+    'While active, `get_tarball_cache` is persisted to `cache_dir`.'
+    global _tarball_cache
+    orig_cache = _tarball_cache
+    _tarball_cache = TarballCache(cache_dir)
+    try:
+        yield _tarball_cache
+    finally:
+        _tarball_cache = orig_cache
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import itertools
+import json
 import os
 import subprocess
 import tempfile
@@ -8,8 +9,17 @@ import unittest.mock
 
 import subvol_utils
 
-from ..compiler import build_item, build_image, parse_args, LayerOpts
-from .. import subvolume_on_disk as svod
+from common import nullcontext
+from root_helper import Chmod, Chown, ExtractTarball, MakeDirs, StatOptions
+
+from ..compiler import (
+    build_item, build_image, parse_args, plan_image, LayerOpts,
+)
+from ..items import (
+    apply_stat_options, PROVIDES_MANIFEST, TarballExtractor,
+    write_provides_manifest,
+)
+from .. import items as items_mod, subvolume_on_disk as svod
 
 from . import sample_items as si
 from .mock_subvolume_from_json_file import (
@@ -19,49 +29,45 @@ from .mock_subvolume_from_json_file import (
 _orig_btrfs_get_volume_props = svod._btrfs_get_volume_props
 FAKE_SUBVOL = 'FAKE_SUBVOL'
 
-def _subvol_mock_lexists_is_btrfs_and_run_as_root(fn):
+def _subvol_mock_is_btrfs_and_run_as_root(fn):
     '''
     The purpose of these mocks is to run the compiler while recording
     what commands we WOULD HAVE run on the subvolume.  This is possible
     because all subvolume mutations are supposed to go through
-    `Subvol.run_as_root`.  This lets our tests assert that the
-    expected operations would have been executed.
+    `Subvol.run_as_root` or `Subvol.run_root_helper_ops`.  This lets our
+    tests assert that the expected operations would have been executed.
     '''
-    fn = unittest.mock.patch.object(os.path, 'lexists')(fn)
     fn = unittest.mock.patch.object(subvol_utils, '_path_is_btrfs_subvol')(fn)
     fn = unittest.mock.patch.object(subvol_utils.Subvol, 'run_as_root')(fn)
+    fn = unittest.mock.patch.object(
+        subvol_utils.Subvol, 'run_root_helper_ops',
+    )(fn)
+    fn = unittest.mock.patch.object(
+        subvol_utils.Subvol, 'root_helper', new=lambda self: nullcontext(),
+    )(fn)
     return fn
 
 
 _FIND_ARGS = [
     'find', '-P', f'{TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}', '(',
     '-path', f'{TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}/meta',
-    ')', '-prune', '-o', '-printf', '%y %p\\0',
+    ')', '-prune', '-o', '-printf', '%y %P\\0',
 ]
 
 
 def _run_as_root(args, **kwargs):
     '''
     DependencyGraph adds a ParentLayerItem to traverse the subvolume, as
-    modified by the phases. This ensures the traversal produces a subvol /
+    modified by the phases, and `write_provides_manifest` traverses it
+    again.  This ensures the traversal produces a subvol /
     '''
     if args[0] == 'find':
         assert args == _FIND_ARGS, args
         ret = unittest.mock.Mock()
-        ret.stdout = f'd {TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}\0'.encode()
+        ret.stdout = b'd \0'
         return ret
 
 
-def _os_path_lexists(path):
-    '''
-    This ugly mock exists because I don't want to set up a fake subvolume,
-    from which the `sample_items` `RemovePathItem`s can remove their files.
-    '''
-    if path.endswith(b'/to/remove'):
-        return True
-    assert 'AFAIK, os.path.lexists is only used by the `RemovePathItem` tests'
-
-
 def _btrfs_get_volume_props(subvol_path):
     if subvol_path == os.path.join(TEST_SUBVOLS_DIR, FAKE_SUBVOL):
         # We don't have an actual btrfs subvolume, so make up a UUID.
@@ -69,6 +75,20 @@ def _btrfs_get_volume_props(subvol_path):
     return _orig_btrfs_get_volume_props(subvol_path)
 
 
+def _split_root_helper_ops(calls):
+    'Makes calls comparable, however the root helper ops were batched.'
+    res = []
+    for c in calls:
+        args, *rest = tuple(c)
+        if len(args) == 1 and isinstance(args[0], list) and all(
+            hasattr(op, '_asdict') for op in args[0]
+        ):
+            res.extend((([op],), *rest) for op in args[0])
+        else:
+            res.append(tuple(c))
+    return res
+
+
 class CompilerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -81,25 +101,30 @@ class CompilerTestCase(unittest.TestCase):
             os.path.dirname(__file__), 'yum-from-test-snapshot',
         )
 
-    @_subvol_mock_lexists_is_btrfs_and_run_as_root
+    def _parse_args(self, args):
+        return parse_args([
+            '--subvolumes-dir', TEST_SUBVOLS_DIR,
+            '--subvolume-rel-path', FAKE_SUBVOL,
+            '--yum-from-repo-snapshot', self.yum_path,
+            '--child-layer-target', 'CHILD_TARGET',
+            '--child-feature-json',
+                si.TARGET_TO_PATH[si.mangle(si.T_KITCHEN_SINK)],
+        ] + args)
+
+    @_subvol_mock_is_btrfs_and_run_as_root
     @unittest.mock.patch.object(svod, '_btrfs_get_volume_props')
     def _compile(
-        self, args, btrfs_get_volume_props, lexists, is_btrfs, run_as_root,
+        self, args, btrfs_get_volume_props, is_btrfs, run_as_root,
+        run_root_helper_ops,
     ):
-        lexists.side_effect = _os_path_lexists
         run_as_root.side_effect = _run_as_root
         btrfs_get_volume_props.side_effect = _btrfs_get_volume_props
         # Since we're not making subvolumes, we need this so that
         # `Subvolume(..., already_exists=True)` will work.
         is_btrfs.return_value = True
-        return build_image(parse_args([
-            '--subvolumes-dir', TEST_SUBVOLS_DIR,
-            '--subvolume-rel-path', FAKE_SUBVOL,
-            '--yum-from-repo-snapshot', self.yum_path,
-            '--child-layer-target', 'CHILD_TARGET',
-            '--child-feature-json',
-                si.TARGET_TO_PATH[si.mangle(si.T_KITCHEN_SINK)],
-        ] + args)), run_as_root.call_args_list
+        return build_image(self._parse_args(args)), (
+            run_as_root.call_args_list + run_root_helper_ops.call_args_list
+        )
 
     def test_child_dependency_errors(self):
         with self.assertRaisesRegex(
@@ -113,7 +138,7 @@ class CompilerTestCase(unittest.TestCase):
         ):
             self._compile([])
 
-    def _compiler_run_as_root_calls(self, *, parent_args):
+    def _compiler_run_as_root_calls(self, *, parent_args, extra_args=()):
         '''
         Invoke the compiler on the targets from the "sample_items" test
         example, and ensure that the commands that the compiler would run
@@ -128,6 +153,7 @@ class CompilerTestCase(unittest.TestCase):
         '''
         res, run_as_root_calls = self._compile([
             *parent_args,
+            *extra_args,
             '--child-dependencies',
             *itertools.chain.from_iterable(si.TARGET_TO_PATH.items()),
         ])
@@ -140,10 +166,12 @@ class CompilerTestCase(unittest.TestCase):
         }), res._replace(**{svod._HOSTNAME: 'fake host'}))
         return run_as_root_calls
 
-    @_subvol_mock_lexists_is_btrfs_and_run_as_root  # Mocks from _compile()
-    def _expected_run_as_root_calls(self, lexists, is_btrfs, run_as_root):
+    @_subvol_mock_is_btrfs_and_run_as_root  # Mocks from _compile()
+    def _expected_run_as_root_calls(
+        self, is_btrfs, run_as_root, run_root_helper_ops,
+    ):
         'Get the commands that each of the *expected* sample items would run'
-        lexists.side_effect = _os_path_lexists
+        run_as_root.side_effect = _run_as_root
         is_btrfs.return_value = True
         subvol = subvol_utils.Subvol(
             f'{TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}',
@@ -161,6 +189,7 @@ class CompilerTestCase(unittest.TestCase):
                 )
             )(subvol)
 
+        stat_options = []
         for item_id, item in si.ID_TO_ITEM.items():
             if item_id not in phase_item_ids:
                 build_item(
@@ -168,8 +197,23 @@ class CompilerTestCase(unittest.TestCase):
                     subvol=subvol,
                     target_to_path=si.TARGET_TO_PATH,
                     subvolumes_dir=TEST_SUBVOLS_DIR,
+                    stat_options=stat_options,
                 )
-        return run_as_root.call_args_list + [
+        # Like the compiler, apply all the stat options in one batch.
+        self.assertIn(
+            StatOptions(path='foo/bar', mode=0o755, user='root', group='root'),
+            stat_options,
+        )
+        apply_stat_options(subvol, stat_options)
+        # The sample items have phases besides PARENT_LAYER, so this walks.
+        write_provides_manifest(
+            subvol,
+            phase_items=[si.ID_TO_ITEM[i] for i in phase_item_ids],
+            items=si.ID_TO_ITEM.values(),
+        )
+        return [
+            *run_as_root.call_args_list,
+            *run_root_helper_ops.call_args_list,
             (
                 ([
                     'btrfs', 'property', 'set', '-ts',
@@ -207,6 +251,16 @@ class CompilerTestCase(unittest.TestCase):
             expected_calls, self._compiler_run_as_root_calls(parent_args=[]),
         )
 
+        # Batching item ops runs the same ops, in fewer helper requests.
+        batched_calls = self._compiler_run_as_root_calls(
+            parent_args=[], extra_args=['--batch-item-ops'],
+        )
+        self.assertLess(len(batched_calls), len(expected_calls))
+        expected_ops = _split_root_helper_ops(expected_calls)
+        batched_ops = _split_root_helper_ops(batched_calls)
+        self.assertEqual(len(expected_ops), len(batched_ops))
+        self._assert_equal_call_sets(expected_ops, batched_ops)
+
         # Now, add an empty parent layer
         with tempfile.TemporaryDirectory() as parent, \
              mock_subvolume_from_json_file(self, path=parent) as parent_json:
@@ -220,8 +274,11 @@ class CompilerTestCase(unittest.TestCase):
                         (['btrfs', 'subvolume', 'create', subvol_path],),
                         {'_subvol_exists': False},
                     ),
-                    ((['chmod', '0755', subvol_path],), {}),
-                    ((['chown', 'root:root', subvol_path],), {}),
+                    (([
+                        Chmod(path='/', mode=0o755),
+                        Chown(path='/', user='root', group='root'),
+                        MakeDirs(path='meta/', mode=0o755),
+                    ],), {}),
                 ]
             ] + [
                 (
@@ -235,9 +292,17 @@ class CompilerTestCase(unittest.TestCase):
                     ],),
                     {'_subvol_exists': False},
                 ),
+                (
+                    ([
+                        'rm', '-f',
+                        os.path.join(subvol_path, PROVIDES_MANIFEST.encode()),
+                    ],),
+                    {},
+                ),
+                (([MakeDirs(path='meta/', mode=0o755)],), {}),
             ]
-            self.assertEqual(  # We should've removed 3, and added 2 commands
-                len(expected_calls_with_parent) + 1, len(expected_calls),
+            self.assertEqual(  # We should've removed 2, and added 4 commands
+                len(expected_calls_with_parent) - 2, len(expected_calls),
             )
             self._assert_equal_call_sets(
                 expected_calls_with_parent,
@@ -246,6 +311,173 @@ class CompilerTestCase(unittest.TestCase):
                 ]),
             )
 
+    def test_single_rpm_transaction(self):
+
+        def yum_calls(calls):
+            return [
+                c for c in calls
+                    if isinstance(c[0][0], list) and self.yum_path in c[0][0]
+            ]
+
+        # The sample items remove two RPMs, and install one.
+        self.assertEqual(2, len(yum_calls(
+            self._compiler_run_as_root_calls(parent_args=[]),
+        )))
+        (args, kwargs), = yum_calls(self._compiler_run_as_root_calls(
+            parent_args=[], extra_args=['--single-rpm-transaction'],
+        ))
+        self.assertEqual(['--', '--assumeyes', 'shell'], args[0][-3:])
+        # `yum shell` does not fail on missing RPMs, so the sandbox checks.
+        idx = args[0].index('--verify-installed')
+        self.assertEqual(
+            ['--verify-installed', 'rpm-test-mice', '--install-root'],
+            args[0][idx:idx + 3],
+        )
+        self.assertEqual(
+            b'remove-n rpm-test-carrot rpm-test-milk\n'
+            b'install-n rpm-test-mice\nrun\n',
+            kwargs['input'],
+        )
+
+    def test_yum_warm_cache_dir(self):
+        yum_calls = [
+            c[0][0] for c in self._compiler_run_as_root_calls(
+                parent_args=[], extra_args=['--yum-warm-cache-dir', '/WARM'],
+            ) if isinstance(c[0][0], list) and self.yum_path in c[0][0]
+        ]
+        self.assertEqual(2, len(yum_calls))
+        for args in yum_calls:
+            idx = args.index('--warm-cache-dir')
+            self.assertEqual('/WARM', args[idx + 1])
+            self.assertLess(idx, args.index('--install-root'))
+
+    def test_tarball_extractor(self):
+        calls = self._compiler_run_as_root_calls(
+            parent_args=[], extra_args=['--tarball-extractor', 'root-helper'],
+        )
+        self.assertEqual([], [
+            c for c in calls if isinstance(c[0][0], list) and
+                c[0][0][:1] == ['tar']
+        ])
+        hello_tar = si.TARGET_TO_PATH[si.T_HELLO_WORLD_TAR]
+        self.assertEqual({'foo/borf', 'foo'}, {
+            op.into_dir for c in calls for op in c[0][0]
+                if isinstance(op, ExtractTarball) and op.source == hello_tar
+        })
+        # The option only lasts for the one build.
+        self.assertIs(TarballExtractor.TAR, items_mod._tarball_extractor)
+
+    @unittest.mock.patch('compiler.compiler.LayerCache')
+    def test_layer_cache(self, layer_cache_cls):
+        cache = layer_cache_cls.return_value
+        cache.input_key.return_value = 'KEY'
+        cache_args = {
+            'parent_args': [], 'extra_args': ['--layer-cache-dir', '/CACHE'],
+        }
+
+        # On a miss, we build the layer as usual, and then store it.
+        cache.snapshot_cached.return_value = False
+        self._assert_equal_call_sets(
+            self._expected_run_as_root_calls(),
+            self._compiler_run_as_root_calls(**cache_args),
+        )
+        layer_cache_cls.assert_called_once_with('/CACHE')
+        cache.input_key.assert_called_once_with(
+            layer_target='CHILD_TARGET',
+            parent_layer_json=None,
+            build_appliance_json=None,
+            yum_from_repo_snapshot=self.yum_path,
+            child_feature_json=si.TARGET_TO_PATH[si.mangle(si.T_KITCHEN_SINK)],
+            target_to_path=si.TARGET_TO_PATH,
+            options={
+                'batch_item_ops': False,
+                'incremental_provides': False,
+                'single_rpm_transaction': False,
+                'tarball_extractor': 'tar',
+                'yum_warm_cache_dir': None,
+            },
+        )
+        (key, subvol), _ = cache.store.call_args
+        self.assertEqual('KEY', key)
+        self.assertEqual(
+            f'{TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}'.encode(), subvol.path(),
+        )
+        cache.remember_uuid.assert_called_once_with('fake uuid', 'KEY')
+        cache.collect_garbage.assert_called_once_with(7 * 24 * 3600)
+
+        # On a hit, we just mark the snapshot of the cached layer read-only.
+        cache.reset_mock()
+        cache.snapshot_cached.return_value = True
+        self.assertEqual([unittest.mock.call([
+            'btrfs', 'property', 'set', '-ts',
+            f'{TEST_SUBVOLS_DIR}/{FAKE_SUBVOL}'.encode(), 'ro', 'true',
+        ])], self._compiler_run_as_root_calls(**cache_args))
+        cache.store.assert_not_called()
+        cache.remember_uuid.assert_called_once_with('fake uuid', 'KEY')
+
+    def test_trace_file(self):
+        with tempfile.NamedTemporaryFile(mode='r') as tf:
+            self._compiler_run_as_root_calls(
+                parent_args=[], extra_args=['--trace-file', tf.name],
+            )
+            trace = json.load(tf)
+        spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual('build_image', spans[0]['name'])
+        self.assertEqual('CHILD_TARGET', spans[0]['args']['layer'])
+        names = {e['name'] for e in spans}
+        for name in [
+            'DependencyGraph', 'PARENT_LAYER', 'prep_item_predecessors',
+            'build_in_dependency_order', 'apply_stat_options',
+            'write_provides_manifest', 'set_readonly',
+        ]:
+            self.assertIn(name, names)
+        phase_item_ids = set(itertools.chain.from_iterable(
+            item_ids for _, item_ids in si.ORDERED_PHASES
+        ))
+        self.assertEqual({
+            type(item).__name__ for item_id, item in si.ID_TO_ITEM.items()
+                if item_id not in phase_item_ids
+        }, {e['name'] for e in spans if e['cat'] == 'item'})
+
+    @_subvol_mock_is_btrfs_and_run_as_root  # Mocks from _compile()
+    def test_plan_only(
+        self, is_btrfs, run_as_root, run_root_helper_ops,
+    ):
+        plan = json.loads(json.dumps(plan_image(self._parse_args([
+            '--plan-only',
+            '--child-dependencies',
+            *itertools.chain.from_iterable(si.TARGET_TO_PATH.items()),
+        ]))))
+        # The plan does not touch the subvolume
+        run_as_root.assert_not_called()
+        run_root_helper_ops.assert_not_called()
+
+        self.assertEqual('CHILD_TARGET', plan['layer_target'])
+        self.assertEqual([
+            (si.ID_TO_ITEM[item_ids[0]].phase_order().name, len(item_ids))
+                for _, item_ids in si.ORDERED_PHASES
+        ], [(p['phase'], len(p['items'])) for p in plan['phases']])
+        phase_item_ids = set(itertools.chain.from_iterable(
+            item_ids for _, item_ids in si.ORDERED_PHASES
+        ))
+        self.assertEqual(
+            len(si.ID_TO_ITEM) - len(phase_item_ids), len(plan['items']),
+        )
+        self.assertEqual(sorted(
+            type(item).__name__ for item_id, item in si.ID_TO_ITEM.items()
+                if item_id not in phase_item_ids
+        ), sorted(i['item']['type'] for i in plan['items']))
+        for idx, item in enumerate(plan['items']):
+            self.assertEqual('//', item['item']['from_target'][:2])
+            # Items only come after the items they depend on
+            self.assertTrue(all(a < idx for a in item['after']), item)
+        self.assertIn(
+            {'type': 'ProvidesDirectory', 'path': '/foo/bar'},
+            plan['provides'],
+        )
+        for req in plan['unverified_requires']:
+            self.assertLess(req['item_index'], len(plan['items']))
+
 
 if __name__ == '__main__':
     unittest.main()
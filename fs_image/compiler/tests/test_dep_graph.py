@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import sys
+import threading
+import time
 import unittest
 
 from tests.temp_subvolumes import TempSubvolumes
@@ -58,6 +60,12 @@ class ValidateReqsProvsTestCase(unittest.TestCase):
                 f'{ItemReq(requires=require_directory("/"), item=item)}$',
         ):
             ValidatedReqsProvs([item])
+        unmatched_reqs = []
+        ValidatedReqsProvs([item], unmatched_reqs=unmatched_reqs)
+        self.assertEqual(
+            [ItemReq(requires=require_directory('/'), item=item)],
+            unmatched_reqs,
+        )
 
     def test_paths_to_reqs_provs(self):
         self.assertEqual(
@@ -209,6 +217,164 @@ class DependencyOrderItemsTestCase(unittest.TestCase):
         with self.assertRaisesRegex(AssertionError, '^Cycle in '):
             list(dg.gen_dependency_order_items('fake_subvol_path'))
 
+    def test_merge_same_builder(self):
+
+        def fake_phase_item(order, builder):
+
+            class FakePhaseItem:
+                get_phase_builder = builder
+
+                def phase_order(self):
+                    return order
+
+            return FakePhaseItem()
+
+        root = FilesystemRootItem(from_target='')
+        remove = fake_phase_item(PhaseOrder.RPM_REMOVE, 'rpm')
+        install = fake_phase_item(PhaseOrder.RPM_INSTALL, 'rpm')
+        remove_paths = fake_phase_item(PhaseOrder.REMOVE_PATHS, 'paths')
+        dg = DependencyGraph([remove_paths, install, root, remove])
+        self.assertEqual(_fs_root_phases(root) + [
+            ('rpm', (remove,)),
+            ('rpm', (install,)),
+            ('paths', (remove_paths,)),
+        ], list(dg.ordered_phases()))
+        self.assertEqual(_fs_root_phases(root) + [
+            ('rpm', (remove, install)), ('paths', (remove_paths,)),
+        ], list(dg.ordered_phases(merge_same_builder=True)))
+
+    def test_plan_dependency_order(self):
+        dg = DependencyGraph(PATH_TO_ITEM.values())
+        self.assertEqual([
+            (PATH_TO_ITEM[p], {PATH_TO_ITEM[d] for d in deps})
+                for p, deps in [
+                    # Of the ready items, the one with the least `repr` is
+                    # next: `CopyFileItem` sorts before `MakeDirsItem`.
+                    ('/a/b/c', []),
+                    ('/a/b/c/F', ['/a/b/c']),
+                    ('/a/d/e', ['/a/b/c']),
+                    ('/a/d/e/G', ['/a/d/e']),
+                ]
+        ], dg.plan_dependency_order())
+
+    def test_plan_dependency_order_with_phases(self):
+
+        class FakeRemovePaths:
+            get_phase_builder = 'kittycat'
+
+            def phase_order(self):
+                return PhaseOrder.REMOVE_PATHS
+
+        root = FilesystemRootItem(from_target='')
+        # Nothing provides `/x`, but a phase might have.
+        needs_x = MakeDirsItem(from_target='', into_dir='x', path_to_make='y')
+        dg = DependencyGraph([root, FakeRemovePaths(), needs_x])
+        unmatched_reqs = []
+        self.assertEqual(
+            [(needs_x, set())],
+            dg.plan_dependency_order(unmatched_reqs=unmatched_reqs),
+        )
+        self.assertEqual(
+            [ItemReq(requires=require_directory('/x'), item=needs_x)],
+            unmatched_reqs,
+        )
+
+    def _build_in_dependency_order(self, dg, *, max_workers, fail_on=None):
+        built = []
+        running = set()
+        max_running = 0
+        lock = threading.Lock()
+        ns = dg._prep_item_predecessors('fake_subvol_path')
+        item_to_predecessors = {
+            k: set(v) for k, v in ns.item_to_predecessors.items()
+        }
+
+        def build(item):
+            nonlocal max_running
+            with lock:
+                # All predecessors, except for the parent layer, are done.
+                self.assertEqual(set(), {
+                    i for i in item_to_predecessors.get(item, ())
+                        if i not in built
+                } - {PATH_TO_ITEM['/']})
+                running.add(item)
+                max_running = max(max_running, len(running))
+            time.sleep(0.05)
+            if item == fail_on:
+                raise RuntimeError('Failed to build')
+            with lock:
+                running.remove(item)
+                built.append(item)
+
+        # `_prep_item_predecessors` mutated `dg`, but it is idempotent.
+        stats = dg.build_in_dependency_order(
+            'fake_subvol_path', build, max_workers=max_workers,
+        )
+        return stats, built, max_running
+
+    def test_build_in_dependency_order(self):
+        for max_workers in [1, 2, 5]:
+            dg = DependencyGraph(PATH_TO_ITEM.values())
+            stats, built, max_running = self._build_in_dependency_order(
+                dg, max_workers=max_workers,
+            )
+            self.assertEqual(
+                {PATH_TO_ITEM[p] for p in PATH_TO_ITEM if p != '/'},
+                set(built),
+            )
+            self.assertEqual(4, len(built))
+            self.assertEqual(PATH_TO_ITEM['/a/b/c'], built[0])
+            # `/a/b/c/F` and `/a/d/e` become ready at the same time.
+            self.assertEqual(min(2, max_workers), max_running)
+            self.assertEqual((4, max_workers), stats[:2])
+            # The critical path is `/a/b/c`, `/a/d/e`, `/a/d/e/G`
+            self.assertGreaterEqual(stats.critical_path_sec, 0.15)
+            self.assertGreaterEqual(stats.total_work_sec, 0.2)
+            self.assertLess(stats.critical_path_sec, stats.total_work_sec)
+            self.assertGreaterEqual(stats.wall_sec, stats.critical_path_sec)
+
+    def test_build_in_dependency_order_batches(self):
+        dg = DependencyGraph(PATH_TO_ITEM.values())
+        built = []
+        batches = []
+        stats = dg.build_in_dependency_order(
+            'fake_subvol_path', built.append, max_workers=2,
+            is_batchable=lambda item: item != PATH_TO_ITEM['/a/b/c'],
+            build_batch_fn=lambda items: batches.append(set(items)),
+        )
+        self.assertEqual([PATH_TO_ITEM['/a/b/c']], built)
+        # `/a/b/c/F` and `/a/d/e` become ready at the same time.
+        self.assertEqual([
+            {PATH_TO_ITEM['/a/b/c/F'], PATH_TO_ITEM['/a/d/e']},
+            {PATH_TO_ITEM['/a/d/e/G']},
+        ], batches)
+        self.assertEqual(4, stats.num_items)
+
+    def test_build_in_dependency_order_error(self):
+        dg = DependencyGraph(PATH_TO_ITEM.values())
+        with self.assertRaisesRegex(RuntimeError, '^Failed to build$'):
+            self._build_in_dependency_order(
+                dg, max_workers=2, fail_on=PATH_TO_ITEM['/a/d/e'],
+            )
+
+    def test_build_in_dependency_order_cycle(self):
+        class RequiresProvidesDirectory(metaclass=ImageItem):
+            def requires(self):
+                yield require_directory('a/b')
+
+            def provides(self):
+                yield ProvidesDirectory(path='a')
+
+        dg = DependencyGraph([
+            RequiresProvidesDirectory(from_target=''),
+            FilesystemRootItem(from_target=''),
+            MakeDirsItem(from_target='', into_dir='a', path_to_make='b/c'),
+        ])
+        with self.assertRaisesRegex(AssertionError, '^Cycle in '):
+            dg.build_in_dependency_order(
+                'fake_subvol_path', lambda item: None, max_workers=2,
+            )
+
     def test_phase_order(self):
 
         class FakeRemovePaths:
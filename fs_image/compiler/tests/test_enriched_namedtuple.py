@@ -158,6 +158,52 @@ class EnrichedNamedtupleTestCase(unittest.TestCase):
         ):
             print(FailsToSetNonConstructible())
 
+    def test_customize_fields_fn_adds_field(self):
+
+        class TypeAddsField(type):
+            def __new__(metacls, classname, bases, dct):
+
+                def customize_fields(field_to_value):
+                    field_to_value['extra'] = 1
+                    return field_to_value
+
+                return metaclass_new_enriched_namedtuple(
+                    __class__, ['n'], metacls, classname, bases, dct,
+                    customize_fields
+                )
+
+        class AddsField(metaclass=TypeAddsField):
+            pass
+
+        with self.assertRaisesRegex(
+            TypeError, "unexpected keyword argument 'extra'",
+        ):
+            AddsField(n=3)
+
+    def test_no_fields(self):
+
+        class TypeNoFields(type):
+            def __new__(metacls, classname, bases, dct):
+                return metaclass_new_enriched_namedtuple(
+                    __class__, [], metacls, classname, bases, dct,
+                )
+
+        class NoFields(metaclass=TypeNoFields):
+            pass
+
+        self.assertEqual(('DO_NOT_USE_type',), NoFields._fields)
+        self.assertEqual('NoFields()', repr(NoFields()))
+
+    def test_new_trusted(self):
+        algae = Algae._new_trusted('red', False, True)
+        self.assertEqual(
+            Algae(color='red', has_roots=False, is_saltwater=True), algae,
+        )
+        self._check_values(
+            algae, {'color': 'red', 'has_roots': False, 'is_saltwater': True},
+        )
+        self.assertNotEqual(Grain._new_trusted('red', False, True), algae)
+
     def test_slots_errors(self):
 
         class BadBase:
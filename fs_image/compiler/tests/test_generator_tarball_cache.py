@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import fcntl
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from contextlib import ExitStack
+
+from ..generator_tarball_cache import (
+    GeneratorTarballCache, get_generator_tarball_cache,
+    use_generator_tarball_cache_dir,
+)
+
+
+class GeneratorTarballCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir_ctx = tempfile.TemporaryDirectory()
+        self.temp_dir = self.temp_dir_ctx.__enter__()
+        self.addCleanup(self.temp_dir_ctx.__exit__, None, None, None)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.generator = os.path.join(self.temp_dir, 'gen')
+        with open(self.generator, 'w') as f:
+            f.write('generator v1')
+        self.num_generated = 0
+
+    def _generate(self, output_dir):
+        self.num_generated += 1
+        os.mkdir(os.path.join(output_dir, 'sub'))
+        tarball = os.path.join(output_dir, 'sub/t.tar')
+        with open(tarball, 'w') as f:
+            f.write(f'tarball {self.num_generated}')
+        return tarball
+
+    def _get(self, cache, exit_stack, args=('a',), tarball_hash='sha256:0'):
+        return cache.get(
+            exit_stack,
+            generator=self.generator,
+            generator_args=list(args),
+            tarball_hash=tarball_hash,
+            generate=self._generate,
+        )
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_temporary(self):
+        cache = GeneratorTarballCache()
+        with ExitStack() as outer:
+            t1 = self._get(cache, outer)
+            with ExitStack() as inner:
+                self.assertEqual(t1, self._get(cache, inner))
+                self.assertNotEqual(t1, self._get(cache, inner, args=['b']))
+                self.assertEqual(2, self.num_generated)
+            # The outer reference keeps the tarball alive
+            self.assertEqual('tarball 1', self._read(t1))
+        self.assertFalse(os.path.exists(t1))
+        # Once all references are gone, we must generate it again.
+        with ExitStack() as exit_stack:
+            self.assertEqual('tarball 3', self._read(
+                self._get(cache, exit_stack)
+            ))
+
+    def test_temporary_failure(self):
+        cache = GeneratorTarballCache()
+        with unittest.mock.patch('tempfile.mkdtemp') as mock_mkdtemp:
+            mock_mkdtemp.return_value = os.path.join(self.temp_dir, 'fail')
+            os.mkdir(mock_mkdtemp.return_value)
+            with self.assertRaisesRegex(RuntimeError, 'gen failed'), \
+                    ExitStack() as exit_stack:
+                cache.get(
+                    exit_stack, generator=self.generator, generator_args=[],
+                    tarball_hash='sha256:0',
+                    generate=unittest.mock.Mock(
+                        side_effect=RuntimeError('gen failed'),
+                    ),
+                )
+            self.assertFalse(os.path.exists(mock_mkdtemp.return_value))
+
+    def test_key(self):
+        cache = GeneratorTarballCache(self.cache_dir)
+        with ExitStack() as exit_stack:
+            t = self._get(cache, exit_stack)
+            self.assertEqual(t, self._get(cache, exit_stack))
+            self.assertNotEqual(t, self._get(
+                cache, exit_stack, tarball_hash='sha256:1',
+            ))
+            self.assertNotEqual(t, self._get(cache, exit_stack, args=[]))
+            with open(self.generator, 'w') as f:
+                f.write('generator v2')
+            self.assertNotEqual(t, self._get(cache, exit_stack))
+        self.assertEqual(4, self.num_generated)
+        self.assertEqual(4, len(os.listdir(self.cache_dir)))
+
+    def test_persisted(self):
+        with ExitStack() as exit_stack:
+            t = self._get(GeneratorTarballCache(self.cache_dir), exit_stack)
+            self.assertTrue(t.endswith('/sub/t.tar'), t)
+        # A later build reuses the tarball without running the generator.
+        with ExitStack() as exit_stack:
+            self.assertEqual(t, self._get(
+                GeneratorTarballCache(self.cache_dir), exit_stack,
+            ))
+        self.assertEqual(1, self.num_generated)
+        self.assertEqual('tarball 1', self._read(t))
+
+    def test_concurrent_populate(self):
+        cache = GeneratorTarballCache(self.cache_dir)
+        other_cache = GeneratorTarballCache(self.cache_dir)
+
+        # Another compiler populates the entry while we are generating.
+        def generate(output_dir):
+            with ExitStack() as exit_stack:
+                self._get(other_cache, exit_stack)
+            return self._generate(output_dir)
+
+        with ExitStack() as exit_stack:
+            t = cache.get(
+                exit_stack, generator=self.generator, generator_args=['a'],
+                tarball_hash='sha256:0', generate=generate,
+            )
+            # The other compiler's tarball won, and ours was cleaned up.
+            self.assertEqual('tarball 1', self._read(t))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_collect_garbage(self):
+        self.assertEqual([], GeneratorTarballCache().collect_garbage(0))
+        self.assertEqual(
+            [], GeneratorTarballCache(self.cache_dir).collect_garbage(0),
+        )
+
+        cache = GeneratorTarballCache(self.cache_dir)
+        with ExitStack() as exit_stack:
+            t_old = self._get(cache, exit_stack, args=['old'])
+        with ExitStack() as exit_stack:
+            t_new = self._get(cache, exit_stack, args=['new'])
+        key_old, key_new = (
+            os.path.relpath(t, self.cache_dir).split('/')[0]
+                for t in (t_old, t_new)
+        )
+        os.utime(os.path.join(self.cache_dir, key_old), (0, 0))
+        # A leftover from a crashed generator
+        os.mkdir(os.path.join(self.cache_dir, '.tmpcrashed'))
+        os.utime(os.path.join(self.cache_dir, '.tmpcrashed'), (0, 0))
+
+        with ExitStack() as exit_stack:
+            # Entries in use are never deleted, regardless of age.
+            t_in_use = self._get(cache, exit_stack, args=['in use'])
+            key_in_use = os.path.relpath(t_in_use, self.cache_dir)[:64]
+            os.utime(os.path.join(self.cache_dir, key_in_use), (0, 0))
+            self.assertEqual([key_old], cache.collect_garbage(3600))
+            self.assertEqual(
+                {key_new, key_in_use}, set(os.listdir(self.cache_dir)),
+            )
+            self.assertEqual([key_new], cache.collect_garbage(-1))
+        self.assertEqual([key_in_use], cache.collect_garbage(-1))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_reopen_after_collect_garbage(self):
+        cache = GeneratorTarballCache(self.cache_dir)
+        with ExitStack() as exit_stack:
+            self._get(cache, exit_stack)
+        orig_flock = fcntl.flock
+
+        # Garbage-collect the entry right before we lock it.
+        def flock(fd, op):
+            if op == fcntl.LOCK_SH and self.num_generated == 1:
+                cache.collect_garbage(-1)
+            return orig_flock(fd, op)
+
+        with unittest.mock.patch('fcntl.flock', side_effect=flock), \
+                ExitStack() as exit_stack:
+            self.assertEqual('tarball 2', self._read(
+                self._get(cache, exit_stack),
+            ))
+
+    def test_missing_tarball_name(self):
+        cache = GeneratorTarballCache(self.cache_dir)
+        with ExitStack() as exit_stack:
+            t = self._get(cache, exit_stack)
+        os.unlink(os.path.join(t.split('/out/')[0], 'tarball_name'))
+        with self.assertRaises(FileNotFoundError), ExitStack() as exit_stack:
+            self._get(cache, exit_stack)
+
+    def test_use_generator_tarball_cache_dir(self):
+        orig_cache = get_generator_tarball_cache()
+        with use_generator_tarball_cache_dir(
+            self.cache_dir, max_age_sec=-1,
+        ) as cache:
+            self.assertIs(cache, get_generator_tarball_cache())
+            self.assertIsNot(orig_cache, cache)
+            with ExitStack() as exit_stack:
+                self._get(cache, exit_stack)
+            self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        self.assertIs(orig_cache, get_generator_tarball_cache())
+        # Exiting collects garbage
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
+import json
+import os
 import sys
+import tempfile
 import unittest
+import unittest.mock
 
 from tests.temp_subvolumes import TempSubvolumes
 
 from ..dep_graph import DependencyGraph
-from ..items import FilesystemRootItem, RemovePathItem, RpmActionItem
-from ..items_for_features import gen_items_for_features
+from ..items import (
+    CopyFileItem, FilesystemRootItem, MakeDirsItem, RemovePathItem,
+    RpmActionItem,
+)
+from ..items_for_features import (
+    gen_items_for_features, replace_targets_by_paths,
+)
 
 from . import sample_items as si
 
@@ -36,6 +45,81 @@ class ImageFeatureTestCase(unittest.TestCase):
                 target_to_path={},
             ))
 
+    def test_replace_targets_by_paths(self):
+        unchanged = {'a': [1, 'b', None], 'c': {'d': 2.5}}
+        x = {
+            'unchanged': unchanged,
+            'list': [{'__BUCK_TARGET': '//x:y'}, unchanged],
+        }
+        replaced = replace_targets_by_paths(x, {'//x:y': '/path'})
+        self.assertEqual({
+            'unchanged': unchanged, 'list': ['/path', unchanged],
+        }, replaced)
+        # Only the containers of targets are copied
+        self.assertEqual(
+            {'__BUCK_TARGET': '//x:y'}, x['list'][0], msg='input mutated',
+        )
+        self.assertIs(unchanged, replaced['unchanged'])
+        self.assertIs(unchanged, replaced['list'][1])
+        self.assertIs(unchanged, replace_targets_by_paths(unchanged, {}))
+
+    def test_diamond_and_parse_cache(self):
+        with tempfile.TemporaryDirectory() as td:
+            def write(name, feature):
+                with open(os.path.join(td, name), 'w') as f:
+                    json.dump(feature, f)
+
+            def make_dirs_item(name):
+                return MakeDirsItem(
+                    from_target=f'//t:{name}', into_dir='/',
+                    path_to_make=name,
+                )
+
+            target_to_path = {
+                f'//t:{n}': os.path.join(td, n) for n in ['a', 'b', 'c']
+            }
+            # Both `//t:a` and `//t:b` include `//t:c`
+            for n in ['a', 'b']:
+                write(n, {
+                    'target': f'//t:{n}',
+                    'features': [{'__BUCK_TARGET': '//t:c'}],
+                    'make_dirs': [{'into_dir': '/', 'path_to_make': n}],
+                })
+            write('c', {'target': '//t:c', 'copy_files': [
+                {'source': {'__BUCK_TARGET': '//t:a'}, 'dest': '/a'},
+            ]})
+
+            def gen_items():
+                return list(gen_items_for_features(
+                    exit_stack=None,
+                    feature_paths=[
+                        target_to_path['//t:a'], target_to_path['//t:b'],
+                    ],
+                    target_to_path=target_to_path,
+                ))
+
+            items_ab = [make_dirs_item('a'), make_dirs_item('b')]
+            self.assertEqual([CopyFileItem(
+                from_target='//t:c', source=target_to_path['//t:a'],
+                dest='/a',
+            )] + items_ab, gen_items())
+
+            # Unchanged files are not parsed again...
+            with unittest.mock.patch.object(json, 'load') as mock_load:
+                self.assertEqual(3, len(gen_items()))
+            mock_load.assert_not_called()
+            # ... but changed files are.
+            write('c', {'target': '//t:c', 'make_dirs': [
+                {'into_dir': '/', 'path_to_make': 'c'},
+            ]})
+            self.assertEqual([make_dirs_item('c')] + items_ab, gen_items())
+
+            write('c', {'target': '//t:c', 'bad_key': []})
+            with self.assertRaisesRegex(
+                AssertionError, r"Unsupported items: {'bad_key': \[\]}",
+            ):
+                gen_items()
+
     def test_install_order(self):
         dg = DependencyGraph(si.ID_TO_ITEM.values())
         builders_and_phases = list(dg.ordered_phases())
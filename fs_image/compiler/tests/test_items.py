@@ -16,11 +16,15 @@ from btrfs_diff.tests.render_subvols import render_sendstream
 from tests.temp_subvolumes import TempSubvolumes
 
 from ..items import (
-    CopyFileItem, FilesystemRootItem, gen_parent_layer_items, LayerOpts,
-    MakeDirsItem, MountItem, ParentLayerItem, PhaseOrder, RemovePathAction,
-    RemovePathItem, RpmActionItem, RpmAction, SymlinkToDirItem,
-    SymlinkToFileItem, TarballItem, _hash_tarball, _protected_path_set,
-    tarball_item_factory,
+    CopyFileItem, FilesystemRootItem, gen_parent_layer_items, HasStatOptions,
+    ImageItem, LayerOpts, MakeDirsItem, MountItem, ParentLayerItem,
+    PhaseOrder, PROVIDES_MANIFEST, RemovePathAction, RemovePathItem,
+    RpmActionItem, RpmAction,
+    SymlinkToDirItem, SymlinkToFileItem, TarballExtractor, TarballItem,
+    _add_provided_paths, _hash_and_list_tarball, _hash_tarball,
+    _list_tarball, _protected_path_set, tarball_item_factory,
+    update_provides_manifest_after_phases, use_tarball_extractor,
+    write_provides_manifest,
 )
 from ..provides import ProvidesDirectory, ProvidesDoNotAccess, ProvidesFile
 from ..requires import require_directory, require_file
@@ -211,9 +215,11 @@ class ItemsTestCase(unittest.TestCase):
             ).build(subvol)
             self.assertEqual(['(Dir)', {
                 'd': ['(Dir)', {
-                    # permissions overwritten for this whole tree
+                    # permissions overwritten for the paths of the item,
+                    # but stat options are not recursive.
                     'a': ['(Dir o5:0)', {
-                        'b': ['(Dir o5:0)', {}], 'new': ['(Dir o5:0)', {}],
+                        'b': ['(Dir m500 o77:88)', {}],
+                        'new': ['(Dir o5:0)', {}],
                     }],
                 }],
                 'no_dir': ['(Dir)', {  # default permissions!
@@ -612,6 +618,43 @@ class ItemsTestCase(unittest.TestCase):
                     force_root_ownership=False,
                 )
 
+    def test_hash_and_list_tarball(self):
+        with self._temp_filesystem() as fs_path, \
+                tempfile.TemporaryDirectory() as td:
+            tar_path = os.path.join(td, 'test.tar')
+            tgz_path = os.path.join(td, 'test.tgz')
+            zst_path = os.path.join(td, 'test.tar.zst')
+            for path, mode in ((tar_path, 'w'), (tgz_path, 'w:gz')):
+                with tarfile.open(path, mode) as tar_obj:
+                    tar_obj.add(
+                        fs_path, filter=_tarinfo_strip_dir_prefix(fs_path),
+                    )
+            subprocess.check_call(['zstd', tar_path, '-o', zst_path])
+
+            # One pass gets the same results as separately hashing & listing
+            for path in (tar_path, tgz_path, zst_path):
+                self.assertEqual(
+                    (_hash_tarball(path, 'sha256'), _list_tarball(path)),
+                    _hash_and_list_tarball(path, 'sha256'),
+                )
+
+            bad_path = os.path.join(td, 'bad.tar')
+            with open(bad_path, 'wb') as f:
+                f.write(b'not a tarball' * 100)
+            with self.assertRaises(tarfile.ReadError):
+                _hash_and_list_tarball(bad_path, 'sha256')
+            with self.assertRaises(tarfile.ReadError):
+                _tarball_item(bad_path, 'y')
+            # With the wrong hash, the validation error is more helpful.
+            with self.assertRaisesRegex(AssertionError, 'failed hash vali'):
+                TarballItem(
+                    from_target='t',
+                    into_dir='y',
+                    tarball=bad_path,
+                    hash='sha256:deadbeef',
+                    force_root_ownership=False,
+                )
+
     # NB: We don't need to test `build` because TarballItem has no logic
     # specific to generated vs pre-built tarballs.  It would really be
     # enough just to construct the item, but it was easy to test `provides`.
@@ -621,8 +664,9 @@ class ItemsTestCase(unittest.TestCase):
                 ExitStack() as exit_stack:
             with tarfile.TarFile(t.name, 'w') as tar_obj:
                 tar_obj.add(fs_path, filter=_tarinfo_strip_dir_prefix(fs_path))
-            self._check_item(
-                tarball_item_factory(
+
+            def make_item():
+                return tarball_item_factory(
                     exit_stack=exit_stack,
                     from_target='t',
                     into_dir='y',
@@ -635,10 +679,17 @@ class ItemsTestCase(unittest.TestCase):
                     ],
                     hash='sha256:' + _hash_tarball(t.name, 'sha256'),
                     force_root_ownership=False,
-                ),
+                )
+
+            item = make_item()
+            self._check_item(
+                item,
                 self._temp_filesystem_provides('y'),
                 {require_directory('y')},
             )
+            # Identical generator invocations share a tarball, so the
+            # resulting items deduplicate.
+            self.assertEqual(item, make_item())
 
     def test_tarball_command(self):
         with TempSubvolumes(sys.argv[0]) as temp_subvolumes:
@@ -650,8 +701,10 @@ class ItemsTestCase(unittest.TestCase):
             with tempfile.NamedTemporaryFile() as t:
                 with tarfile.TarFile(t.name, 'w') as tar_obj:
                     tar_obj.addfile(tarfile.TarInfo('exists'))
-                with self.assertRaises(subprocess.CalledProcessError):
-                    _tarball_item(t.name, '/d').build(subvol)
+                for extractor in TarballExtractor:
+                    with use_tarball_extractor(extractor), \
+                            self.assertRaises(subprocess.CalledProcessError):
+                        _tarball_item(t.name, '/d').build(subvol)
 
             # Adding new files & directories works. Overwriting a
             # pre-existing directory leaves the owner+mode of the original
@@ -661,9 +714,16 @@ class ItemsTestCase(unittest.TestCase):
             subvol.run_as_root(['chmod', '0301', subvol.path('d/old_dir')])
             subvol_root = temp_subvolumes.snapshot(subvol, 'tar-sv-root')
             subvol_zst = temp_subvolumes.snapshot(subvol, 'tar-sv-zst')
+            subvol_tgz = temp_subvolumes.snapshot(subvol, 'tar-sv-tgz')
+            subvol_tbz2 = temp_subvolumes.snapshot(subvol, 'tar-sv-tbz2')
+            subvol_txz = temp_subvolumes.snapshot(subvol, 'tar-sv-txz')
+            subvol_helper = temp_subvolumes.snapshot(subvol, 'tar-sv-helper')
             with tempfile.TemporaryDirectory() as td:
                 tar_path = os.path.join(td, 'test.tar')
                 zst_path = os.path.join(td, 'test.tar.zst')
+                tgz_path = os.path.join(td, 'test.tgz')
+                tbz2_path = os.path.join(td, 'test.tar.bz2')
+                txz_path = os.path.join(td, 'test.txz')
                 with tarfile.TarFile(tar_path, 'w') as tar_obj:
                     tar_obj.addfile(tarfile.TarInfo('new_file'))
 
@@ -682,10 +742,23 @@ class ItemsTestCase(unittest.TestCase):
                     tar_obj.addfile(old_dir)
 
                 subprocess.check_call(['zstd', tar_path, '-o', zst_path])
+                # `tar` detects the compression of formats that
+                # `decompress_command` does not handle.
+                for compressor, path in (
+                    ('gzip', tgz_path),
+                    ('bzip2', tbz2_path),
+                    ('xz', txz_path),
+                ):
+                    with open(path, 'wb') as f:
+                        subprocess.check_call(
+                            [compressor, '--stdout', tar_path], stdout=f,
+                        )
 
                 # Fail when the destination does not exist
-                with self.assertRaises(subprocess.CalledProcessError):
-                    _tarball_item(tar_path, '/no_dir').build(subvol)
+                for extractor in TarballExtractor:
+                    with use_tarball_extractor(extractor), \
+                            self.assertRaises(subprocess.CalledProcessError):
+                        _tarball_item(tar_path, '/no_dir').build(subvol)
 
                 # Before unpacking the tarball
                 orig_content = ['(Dir)', {'d': ['(Dir)', {
@@ -705,24 +778,51 @@ class ItemsTestCase(unittest.TestCase):
                 self.assertNotEqual(new_content, new_content_root)
 
                 # Check the subvolume content before and after unpacking
-                for item, (sv, before, after) in (
+                tar = TarballExtractor.TAR
+                for item, extractor, (sv, before, after) in (
                     (
-                        _tarball_item(tar_path, '/d/'),
+                        _tarball_item(tar_path, '/d/'), tar,
                         (subvol, orig_content, new_content),
                     ),
                     (
                         _tarball_item(tar_path, 'd', force_root_ownership=True),
+                        tar,
                         (subvol_root, orig_content, new_content_root),
                     ),
                     (
-                        _tarball_item(zst_path, 'd/'),
+                        _tarball_item(zst_path, 'd/'), tar,
                         (subvol_zst, orig_content, new_content),
                     ),
+                    (
+                        _tarball_item(tgz_path, 'd/'), tar,
+                        (subvol_tgz, orig_content, new_content),
+                    ),
+                    (
+                        _tarball_item(tbz2_path, 'd/'), tar,
+                        (subvol_tbz2, orig_content, new_content),
+                    ),
+                    (
+                        _tarball_item(txz_path, 'd/'), tar,
+                        (subvol_txz, orig_content, new_content),
+                    ),
+                    (
+                        _tarball_item(zst_path, 'd/'),
+                        TarballExtractor.ROOT_HELPER,
+                        (subvol_helper, orig_content, new_content),
+                    ),
                 ):
                     self.assertEqual(before, _render_subvol(sv))
-                    item.build(sv)
+                    with use_tarball_extractor(extractor):
+                        item.build(sv)
                     self.assertEqual(after, _render_subvol(sv))
 
+                # Do not extract a tarball that changed since validation
+                item = _tarball_item(tar_path, '/no_dir')
+                with open(tar_path, 'ab') as f:
+                    f.write(b'\0' * 512)
+                with self.assertRaisesRegex(AssertionError, 'failed hash va'):
+                    item.build(subvol)
+
     def test_parent_layer_provides(self):
         with TempSubvolumes(sys.argv[0]) as temp_subvolumes:
             parent = temp_subvolumes.create('parent')
@@ -774,6 +874,135 @@ class ItemsTestCase(unittest.TestCase):
             child_content[1]['meta'] = ['(Dir)', {}]
             self.assertEqual(child_content, _render_subvol(child))
 
+    def test_provides_manifest(self):
+        with TempSubvolumes(sys.argv[0]) as temp_subvolumes:
+            parent = temp_subvolumes.caller_will_create('parent')
+            root_item = FilesystemRootItem(from_target='t')
+            root_item.get_phase_builder([root_item], DUMMY_LAYER_OPTS)(parent)
+            parent_items = [
+                MakeDirsItem(
+                    from_target='t', into_dir='/', path_to_make='a/b',
+                ),
+                SymlinkToDirItem(from_target='t', source='/a', dest='/c'),
+            ]
+            for item in parent_items:
+                item.build(parent)
+            write_provides_manifest(
+                parent, phase_items=[root_item], items=parent_items,
+            )
+            with open(parent.path(PROVIDES_MANIFEST), 'rb') as f:
+                self.assertEqual(b'd .\0d a\0d a/b\0l c\0', f.read())
+
+            # Children read the manifest instead of walking the parent.
+            parent_item = ParentLayerItem(
+                from_target='t', path=parent.path().decode(),
+            )
+            with unittest.mock.patch(
+                'compiler.items._find_provides_manifest',
+            ) as find:
+                self._check_item(parent_item, {
+                    ProvidesDirectory(path='/'),
+                    ProvidesDirectory(path='/a'),
+                    ProvidesDirectory(path='/a/b'),
+                    ProvidesFile(path='/c'),
+                    ProvidesDoNotAccess(path='/meta'),
+                }, set())
+            find.assert_not_called()
+
+            # The snapshot's copy of the parent manifest would go stale, so
+            # the builder deletes it.
+            child = temp_subvolumes.caller_will_create('child')
+            parent_item.get_phase_builder([parent_item], DUMMY_LAYER_OPTS)(
+                child
+            )
+            self.assertFalse(os.path.exists(child.path(PROVIDES_MANIFEST)))
+
+            # With no other phases, the parent's manifest is extended.
+            child_items = [MakeDirsItem(
+                from_target='t', into_dir='a', path_to_make='d/e',
+            )]
+            child_items[0].build(child)
+            write_provides_manifest(
+                child, phase_items=[parent_item], items=child_items,
+            )
+            with open(child.path(PROVIDES_MANIFEST), 'rb') as f:
+                self.assertEqual(
+                    b'd .\0d a\0d a/b\0d a/d\0d a/d/e\0l c\0', f.read(),
+                )
+
+            # After a phase besides PARENT_LAYER, we can either walk the
+            # subvolume, or patch the parent's manifest with a sendstream.
+            child.set_readonly(True)  # Like a real parent layer
+            grandchild = temp_subvolumes.caller_will_create('grandchild')
+            child_item = ParentLayerItem(
+                from_target='t', path=child.path().decode(),
+            )
+            child_item.get_phase_builder([child_item], DUMMY_LAYER_OPTS)(
+                grandchild
+            )
+            remove_item = RemovePathItem(
+                from_target='t', action=RemovePathAction.assert_exists,
+                path='a/d',
+            )
+            RemovePathItem.get_phase_builder([remove_item], DUMMY_LAYER_OPTS)(
+                grandchild
+            )
+            grandchild_manifest = b'd .\0d a\0d a/b\0l c\0'
+            # No-ops: no phases, no parent to diff with, or no manifest.
+            for phase_items in [
+                [child_item],
+                [root_item, remove_item],
+                [ParentLayerItem(
+                    from_target='t', path=grandchild.path().decode(),
+                ), remove_item],
+            ]:
+                update_provides_manifest_after_phases(
+                    grandchild, phase_items=phase_items,
+                )
+                self.assertFalse(
+                    os.path.exists(grandchild.path(PROVIDES_MANIFEST))
+                )
+            update_provides_manifest_after_phases(
+                grandchild, phase_items=[child_item, remove_item],
+            )
+            with open(grandchild.path(PROVIDES_MANIFEST), 'rb') as f:
+                self.assertEqual(grandchild_manifest, f.read())
+            with unittest.mock.patch(
+                'compiler.items._find_provides_manifest',
+            ) as find:
+                write_provides_manifest(
+                    grandchild, phase_items=[child_item, remove_item],
+                    items=[],
+                )
+            find.assert_not_called()
+            with open(grandchild.path(PROVIDES_MANIFEST), 'rb') as f:
+                self.assertEqual(grandchild_manifest, f.read())
+            # Without the post-phase manifest, we walk.
+            grandchild.run_as_root([
+                'rm', grandchild.path(PROVIDES_MANIFEST),
+            ])
+            write_provides_manifest(
+                grandchild, phase_items=[child_item, remove_item], items=[],
+            )
+            with open(grandchild.path(PROVIDES_MANIFEST), 'rb') as f:
+                self.assertEqual(grandchild_manifest, f.read())
+
+            # Items that were not built, or wrote through a relative
+            # symlink, do not provide what `find` would see.
+            symlinks = temp_subvolumes.create('symlinks')
+            symlinks.run_as_root(['mkdir', symlinks.path('a')])
+            symlinks.run_as_root(['ln', '-s', 'a', symlinks.path('r')])
+            MakeDirsItem(
+                from_target='t', into_dir='r', path_to_make='g',
+            ).build(symlinks)
+            for item in [
+                MakeDirsItem(from_target='t', into_dir='a', path_to_make='x'),
+                MakeDirsItem(from_target='t', into_dir='r', path_to_make='g'),
+            ]:
+                self.assertIsNone(_add_provided_paths(symlinks, {
+                    '.': 'd', 'a': 'd',
+                }, [item]))
+
     def test_stat_options(self):
         self._check_item(
             MakeDirsItem(
@@ -788,6 +1017,14 @@ class ItemsTestCase(unittest.TestCase):
             {require_directory('x')},
         )
 
+    def test_stat_options_methods_required(self):
+        with self.assertRaisesRegex(AssertionError, 'define `build_ops`'):
+            class NoBuildOpsItem(HasStatOptions, metaclass=ImageItem):
+                fields = []
+
+                def stat_options_paths(self):
+                    return []  # pragma: no cover
+
     def test_parent_layer_items(self):
         with mock_subvolume_from_json_file(self, path=None):
             self.assertEqual(
@@ -861,6 +1098,18 @@ class ItemsTestCase(unittest.TestCase):
                         action=RemovePathAction.if_exists,
                         path=prot_path,
                     )], DUMMY_LAYER_OPTS)(subvol)
+            # Nor do we remove a directory that contains a protected path.
+            with unittest.mock.patch(
+                'compiler.items._protected_path_set',
+                side_effect=lambda sv: _protected_path_set(sv) | {'f/g/'},
+            ), self.assertRaisesRegex(
+                subprocess.CalledProcessError, 'f overlaps a protected path',
+            ):
+                RemovePathItem.get_phase_builder([RemovePathItem(
+                    from_target='t',
+                    action=RemovePathAction.assert_exists,
+                    path='/f',
+                )], DUMMY_LAYER_OPTS)(subvol)
 
             # Check handling of non-existent paths without removing anything
             remove = RemovePathItem(
@@ -960,26 +1209,32 @@ class ItemsTestCase(unittest.TestCase):
                 ],
                 layer_opts,
             )(subvol)
-            # Clean up the `yum` & `rpm` litter before checking the packages.
-            # Maybe fixme: As a result, we end up not asserting ownership /
-            # permissions / etc on directories like /var and /dev.
-            subvol.run_as_root([
-                'rm', '-rf',
-                # Annotate all paths since `sudo rm -rf` is scary.
-                subvol.path('var/cache/yum'),
-                subvol.path('var/lib/rpm'),
-                subvol.path('var/lib/yum'),
-                subvol.path('var/log/yum.log'),
-            ])
-            subvol.run_as_root([
-                'rmdir',
-                subvol.path('dev'),  # made by yum_from_snapshot.py
-                subvol.path('meta'),
-                subvol.path('var/cache'),
-                subvol.path('var/lib'),
-                subvol.path('var/log'),
-                subvol.path('var'),
-            ])
+
+            def render_without_yum_litter(snapshot_name):
+                # Clean up the `yum` & `rpm` litter before checking the
+                # packages.  Maybe fixme: As a result, we end up not
+                # asserting ownership / permissions / etc on directories
+                # like /var and /dev.
+                snapshot = temp_subvolumes.snapshot(subvol, snapshot_name)
+                snapshot.run_as_root([
+                    'rm', '-rf',
+                    # Annotate all paths since `sudo rm -rf` is scary.
+                    snapshot.path('var/cache/yum'),
+                    snapshot.path('var/lib/rpm'),
+                    snapshot.path('var/lib/yum'),
+                    snapshot.path('var/log/yum.log'),
+                ])
+                snapshot.run_as_root([
+                    'rmdir',
+                    snapshot.path('dev'),  # made by yum_from_snapshot.py
+                    snapshot.path('meta'),
+                    snapshot.path('var/cache'),
+                    snapshot.path('var/lib'),
+                    snapshot.path('var/log'),
+                    snapshot.path('var'),
+                ])
+                return _render_subvol(snapshot)
+
             self.assertEqual(['(Dir)', {
                 'usr': ['(Dir)', {
                     'share': ['(Dir)', {
@@ -989,7 +1244,47 @@ class ItemsTestCase(unittest.TestCase):
                         }],
                     }],
                 }],
-            }], _render_subvol(subvol))
+            }], render_without_yum_litter('installed'))
+
+            # Merged RPM phases remove & install in one `yum shell`
+            RpmActionItem.get_phase_builder(
+                [
+                    RpmActionItem(
+                        from_target='t', name='rpm-test-carrot',
+                        action=RpmAction.remove_if_exists,
+                    ),
+                    RpmActionItem(
+                        from_target='t', name='rpm-test-mice',
+                        action=RpmAction.install,
+                    ),
+                ],
+                layer_opts,
+            )(subvol)
+            self.assertEqual(['(Dir)', {
+                'usr': ['(Dir)', {
+                    'share': ['(Dir)', {
+                        'rpm_test': ['(Dir)', {
+                            'mice.txt': ['(File d11)'],
+                        }],
+                    }],
+                }],
+            }], render_without_yum_litter('swapped'))
+
+            # The merged transaction fails if it does not install an RPM
+            with self.assertRaises(subprocess.CalledProcessError):
+                RpmActionItem.get_phase_builder(
+                    [
+                        RpmActionItem(
+                            from_target='t', name='rpm-test-carrot',
+                            action=RpmAction.remove_if_exists,
+                        ),
+                        RpmActionItem(
+                            from_target='m', name='rpm-test-mice-2',
+                            action=RpmAction.install,
+                        ),
+                    ],
+                    layer_opts,
+                )(subvol)
 
     def test_rpm_action_item_yum_from_snapshot(self):
         self._test_rpm_action_item(layer_opts=LayerOpts(
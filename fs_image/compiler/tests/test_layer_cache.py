@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+import unittest.mock
+
+import subvol_utils
+
+from subvol_utils import Subvol
+
+from .. import mount_item
+from ..layer_cache import _compiler_sources_hash, LayerCache
+
+
+def _run_as_root(self, args, **kwargs):
+    'Stands in for the `btrfs` commands that `LayerCache` uses.'
+    if args[:3] == ['btrfs', 'subvolume', 'snapshot']:
+        shutil.copytree(args[3], args[4], symlinks=True)
+    elif args[:3] == ['btrfs', 'subvolume', 'delete']:
+        shutil.rmtree(args[3])
+    elif args[0] == 'test':
+        assert not os.path.exists(args[-1]), args
+    else:
+        assert args[:3] == ['btrfs', 'property', 'set'], args
+
+
+class LayerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir_ctx = tempfile.TemporaryDirectory()
+        self.temp_dir = self.temp_dir_ctx.__enter__()
+        self.addCleanup(self.temp_dir_ctx.__exit__, None, None, None)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        for patcher in [
+            unittest.mock.patch.object(
+                subvol_utils, '_path_is_btrfs_subvol', return_value=True,
+            ),
+            unittest.mock.patch.object(
+                subvol_utils.Subvol, 'run_as_root', new=_run_as_root,
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _write(self, relpath, content):
+        path = os.path.join(self.temp_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content if type(content) is str else json.dumps(content))
+        return path
+
+    def _layer(self, name, content='hello'):
+        'Returns a `Subvol` for a "built" layer.'
+        self._write(os.path.join(name, 'file'), content)
+        return Subvol(os.path.join(self.temp_dir, name), already_exists=True)
+
+    def test_input_key(self):
+        cache = LayerCache(self.cache_dir)
+        target_to_path = {
+            '//f:1': self._write('f1.json', {'target': '//f:1', 'features': [
+                {'__BUCK_TARGET': '//f:3'},
+            ]}),
+            # Both `//f:1` & `//f:2` include `//f:3`
+            '//f:2': self._write('f2.json', {'target': '//f:2', 'features': [
+                {'__BUCK_TARGET': '//f:3'},
+            ]}),
+            '//f:3': self._write('f3.json', {
+                'target': '//f:3',
+                'tarballs': [{'tarball': {'__BUCK_TARGET': '//x:dir'}}],
+            }),
+            '//x:file': self._write('x/file', 'file content'),
+            '//x:dir': os.path.dirname(self._write('x/dir/sub/f', 'abc')),
+        }
+        os.symlink('f', os.path.join(self.temp_dir, 'x/dir/sub/link'))
+        yum = self._write('yum', 'yum v1')
+        child_feature_json = self._write('child.json', {
+            'target': '//c:c',
+            'features': [
+                {'__BUCK_TARGET': '//f:1'}, {'__BUCK_TARGET': '//f:2'},
+            ],
+            'copy_files': [{
+                'source': {'__BUCK_TARGET': '//x:file'}, 'dest': '/f',
+            }],
+        })
+        parent_json = self._write('parent.json', {'btrfs_uuid': 'PARENT'})
+
+        def key(**kwargs):
+            return cache.input_key(**{
+                'layer_target': '//c:c',
+                'parent_layer_json': parent_json,
+                'build_appliance_json': None,
+                'yum_from_repo_snapshot': yum,
+                'child_feature_json': child_feature_json,
+                'target_to_path': target_to_path,
+                'options': {'single_rpm_transaction': False},
+                **kwargs,
+            })
+
+        orig_key = key()
+        self.assertEqual(orig_key, key())
+        keys = {orig_key}
+
+        def assert_new_key(**kwargs):
+            new_key = key(**kwargs)
+            self.assertNotIn(new_key, keys)
+            keys.add(new_key)
+
+        assert_new_key(layer_target='//c:d')
+        assert_new_key(parent_layer_json=None)
+        assert_new_key(build_appliance_json=parent_json)
+        assert_new_key(yum_from_repo_snapshot=None)
+        # Options that change how the same inputs are built
+        assert_new_key(options={'single_rpm_transaction': True})
+        assert_new_key(options={
+            'single_rpm_transaction': False, 'tarball_extractor': 'tar',
+        })
+        self._write('yum', 'yum v2')
+        assert_new_key()
+        # A file that a feature refers to
+        self._write('x/file', 'new content')
+        assert_new_key()
+        # Content, modes & symlinks in the directory of a nested feature
+        self._write('x/dir/sub/f', 'def')
+        assert_new_key()
+        os.chmod(os.path.join(self.temp_dir, 'x/dir/sub/f'), 0o755)
+        assert_new_key()
+        os.unlink(os.path.join(self.temp_dir, 'x/dir/sub/link'))
+        os.symlink('g', os.path.join(self.temp_dir, 'x/dir/sub/link'))
+        assert_new_key()
+        os.mkfifo(os.path.join(self.temp_dir, 'x/dir/sub/fifo'))
+        assert_new_key()
+        # Changes to the compiler
+        with unittest.mock.patch.dict(sys.modules, {
+            'compiler.fake_module': types.SimpleNamespace(
+                __file__=os.path.join(
+                    os.path.dirname(os.path.dirname(__file__)), 'fake.py',
+                ),
+                __loader__=unittest.mock.Mock(**{
+                    'get_source.return_value': 'pass',
+                }),
+            ),
+        }):
+            assert_new_key()
+
+        with self.assertRaisesRegex(RuntimeError, '//f:3 not in '):
+            key(target_to_path={
+                k: v for k, v in target_to_path.items() if k != '//f:3'
+            })
+
+    def test_compiler_sources_hash(self):
+        self.assertEqual(_compiler_sources_hash(), _compiler_sources_hash())
+        with unittest.mock.patch.dict(sys.modules, {
+            # Modules from outside of `fs_image` are not hashed.
+            'unrelated': types.SimpleNamespace(__file__='/unrelated.py'),
+        }):
+            self.assertEqual(
+                _compiler_sources_hash(), _compiler_sources_hash(),
+            )
+
+        def bytecode_module_hash(bytecode):
+            with unittest.mock.patch.dict(sys.modules, {
+                'compiler.fake_module': types.SimpleNamespace(
+                    __file__=os.path.join(
+                        os.path.dirname(os.path.dirname(__file__)),
+                        'fake.pyc',
+                    ),
+                    __loader__=unittest.mock.Mock(**{
+                        'get_source.return_value': None,
+                        'get_data.return_value': bytecode,
+                    }),
+                ),
+            }):
+                return _compiler_sources_hash()
+
+        # Without sources, we hash the bytecode.
+        self.assertEqual(
+            bytecode_module_hash(b'a'), bytecode_module_hash(b'a'),
+        )
+        self.assertNotEqual(
+            bytecode_module_hash(b'a'), bytecode_module_hash(b'b'),
+        )
+
+    def test_parent_uuid(self):
+        cache = LayerCache(self.cache_dir)
+        parent_json = self._write('parent.json', {'btrfs_uuid': 'PARENT'})
+        feature_json = self._write('feature.json', {'target': '//c:c'})
+
+        def key():
+            return cache.input_key(
+                layer_target='//c:c', parent_layer_json=parent_json,
+                build_appliance_json=None, yum_from_repo_snapshot=None,
+                child_feature_json=feature_json, target_to_path={},
+                options={},
+            )
+
+        uuid_key = key()
+        cache.remember_uuid('PARENT', 'PARENT_KEY')
+        parent_key = key()
+        self.assertNotEqual(uuid_key, parent_key)
+        # A rebuilt parent with the same inputs has the same children.
+        self._write('parent.json', {'btrfs_uuid': 'PARENT2'})
+        self.assertNotIn(key(), [uuid_key, parent_key])
+        cache.remember_uuid('PARENT2', 'PARENT_KEY')
+        self.assertEqual(parent_key, key())
+
+    def test_store_and_snapshot(self):
+        cache = LayerCache(self.cache_dir)
+        dest = Subvol(os.path.join(self.temp_dir, 'dest'))
+        self.assertFalse(cache.snapshot_cached('k', dest))
+
+        cache.store('k', self._layer('built'))
+        self.assertTrue(cache.snapshot_cached('k', dest))
+        with open(dest.path('file')) as f:
+            self.assertEqual('hello', f.read())
+        self.assertFalse(cache.snapshot_cached('other', Subvol(
+            os.path.join(self.temp_dir, 'other'),
+        )))
+
+        # A concurrent build stored the same key first, so ours is dropped.
+        cache.store('k', self._layer('built2', 'other'))
+        self.assertEqual(['k'], os.listdir(self.cache_dir))
+        dest2 = Subvol(os.path.join(self.temp_dir, 'dest2'))
+        self.assertTrue(cache.snapshot_cached('k', dest2))
+        with open(dest2.path('file')) as f:
+            self.assertEqual('hello', f.read())
+
+    def test_do_not_store_mounts(self):
+        cache = LayerCache(self.cache_dir)
+        layer = self._layer('built')
+        self._write(os.path.join(
+            'built', mount_item.META_MOUNTS_DIR, 'mnt',
+            mount_item.MOUNT_MARKER, 'is_directory',
+        ), 'true')
+        cache.store('k', layer)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_snapshot_after_collect_garbage(self):
+        cache = LayerCache(self.cache_dir)
+        cache.store('k', self._layer('built'))
+        orig_flock = fcntl.flock
+
+        # Garbage-collect the entry right before we lock it.
+        def flock(fd, op):
+            if op == fcntl.LOCK_SH:
+                cache.collect_garbage(-1)
+            return orig_flock(fd, op)
+
+        with unittest.mock.patch('fcntl.flock', side_effect=flock):
+            self.assertFalse(cache.snapshot_cached(
+                'k', Subvol(os.path.join(self.temp_dir, 'dest')),
+            ))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'dest')))
+
+    def test_collect_garbage(self):
+        cache = LayerCache(self.cache_dir)
+        self.assertEqual([], cache.collect_garbage(0))
+
+        for key in ['old', 'new', 'in_use']:
+            cache.store(key, self._layer(key))
+        cache.remember_uuid('OLD', 'old')
+        cache.remember_uuid('NEW', 'new')
+        for path in ['old', 'uuids/OLD']:
+            os.utime(os.path.join(self.cache_dir, path), (0, 0))
+        # Left behind by compilers that crashed during `store`
+        os.makedirs(os.path.join(self.cache_dir, '.tmpcrashed/layer'))
+        os.mkdir(os.path.join(self.cache_dir, '.tmpearly'))
+        for name in ['.tmpcrashed', '.tmpearly']:
+            os.utime(os.path.join(self.cache_dir, name), (0, 0))
+
+        in_use_fd = os.open(
+            os.path.join(self.cache_dir, 'in_use'),
+            os.O_RDONLY | os.O_DIRECTORY,
+        )
+        try:
+            fcntl.flock(in_use_fd, fcntl.LOCK_SH)
+            os.utime(in_use_fd, (0, 0))
+            self.assertEqual(['old'], cache.collect_garbage(3600))
+            self.assertEqual(
+                {'new', 'in_use', 'uuids'}, set(os.listdir(self.cache_dir)),
+            )
+            self.assertEqual(['NEW'], os.listdir(
+                os.path.join(self.cache_dir, 'uuids'),
+            ))
+            self.assertEqual(['new'], cache.collect_garbage(-1))
+        finally:
+            os.close(in_use_fd)
+        self.assertEqual(['in_use'], cache.collect_garbage(-1))
+        self.assertEqual(['uuids'], os.listdir(self.cache_dir))
+        self.assertEqual([], os.listdir(os.path.join(self.cache_dir, 'uuids')))
+
+
+if __name__ == '__main__':
+    unittest.main()
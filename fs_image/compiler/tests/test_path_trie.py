@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import unittest
+
+from ..path_trie import PathTrie
+
+
+class PathTrieTestCase(unittest.TestCase):
+
+    def test_mapping(self):
+        t = PathTrie([('/a/b', 1), ('/a', 2)])
+        self.assertEqual(2, len(t))
+        self.assertEqual(1, t['/a/b'])
+        self.assertEqual(1, t['a/./b/'])  # Same key, different spelling
+        self.assertNotIn('/a/b/c', t)
+        self.assertNotIn('/', t)
+        self.assertNotIn('/x', t)
+        self.assertEqual(None, t.get('/a/c'))
+
+        t['/a'] = 3  # Overwrite does not change the length
+        self.assertEqual(2, len(t))
+        self.assertEqual({'/a': 3, '/a/b': 1}, t)
+        self.assertEqual("PathTrie([('/a', 3), ('/a/b', 1)])", repr(t))
+
+        self.assertEqual(1, t.setdefault('/a/b', 5))
+        self.assertEqual(6, t.setdefault('/a/b/c', 6))
+        self.assertEqual(3, len(t))
+
+        del t['/a/b']
+        self.assertEqual({'/a': 3, '/a/b/c': 6}, t)
+        with self.assertRaises(KeyError):
+            del t['/a/b']
+        with self.assertRaises(KeyError):
+            t['/a/b']
+
+    def test_iteration_order(self):
+        paths = ['/b', '/a/z', '/', '/a', '/a/c/d']
+        self.assertEqual(
+            ['/', '/a', '/a/c/d', '/a/z', '/b'],
+            list(PathTrie((p, None) for p in paths)),
+        )
+        self.assertEqual([], list(PathTrie()))
+
+    def test_has_prefix_of(self):
+        t = PathTrie([('meta/', None), ('a/file', None)])
+        for path in ['meta', 'meta/x/y', 'a/file', 'a/file/oops', './meta']:
+            self.assertTrue(t.has_prefix_of(path), path)
+        for path in ['.', '', 'a', 'metax', 'a/fil', 'a/files', 'b/meta']:
+            self.assertFalse(t.has_prefix_of(path), path)
+        self.assertTrue(PathTrie([('/', None)]).has_prefix_of('/any/path'))
+        self.assertFalse(PathTrie().has_prefix_of('/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@
 import os
 import subprocess
 import unittest
+import unittest.mock
 
 from btrfs_diff.tests.render_subvols import render_sendstream
+from root_helper import WriteTree
 from tests.temp_subvolumes import with_temp_subvols
 
 from ..procfs_serde import serialize, deserialize
@@ -120,6 +122,23 @@ class TestProcfsSerDe(unittest.TestCase):
             'foobar',
         )
 
+    def test_serialize_in_one_op(self):
+        subvol = unittest.mock.Mock()
+        serialize(
+            {'a': {'b.bin': b'x', 'n': None}, 'c': 1}, subvol, 'meta/d',
+        )
+        subvol.run_root_helper_ops.assert_called_once_with([
+            WriteTree(path='meta/d', entries=[
+                ('', None),
+                ('a', None),
+                ('a/b.bin', 'eA=='),  # No trailing newline for `.bin`
+                ('c', 'MQo='),  # '1\n'
+            ]),
+        ])
+        subvol.reset_mock()
+        serialize(None, subvol, 'meta/e')
+        subvol.run_root_helper_ops.assert_not_called()
+
     # Not bothering to test deserialization of valid values, since the
     # `serialize(deserialize(x)) == x` test of `test_serialize` cover it.
     @with_temp_subvols
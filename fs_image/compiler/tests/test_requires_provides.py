@@ -16,6 +16,16 @@ class RequiresProvidesTestCase(unittest.TestCase):
         self.assertEqual('/b/d', ProvidesDirectory(path='/b/c//../d').path)
         self.assertEqual('/x/y', ProvidesFile(path='///x/./y/').path)
 
+    def test_new_trusted(self):
+        for cls in [ProvidesDirectory, ProvidesFile]:
+            trusted = cls._new_trusted('/x/y')
+            self.assertEqual(cls(path='x/y'), trusted)
+            self.assertEqual(hash(cls(path='x/y')), hash(trusted))
+            self.assertEqual(f"{cls.__name__}(path='/x/y')", repr(trusted))
+        self.assertNotEqual(
+            ProvidesFile(path='x'), ProvidesDirectory._new_trusted('/x'),
+        )
+
     def test_provides_requires(self):
         pf1 = ProvidesFile(path='f')
         pf2 = ProvidesFile(path='f/b')
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import io
+import unittest
+
+from btrfs_diff.parse_send_stream import parse_send_stream
+from btrfs_diff.send_stream import SendStreamItems
+from btrfs_diff.tests.demo_sendstreams import gold_demo_sendstreams
+
+from ..sendstream_manifest import apply_sendstream_to_manifest
+
+_CREATE_OPS_MANIFEST = [
+    ('d', '.'),
+    ('f', '56KB_nuls'),
+    ('f', '56KB_nuls_clone'),
+    ('b', 'buffered'),
+    ('l', 'bye_symlink'),
+    ('d', 'dir_to_remove'),
+    ('p', 'fifo'),
+    ('f', 'goodbye'),
+    ('d', 'hello'),
+    ('f', 'hello/world'),
+    ('c', 'unbuffered'),
+    ('s', 'unix_sock'),
+    ('f', 'zeros_hole_zeros'),
+]
+
+
+def _not_protected(path):
+    return False
+
+
+class SendstreamManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+
+    def _items(self, name):
+        return parse_send_stream(
+            io.BytesIO(gold_demo_sendstreams()[name]['sendstream'])
+        )
+
+    def test_create_and_mutate(self):
+        # A full sendstream applies to a manifest with just a root.
+        self.assertEqual(_CREATE_OPS_MANIFEST, apply_sendstream_to_manifest(
+            [('d', '.')], self._items('create_ops'), _not_protected,
+        ))
+        self.assertEqual([
+            ('d', '.'),
+            ('f', '56KB_nuls'),
+            ('f', '56KB_nuls_clone'),
+            ('b', 'buffered'),
+            ('l', 'bye_symlink'),
+            ('f', 'farewell'),
+            ('p', 'fifo'),
+            ('d', 'hello_renamed'),
+            ('f', 'hello_renamed/een'),
+            ('c', 'unbuffered'),
+            ('s', 'unix_sock'),
+            ('f', 'zeros_hole_zeros'),
+        ], apply_sendstream_to_manifest(
+            _CREATE_OPS_MANIFEST, self._items('mutate_ops'), _not_protected,
+        ))
+
+    def test_protected(self):
+        self.assertEqual(
+            [e for e in _CREATE_OPS_MANIFEST if not e[1].startswith('hello')],
+            apply_sendstream_to_manifest(
+                [('d', '.')],
+                self._items('create_ops'),
+                lambda p: p == 'hello' or p.startswith('hello/'),
+            ),
+        )
+        self.assertEqual([('d', '.')], apply_sendstream_to_manifest([
+            ('d', '.'),
+        ], [
+            SendStreamItems.mkdir(path=b'o257-1-0'),
+            SendStreamItems.rename(path=b'o257-1-0', dest=b'meta'),
+            SendStreamItems.link(path=b'meta/x', dest=b'y'),
+            SendStreamItems.unlink(path=b'meta/x'),
+            SendStreamItems.rename(path=b'meta', dest=b'meta2'),
+        ], lambda p: p.startswith('meta')))
+        with self.assertRaisesRegex(RuntimeError, 'moves a protected path'):
+            apply_sendstream_to_manifest([('d', '.')], [
+                SendStreamItems.rename(path=b'meta', dest=b'x'),
+            ], lambda p: p == 'meta')
+
+    def test_rename_overwrites(self):
+        self.assertEqual([('d', '.'), ('d', 'b'), ('f', 'b/x')],
+            apply_sendstream_to_manifest([
+                ('d', '.'), ('d', 'a'), ('f', 'a/x'), ('d', 'b'),
+            ], [
+                SendStreamItems.rename(path=b'a', dest=b'b'),
+            ], _not_protected),
+        )
+
+    def test_errors(self):
+        for entries, items, error in [
+            ([], [], 'lacks a root directory'),
+            ([('f', '.')], [], 'lacks a root directory'),
+            ([('d', '.'), ('f', 'a')], [
+                SendStreamItems.mkfile(path=b'a/b'),
+            ], 'a/b is not in a directory of the manifest'),
+            ([('d', '.')], [
+                SendStreamItems.mkfile(path=b'x/y/z'),
+            ], 'x/y/z is not in a directory of the manifest'),
+            ([('d', '.'), ('f', 'a')], [
+                SendStreamItems.mkdir(path=b'a'),
+            ], 'a is already in the manifest'),
+            ([('d', '.')], [
+                SendStreamItems.rmdir(path=b'a'),
+            ], 'a is not in the manifest'),
+            ([('d', '.')], [
+                SendStreamItems.link(path=b'a', dest=b'b'),
+            ], 'b is not in the manifest'),
+            ([('d', '.')], [
+                SendStreamItems.mknod(path=b'a', mode=0o10644, dev=0),
+            ], 'mknod with unexpected mode 10644'),
+        ]:
+            with self.assertRaisesRegex(RuntimeError, error):
+                apply_sendstream_to_manifest(entries, items, _not_protected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from ..tarball_cache import (
+    get_tarball_cache, hash_file, TarballCache, use_tarball_cache_dir,
+)
+
+
+class TarballCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir_ctx = tempfile.TemporaryDirectory()
+        self.temp_dir = self.temp_dir_ctx.__enter__()
+        self.addCleanup(self.temp_dir_ctx.__exit__, None, None, None)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.tarball = os.path.join(self.temp_dir, 'a.tar')
+        with open(self.tarball, 'wb') as f:
+            f.write(b'kitteh' * 12345)
+
+    def _touch(self, content: bytes):
+        st = os.stat(self.tarball)
+        with open(self.tarball, 'wb') as f:
+            f.write(content)
+        # Force a new mtime, even if the clock is coarse.
+        os.utime(self.tarball, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    def test_hash_file(self):
+        self.assertEqual(
+            hashlib.sha256(b'kitteh' * 12345).hexdigest(),
+            hash_file(self.tarball, 'sha256'),
+        )
+        empty = os.path.join(self.temp_dir, 'empty')
+        with open(empty, 'wb'):
+            pass
+        self.assertEqual(hashlib.md5().hexdigest(), hash_file(empty, 'md5'))
+
+    def test_hexdigest(self):
+        expected = hash_file(self.tarball, 'sha256')
+        cache = TarballCache(self.cache_dir)
+        with unittest.mock.patch(
+            'compiler.tarball_cache.hash_file', side_effect=hash_file,
+        ) as mock_hash:
+            self.assertEqual(expected, cache.hexdigest(self.tarball, 'sha256'))
+            self.assertEqual(expected, cache.hexdigest(self.tarball, 'sha256'))
+            self.assertEqual(1, mock_hash.call_count)
+
+            # A new cache, e.g. in the next compiler run, reads it from disk
+            self.assertEqual(expected, TarballCache(
+                self.cache_dir,
+            ).hexdigest(self.tarball, 'sha256'))
+            self.assertEqual(1, mock_hash.call_count)
+
+            # Other algorithms are cached separately
+            cache.hexdigest(self.tarball, 'sha1')
+            self.assertEqual(2, mock_hash.call_count)
+
+            # Changing the file invalidates the cache.
+            self._touch(b'new content')
+            self.assertEqual(
+                hashlib.sha256(b'new content').hexdigest(),
+                cache.hexdigest(self.tarball, 'sha256'),
+            )
+            self.assertEqual(3, mock_hash.call_count)
+
+    def test_in_memory(self):
+        cache = TarballCache()
+        list_members = unittest.mock.Mock(return_value=[('a', True)])
+        self.assertEqual(
+            [('a', True)], cache.members(self.tarball, list_members),
+        )
+        self.assertEqual(
+            [('a', True)], cache.members(self.tarball, list_members),
+        )
+        self.assertEqual(1, list_members.call_count)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_members_persisted(self):
+        members = [('d/', True), ('d/f', False)]
+        self.assertEqual(members, TarballCache(self.cache_dir).members(
+            self.tarball, lambda: members,
+        ))
+        list_members = unittest.mock.Mock()
+        self.assertEqual(members, TarballCache(self.cache_dir).members(
+            self.tarball, list_members,
+        ))
+        list_members.assert_not_called()
+
+    def test_changed_while_computing(self):
+        cache = TarballCache(self.cache_dir)
+        self.assertEqual([('x', False)], cache.members(
+            self.tarball,
+            lambda: self._touch(b'changed') or [('x', False)],
+        ))
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertEqual([], cache.members(self.tarball, lambda: []))
+
+    def test_filename_collision(self):
+        cache = TarballCache(self.cache_dir)
+        cache.members(self.tarball, lambda: [('a', False)])
+        cache_file, = os.listdir(self.cache_dir)
+        cache_path = os.path.join(self.cache_dir, cache_file)
+        with open(cache_path) as f:
+            entry = json.load(f)
+        entry['key'] = 'some other file'
+        with open(cache_path, 'w') as f:
+            json.dump(entry, f)
+        self.assertEqual([('b', True)], TarballCache(self.cache_dir).members(
+            self.tarball, lambda: [('b', True)],
+        ))
+
+    def test_hexdigest_and_members(self):
+        cache = TarballCache(self.cache_dir)
+        hash_and_list = unittest.mock.Mock(return_value=('abc', [('a', True)]))
+        for _ in range(2):
+            self.assertEqual(
+                ('abc', [('a', True)]),
+                cache.hexdigest_and_members(
+                    self.tarball, 'sha256', hash_and_list,
+                ),
+            )
+        self.assertEqual(1, hash_and_list.call_count)
+        # Both facts are now available separately.
+        self.assertEqual('abc', cache.hexdigest(self.tarball, 'sha256'))
+        self.assertEqual(
+            [('a', True)], TarballCache(self.cache_dir).members(
+                self.tarball, unittest.mock.Mock(),
+            ),
+        )
+        # If only one fact is cached, we compute both.
+        cache = TarballCache()
+        md5 = cache.hexdigest(self.tarball, 'md5')
+        hash_and_list = unittest.mock.Mock(return_value=(md5, [('b', False)]))
+        self.assertEqual(
+            (md5, [('b', False)]),
+            cache.hexdigest_and_members(self.tarball, 'md5', hash_and_list),
+        )
+        self.assertEqual(1, hash_and_list.call_count)
+
+    def test_hexdigest_of_open_file(self):
+        cache = TarballCache()
+        expected = hash_file(self.tarball, 'sha256')
+        with open(self.tarball, 'rb') as f:
+            self.assertEqual(expected, cache.hexdigest_of_open_file(
+                f, self.tarball, 'sha256',
+            ))
+        # It shares the cache entry with `hexdigest`
+        with unittest.mock.patch(
+            'compiler.tarball_cache.hash_file',
+        ) as mock_hash:
+            self.assertEqual(expected, cache.hexdigest(self.tarball, 'sha256'))
+            mock_hash.assert_not_called()
+        # Replacing the file does not affect the hash of the open one.
+        with open(self.tarball, 'rb') as f:
+            os.unlink(self.tarball)
+            with open(self.tarball, 'wb') as f2:
+                f2.write(b'other')
+            self.assertEqual(expected, cache.hexdigest_of_open_file(
+                f, self.tarball, 'sha256',
+            ))
+        self.assertEqual(
+            hashlib.sha256(b'other').hexdigest(),
+            cache.hexdigest(self.tarball, 'sha256'),
+        )
+
+    def test_use_tarball_cache_dir(self):
+        orig_cache = get_tarball_cache()
+        with use_tarball_cache_dir(self.cache_dir) as cache:
+            self.assertIs(cache, get_tarball_cache())
+            self.assertIsNot(orig_cache, cache)
+            get_tarball_cache().hexdigest(self.tarball, 'sha256')
+        self.assertIs(orig_cache, get_tarball_cache())
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from common import nullcontext
+
+from ..tracing import span, use_tracer
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def _events(self, tracer):
+        out = io.StringIO()
+        tracer.write(out)
+        trace = json.loads(out.getvalue())
+        self.assertEqual('ms', trace['displayTimeUnit'])
+        return trace['traceEvents']
+
+    def test_inactive(self):
+        self.assertIsInstance(span('x', cat='y'), nullcontext)
+
+    def test_spans(self):
+        with use_tracer() as tracer:
+            with span('outer', cat='test', arg=[1, 2], obj=self):
+                with span('inner', cat='test'), \
+                        tempfile.TemporaryFile() as tf:
+                    tf.write(b'x' * 12345)
+                    tf.flush()
+                    subprocess.run(['true'], check=True)
+                with span('sibling', cat='test'):
+                    pass
+            with self.assertRaisesRegex(RuntimeError, 'boom'):
+                with span('failed', cat='test'):
+                    raise RuntimeError('boom')
+            with self.assertRaisesRegex(AssertionError, 'already active'):
+                with use_tracer():
+                    pass  # pragma: no cover
+        self.assertIsInstance(span('x', cat='y'), nullcontext)
+
+        events = self._events(tracer)
+        metadata = [e for e in events if e['ph'] == 'M']
+        self.assertEqual([{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {'name': threading.current_thread().name},
+        }], metadata)
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(
+            ['outer', 'inner', 'sibling', 'failed'],
+            [e['name'] for e in spans],
+        )
+        outer, inner, _, _ = spans
+        self.assertEqual([1, 2], outer['args']['arg'])
+        self.assertEqual(repr(self), outer['args']['obj'])
+        # `outer` encloses `inner`
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertLessEqual(
+            inner['ts'] + inner['dur'], outer['ts'] + outer['dur'],
+        )
+        for e in spans:
+            self.assertEqual('test', e['cat'])
+            self.assertGreaterEqual(e['args']['cpu_sec'], 0)
+        self.assertGreaterEqual(inner['args']['bytes_written'], 12345)
+        self.assertGreaterEqual(
+            outer['args']['bytes_written'], inner['args']['bytes_written'],
+        )
+        if hasattr(sys, 'addaudithook'):
+            self.assertEqual(1, inner['args']['subprocesses'])
+            self.assertEqual(1, outer['args']['subprocesses'])
+
+    def test_threads(self):
+        with use_tracer() as tracer:
+            def work():
+                with span('work', cat='test'):
+                    pass
+
+            thread = threading.Thread(target=work, name='worker')
+            thread.start()
+            thread.join()
+        (metadata,), (work,) = (
+            [e for e in self._events(tracer) if e['ph'] == ph]
+                for ph in 'MX'
+        )
+        self.assertEqual('worker', metadata['args']['name'])
+        self.assertEqual(metadata['tid'], work['tid'])
+        self.assertNotEqual(threading.get_ident(), work['tid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
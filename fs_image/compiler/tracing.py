@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''
+Opt-in tracing of where `build_image` spends its time.  Inside
+`use_tracer`, each `span` records its wall time, the CPU time of its
+thread, the subprocesses that its thread started, and the bytes that its
+thread wrote.  Spans nest, so the figures of a span include those of the
+spans inside it.
+
+`Tracer.write` emits Chrome trace-event JSON, which `chrome://tracing` or
+https://ui.perfetto.dev can display as a timeline, with one row per
+thread.
+
+Caveats:
+  - Subprocesses are counted via `sys.addaudithook`, which is new in
+    Python 3.8, so older interpreters do not report them.
+  - Bytes written are those of `write`-like syscalls of our process,
+    including pipes.  The root helper and other subprocesses do most of the
+    writing to the image, and they are not included.
+
+Code that may be traced calls `span`, which is a no-op unless a tracer is
+active -- like `get_tarball_cache()`, this avoids passing the tracer to
+every item.
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator, Optional, TextIO
+
+from common import nullcontext
+
+_tracer = None
+_audit_hook_installed = False
+
+
+def _thread_cpu_sec() -> float:
+    return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+
+def _thread_bytes_written() -> Optional[int]:
+    try:
+        with open('/proc/thread-self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split(':', 1)[1])
+    except OSError:  # pragma: no cover
+        pass  # Not Linux, or older than 3.17
+    return None  # pragma: no cover
+
+
+def _audit_hook(event, _args):
+    tracer = _tracer
+    if event == 'subprocess.Popen' and tracer is not None:
+        tracer._thread_state.subprocesses += 1
+
+
+class _ThreadState(threading.local):
+    subprocesses = 0
+
+
+class Tracer:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._tid_to_name = {}
+        self._thread_state = _ThreadState()
+        self._start_time = time.perf_counter()
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._start_time) * 1e6
+
+    @contextmanager
+    def span(self, name: str, *, cat: str, **args) -> Iterator[None]:
+        '`args` are shown with the span, via `repr` if not JSON types.'
+        start_us = self._now_us()
+        start_cpu_sec = _thread_cpu_sec()
+        start_subprocesses = self._thread_state.subprocesses
+        start_bytes_written = _thread_bytes_written()
+        try:
+            yield
+        finally:
+            end_us = self._now_us()
+            args['cpu_sec'] = round(_thread_cpu_sec() - start_cpu_sec, 6)
+            if _audit_hook_installed:
+                args['subprocesses'] = (
+                    self._thread_state.subprocesses - start_subprocesses
+                )
+            end_bytes_written = _thread_bytes_written()
+            if end_bytes_written is not None:
+                args['bytes_written'] = end_bytes_written - start_bytes_written
+            thread = threading.current_thread()
+            with self._lock:
+                self._tid_to_name[thread.ident] = thread.name
+                self._events.append({
+                    'name': name,
+                    'cat': cat,
+                    'ph': 'X',  # A "complete" event, with a duration
+                    'ts': start_us,
+                    'dur': end_us - start_us,
+                    'pid': os.getpid(),
+                    'tid': thread.ident,
+                    'args': args,
+                })
+
+    def write(self, outfile: TextIO):
+        with self._lock:
+            thread_names = [
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',  # Metadata, which names the rows
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': name},
+                } for tid, name in sorted(self._tid_to_name.items())
+            ]
+            # Enclosing spans go first, though they finish last.
+            spans = sorted(self._events, key=lambda e: (e['ts'], -e['dur']))
+        json.dump({
+            'traceEvents': thread_names + spans,
+            'displayTimeUnit': 'ms',
+        }, outfile, default=repr)
+
+
+def span(name: str, *, cat: str, **args):
+    'Traces the enclosed code, if a tracer is active.'
+    tracer = _tracer
+    return nullcontext() if tracer is None else tracer.span(
+        name, cat=cat, **args,
+    )
+
+
+@contextmanager
+def use_tracer() -> Iterator[Tracer]:
+    'While active, `span` records into the yielded `Tracer`.'
+    global _tracer, _audit_hook_installed
+    assert _tracer is None, 'A tracer is already active'
+    # Audit hooks cannot be removed, so we install ours only once.
+    if not _audit_hook_installed and hasattr(sys, 'addaudithook'):
+        sys.addaudithook(_audit_hook)
+        _audit_hook_installed = True
+    _tracer = Tracer()
+    try:
+        yield _tracer
+    finally:
+        _tracer = None
@@ -0,0 +1,1033 @@
+#!/usr/bin/env python3
+'''
+Image items used to shell out via `sudo` for each filesystem primitive, so
+e.g. `CopyFileItem` cost four processes (`cp`, `test ! -L`, `chmod -R`,
+`chown -R`).  For layers with thousands of items, most of the build time
+went to starting `sudo`.
+
+Instead, `Subvol.root_helper()` starts this program once, as `root`, and
+sends it batches of operations (the `NamedTuple`s below) to apply to one
+subvolume.  Usage as a library:
+
+    with start_root_helper(subvol_path, popen) as helper:
+        helper.run([MakeDirs(path='a/b'), Chmod(path='a', mode='u+rx')])
+
+The process chain mimics `send_fds_and_run.py`: the unprivileged client
+listens on a temporary Unix socket, and `popen` runs this file -- as the
+`root-helper` binary -- under `sudo` with `--unix-sock`.  Each message is
+a 4-byte big-endian length, followed by that much UTF-8 JSON.  A request
+is a list of `[op_name, op_fields]`, and the response is `{"results":
+[...], "error": null or "message"}`.  The helper stops at the first
+failing op of a batch, and exits when the client closes the socket.
+
+## Confinement
+
+All paths are relative to the subvolume root, which the helper re-opens
+for every batch -- so the helper can be started before the subvolume
+exists, and it survives the subvolume being snapshotted into place.  Paths
+are resolved one component at a time with `openat(O_NOFOLLOW)`.  Relative
+symlinks in directory components are followed by hand, as `Subvol.path`
+allows, but neither a symlink nor a `..` can take an operation outside of
+the subvolume.  The leaf itself is never followed: `chmod` refuses
+symlinks, while `chown` and `lstat` act on the symlink.  Future: once
+Python exposes `openat2`, `RESOLVE_BENEATH` would do this in the kernel.
+
+Only `CopyFile.source` and `ExtractTarball.source` are host paths, since
+they name build artifacts.
+'''
+import argparse
+import base64
+import collections
+import errno
+import fcntl
+import functools
+import grp
+import hashlib
+import json
+import os
+import pwd
+import re
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import (
+    Any, AnyStr, Callable, Iterator, List, NamedTuple, Optional,
+    Sequence, Tuple, Union,
+)
+
+from common import (
+    check_popen_returncode, decompress_command, FD_UNIX_SOCK_TIMEOUT,
+    get_file_logger, init_logging, listen_temporary_unix_socket,
+)
+
+log = get_file_logger(__file__)
+
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+_COPY_CHUNK_SIZE = 2 ** 20
+_FICLONE = 0x40049409  # From `linux/fs.h`
+# Errors meaning "this filesystem pair cannot clone / copy in-kernel".
+_NO_CLONE_ERRNOS = {
+    errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV,
+}
+_MAX_SYMLINKS = 40  # Like the kernel's MAXSYMLINKS
+_BTRFS_SUBVOL_ROOT_INO = 256  # `BTRFS_FIRST_FREE_OBJECTID`
+# `_IOW(BTRFS_IOCTL_MAGIC, 15, struct btrfs_ioctl_vol_args)` from
+# `linux/btrfs.h`.  The argument is an `fd` (unused) and a 4088-byte name.
+_BTRFS_IOC_SNAP_DESTROY = 0x5000940f
+_BTRFS_VOL_ARGS_FORMAT = '=q4088s'
+_PROTECTED = object()  # Marks the protected nodes of `_protected_trie`
+_ACCEPT_POLL_SEC = 0.1
+
+
+class CopyFile(NamedTuple):
+    'Like `cp --reflink=auto source dest`: `dest` is created, or overwritten.'
+    source: str  # A host path
+    dest: str
+
+
+class MakeDirs(NamedTuple):
+    '''
+    Like `mkdir -p`.  Missing parents get the default mode, while `mode`
+    applies to `path` only, and only if this creates it.
+    '''
+    path: str
+    mode: Optional[int] = None
+
+
+class Chmod(NamedTuple):
+    'Like `chmod`, but fails on a symlink.  See `apply_mode` for `mode`.'
+    path: str
+    mode: Union[int, str]
+    # As with `chmod -R`, symlinks inside `path` are skipped.
+    recursive: bool = False
+
+
+class Chown(NamedTuple):
+    'Like `chown --no-dereference`.  Names may also be numeric IDs.'
+    path: str
+    user: str
+    group: str
+    recursive: bool = False
+
+
+class Symlink(NamedTuple):
+    'Like `ln --symbolic --no-dereference source dest`.'
+    source: str
+    dest: str
+
+
+class Lstat(NamedTuple):
+    '''
+    The result is `None` if `path` does not exist, or else a dict with the
+    `mode`, `uid`, `gid`, and `size` of `path`, without following it.
+    '''
+    path: str
+
+
+class WriteTree(NamedTuple):
+    '''
+    Makes the missing parents of `path` with mode 0755, and then each of
+    `entries` in order, failing if it exists.  An entry is a `[relpath,
+    content]` pair, where `relpath` is relative to `path`, or '' for `path`
+    itself.  A `null` content makes a 0755 directory, and otherwise we
+    write a 0644 file with the base64-decoded `content`.
+    '''
+    path: str
+    entries: List[Tuple[str, Optional[str]]]
+
+
+class StatOptions(NamedTuple):
+    'One entry of `SetStatOptions`, with `mode` as for `Chmod`.'
+    path: str
+    mode: Union[int, str]
+    user: str
+    group: str
+
+
+class SetStatOptions(NamedTuple):
+    '''
+    Sets the owner, and then the mode, of exactly the paths in `entries`,
+    without recursion.  User & group names are resolved once per op, using
+    the `/etc/passwd` and `/etc/group` of the subvolume.  If the subvolume
+    lacks one of these files, we use the host's, like `Chown`.
+    '''
+    entries: List[StatOptions]
+
+
+class RemovePaths(NamedTuple):
+    '''
+    Removes each of `paths` in order, and recursively, like `rm -r
+    --one-file-system`, without following symlinks.  A directory on
+    another device is only removed if it is a btrfs subvolume, which we
+    delete via `BTRFS_IOC_SNAP_DESTROY` instead of walking it.
+
+    Fails without removing anything if a path is one of `protected_paths`
+    (which take a trailing / for directories, as in `Lstat` et al), is
+    inside one, or contains one.  Nor does the removal walk touch an inode
+    of an existing protected path, in case a symlink in a parent directory
+    of one of `paths` made it an alias of a protected directory.
+
+    An entry of `paths` is a `[path, must_exist]` pair.  The result lists
+    the indexes of the paths that did not exist.  The op stops right after
+    a missing path that `must_exist`, so this can only be the last index.
+    '''
+    paths: List[Tuple[str, bool]]
+    protected_paths: List[str]
+
+
+class ExtractTarball(NamedTuple):
+    '''
+    Like `tar -C into_dir -x --keep-old-files -f source` as `root`, plus
+    `--no-same-owner` if `force_root_ownership`: directories that already
+    exist are left untouched, and any other existing path is an error.
+    Otherwise, owners are looked up by name on the host, falling back to
+    the IDs in the archive, and modes are restored exactly.  Each member
+    gets its mtime as both its atime & mtime.
+
+    Unlike `tar`, this never writes through a symlink that is already in
+    the image.  Members are created with `O_NOFOLLOW`.  Their parent
+    directories are resolved like the paths of all other ops, but with
+    `into_dir` as the root: relative symlinks in the parents are followed
+    only while they stay inside `into_dir`, never out of it, and absolute
+    symlinks are refused.
+
+    `source` is a host path.  A `.zst` or gzip `source` is decompressed by
+    `decompress_command` in a subprocess, other formats by `tarfile`.
+    Before writing anything, we hash all of `source`, and fail if that does
+    not match `hash`, an `algorithm:hexdigest` pair.  We then extract the
+    same open file, so a tarball that changed after the compiler validated
+    it cannot make a layer.
+    '''
+    source: str
+    into_dir: str
+    hash: str
+    force_root_ownership: bool
+
+
+_OP_TYPES = {t.__name__: t for t in [
+    CopyFile, MakeDirs, Chmod, Chown, Symlink, Lstat, SetStatOptions,
+    WriteTree, RemovePaths, ExtractTarball,
+]}
+
+# `chmod` clauses look like `ug+rw-x`, see `apply_mode`.
+_MODE_CLAUSE_RE = re.compile(r'([ugoa]*)((?:[-+=][rwxXst]*)+)')
+_MODE_ACTION_RE = re.compile(r'([-+=])([rwxXst]*)')
+_WHO_TO_BITS = {
+    'u': stat.S_IRWXU | stat.S_ISUID,
+    'g': stat.S_IRWXG | stat.S_ISGID,
+    'o': stat.S_IRWXO | stat.S_ISVTX,
+    'a': 0o7777,
+}
+_PERM_TO_BITS = {
+    'r': 0o444,
+    'w': 0o222,
+    'x': 0o111,
+    's': stat.S_ISUID | stat.S_ISGID,
+    't': stat.S_ISVTX,
+}
+
+
+def apply_mode(
+    mode: Union[int, str], old_mode: int, *, is_dir: bool, umask: int,
+) -> int:
+    '''
+    Returns the permission bits that GNU `chmod MODE` would set on a file
+    with `st_mode` of `old_mode`.  `mode` is an int, or a comma-separated
+    list of symbolic clauses like `a-rwxXst,u+rx`.  As in `chmod`, a clause
+    without `ugoa` leaves alone the bits set in `umask`, and numeric modes
+    cannot clear the set-ID bits of directories.
+    '''
+    if isinstance(mode, int):
+        if is_dir:
+            return mode | (old_mode & (stat.S_ISUID | stat.S_ISGID))
+        return mode
+    new_mode = stat.S_IMODE(old_mode)
+    for clause in mode.split(','):
+        m = _MODE_CLAUSE_RE.fullmatch(clause)
+        if not m:
+            raise RuntimeError(f'Unsupported clause {clause} in mode {mode}')
+        who_bits = 0
+        for who in m.group(1):
+            who_bits |= _WHO_TO_BITS[who]
+        affected_bits = who_bits if who_bits else (0o7777 & ~umask)
+        for action, perms in _MODE_ACTION_RE.findall(m.group(2)):
+            bits = 0
+            for perm in perms:
+                if perm == 'X':
+                    # Execute only for directories, or if someone already
+                    # has it -- evaluated as of this clause, like `chmod`.
+                    if is_dir or new_mode & 0o111:
+                        bits |= 0o111
+                else:
+                    bits |= _PERM_TO_BITS[perm]
+            bits &= affected_bits
+            if action == '+':
+                new_mode |= bits
+            elif action == '-':
+                new_mode &= ~bits
+            else:
+                assert action == '='
+                new_mode = (new_mode & ~affected_bits) | bits
+    return new_mode
+
+
+def _resolve_id(name: str, getter: Callable[[str], Any]) -> int:
+    'Like `chown`, look up the name first, and fall back to a numeric ID.'
+    try:
+        return getter(name)
+    except KeyError:
+        if name.isdigit():
+            return int(name)
+        raise RuntimeError(f'Unknown user or group: {name}')
+
+
+def _split_path(path: AnyStr) -> List[bytes]:
+    'Normalizes lexically, like `Subvol.path`, and splits into components.'
+    norm = os.path.normpath(os.fsencode(path).lstrip(b'/') or b'.')
+    if norm == b'..' or norm.startswith(b'../'):
+        raise RuntimeError(f'{path} is outside the subvol')
+    return [p for p in norm.split(b'/') if p != b'.']
+
+
+def _open_dir(root_fd: int, parts: List[bytes]) -> int:
+    '''
+    Returns a new FD for the directory at `parts`.  As in `Subvol.path`,
+    relative symlinks are followed, but only as long as they stay inside
+    the subvolume.  Absolute symlinks would be interpreted relative to the
+    host root by the tools we replace, so we refuse them.
+    '''
+    fds = [os.dup(root_fd)]
+    try:
+        todo = collections.deque(parts)
+        num_links = 0
+        while todo:
+            part = todo.popleft()
+            if part in (b'', b'.'):
+                continue
+            if part == b'..':
+                if len(fds) == 1:
+                    raise RuntimeError(f'{b"/".join(parts)} exits the subvol')
+                os.close(fds.pop())
+                continue
+            try:
+                fds.append(os.open(part, _DIR_FLAGS, dir_fd=fds[-1]))
+                continue
+            except OSError as ex:
+                try:
+                    target = os.readlink(part, dir_fd=fds[-1])
+                except OSError:
+                    raise ex  # Not a symlink, so report the original error
+            if target.startswith(b'/'):
+                raise RuntimeError(
+                    f'{b"/".join(parts)} traverses absolute symlink {part}'
+                )
+            num_links += 1
+            if num_links > _MAX_SYMLINKS:
+                raise RuntimeError(f'Too many symlinks in {b"/".join(parts)}')
+            todo.extendleft(reversed(target.split(b'/')))
+        return fds.pop()
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+@contextmanager
+def _open_parent(root_fd: int, path: AnyStr) -> Iterator[Tuple[int, bytes]]:
+    '''
+    Yields an FD for the parent directory of `path`, and the name of `path`
+    in that directory.  For the subvolume root, the name is `.`.  The name
+    is never followed, since the ops' `*at` calls all use `O_NOFOLLOW`.
+    '''
+    parts = _split_path(path)
+    fd = _open_dir(root_fd, parts[:-1])
+    try:
+        yield fd, parts[-1] if parts else b'.'
+    finally:
+        os.close(fd)
+
+
+def _walk_beneath(
+    dir_fd: int, fn: Callable[[int, bytes, os.stat_result], None],
+) -> None:
+    'Calls `fn(parent_fd, name, lstat)` for everything under `dir_fd`.'
+    for name in os.listdir(dir_fd):
+        st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode):
+            # Open before `fn`, in case it removes our access.
+            sub_fd = os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+            try:
+                fn(dir_fd, name, st)
+                _walk_beneath(sub_fd, fn)
+            finally:
+                os.close(sub_fd)
+        else:
+            fn(dir_fd, name, st)
+
+
+def _copy_file(root_fd: int, op: CopyFile, *, umask: int) -> None:
+    src_fd = os.open(op.source, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        src_mode = stat.S_IMODE(os.fstat(src_fd).st_mode)
+        with _open_parent(root_fd, op.dest) as (parent_fd, name):
+            dst_fd = os.open(
+                name,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW |
+                    os.O_CLOEXEC,
+                src_mode & ~umask,  # Like `cp`
+                dir_fd=parent_fd,
+            )
+        try:
+            _copy_data(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _copy_data(src_fd: int, dst_fd: int) -> None:
+    '''
+    Build artifacts in `buck-out` usually live on the same btrfs volume as
+    the image, so we first try to share the source's extents via `FICLONE`
+    -- a metadata-only operation, regardless of the file size.  Failing
+    that, `copy_file_range` still copies in the kernel, and may clone or
+    offload on some filesystems.  A `read` & `write` loop is the fallback
+    for everything else, e.g. across filesystems on older kernels.
+    '''
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return
+    except OSError as ex:
+        if ex.errno not in _NO_CLONE_ERRNOS:
+            raise
+    copied = 0
+    try:
+        # `os.copy_file_range` is new in Python 3.8
+        while hasattr(os, 'copy_file_range'):
+            n = os.copy_file_range(src_fd, dst_fd, _COPY_CHUNK_SIZE)
+            if not n:
+                return
+            copied += n
+    except OSError as ex:
+        # Only fall back if nothing was copied, or we could corrupt `dst`.
+        if copied or ex.errno not in _NO_CLONE_ERRNOS:
+            raise
+    while True:
+        chunk = os.read(src_fd, _COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
+
+
+def _make_dirs(root_fd: int, op: MakeDirs, *, umask: int) -> None:
+    parts = _split_path(op.path)
+    for idx in range(len(parts)):
+        with _open_parent(root_fd, b'/'.join(parts[:idx + 1])) as (
+            parent_fd, name,
+        ):
+            try:
+                os.mkdir(name, 0o777 & ~umask, dir_fd=parent_fd)
+            except FileExistsError:
+                continue  # If it is not a directory, we fail below.
+            if op.mode is not None and idx == len(parts) - 1:
+                os.chmod(name, op.mode, dir_fd=parent_fd)
+    os.close(_open_dir(root_fd, parts))  # Like `mkdir -p`, require a dir.
+
+
+def _chmod(root_fd: int, op: Chmod, *, umask: int) -> None:
+
+    def chmod(parent_fd, name, st):
+        if stat.S_ISLNK(st.st_mode):
+            return  # Like `chmod -R`, skip symlinks in the tree.
+        os.chmod(name, apply_mode(
+            op.mode, st.st_mode, is_dir=stat.S_ISDIR(st.st_mode), umask=umask,
+        ), dir_fd=parent_fd)
+
+    with _open_parent(root_fd, op.path) as (parent_fd, name):
+        st = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+        # `chmod` has no --no-dereference, so we used to `test ! -L`.
+        if stat.S_ISLNK(st.st_mode):
+            raise RuntimeError(f'Cannot chmod {op.path}, it is a symlink')
+        if op.recursive and stat.S_ISDIR(st.st_mode):
+            dir_fd = os.open(name, _DIR_FLAGS, dir_fd=parent_fd)
+            try:
+                chmod(parent_fd, name, st)
+                _walk_beneath(dir_fd, chmod)
+            finally:
+                os.close(dir_fd)
+        else:
+            chmod(parent_fd, name, st)
+
+
+def _chown(root_fd: int, op: Chown, *, umask: int) -> None:
+    uid = _resolve_id(op.user, lambda n: pwd.getpwnam(n).pw_uid)
+    gid = _resolve_id(op.group, lambda n: grp.getgrnam(n).gr_gid)
+
+    def chown(parent_fd, name, st):
+        os.chown(name, uid, gid, dir_fd=parent_fd, follow_symlinks=False)
+
+    with _open_parent(root_fd, op.path) as (parent_fd, name):
+        st = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+        chown(parent_fd, name, st)
+        if op.recursive and stat.S_ISDIR(st.st_mode):
+            dir_fd = os.open(name, _DIR_FLAGS, dir_fd=parent_fd)
+            try:
+                _walk_beneath(dir_fd, chown)
+            finally:
+                os.close(dir_fd)
+
+
+def _symlink(root_fd: int, op: Symlink, *, umask: int) -> None:
+    with _open_parent(root_fd, op.dest) as (parent_fd, name):
+        os.symlink(op.source, name, dir_fd=parent_fd)
+
+
+def _image_id_getter(
+    root_fd: int, path: str, host_getter: Callable[[str], int],
+) -> Callable[[str], int]:
+    '''
+    Returns a function mapping names to IDs via a `passwd`-format file in
+    the subvolume, or `host_getter` if there is no such file.  Like the
+    host lookups, the function raises `KeyError` for unknown names.
+    '''
+    try:
+        with _open_parent(root_fd, path) as (parent_fd, name):
+            fd = os.open(
+                name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC,
+                dir_fd=parent_fd,
+            )
+    except FileNotFoundError:
+        return functools.lru_cache(maxsize=None)(host_getter)
+    name_to_id = {}
+    with open(fd, 'rb') as f:
+        for line in f:
+            fields = line.rstrip(b'\n').split(b':')
+            if len(fields) > 2 and fields[2].isdigit():
+                # Like `getpwnam`, the first entry for a name wins.
+                name_to_id.setdefault(os.fsdecode(fields[0]), int(fields[2]))
+    return name_to_id.__getitem__
+
+
+def _set_stat_options(
+    root_fd: int, op: SetStatOptions, *, umask: int,
+) -> None:
+    get_uid = _image_id_getter(
+        root_fd, 'etc/passwd', lambda n: pwd.getpwnam(n).pw_uid,
+    )
+    get_gid = _image_id_getter(
+        root_fd, 'etc/group', lambda n: grp.getgrnam(n).gr_gid,
+    )
+    for entry in op.entries:
+        entry = StatOptions(*entry)  # JSON turned it into a list
+        uid = _resolve_id(entry.user, get_uid)
+        gid = _resolve_id(entry.group, get_gid)
+        with _open_parent(root_fd, entry.path) as (parent_fd, name):
+            st = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+            if stat.S_ISLNK(st.st_mode):
+                raise RuntimeError(f'Cannot chmod {entry.path}, a symlink')
+            # `chown` clears the set-ID bits, so it has to come first.
+            os.chown(name, uid, gid, dir_fd=parent_fd, follow_symlinks=False)
+            os.chmod(name, apply_mode(
+                entry.mode, st.st_mode, is_dir=stat.S_ISDIR(st.st_mode),
+                umask=umask,
+            ), dir_fd=parent_fd)
+
+
+def _lstat(root_fd: int, op: Lstat, *, umask: int) -> Optional[dict]:
+    try:
+        with _open_parent(root_fd, op.path) as (parent_fd, name):
+            st = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+    return {
+        'mode': st.st_mode, 'uid': st.st_uid, 'gid': st.st_gid,
+        'size': st.st_size,
+    }
+
+
+def _write_tree(root_fd: int, op: WriteTree, *, umask: int) -> None:
+    parts = _split_path(op.path)
+    for idx in range(len(parts) - 1):
+        with _open_parent(root_fd, b'/'.join(parts[:idx + 1])) as (
+            parent_fd, name,
+        ):
+            try:
+                os.mkdir(name, 0o755, dir_fd=parent_fd)
+            except FileExistsError:
+                pass  # If it is not a directory, we fail below.
+    for relpath, content in op.entries:
+        with _open_parent(root_fd, os.path.join(op.path, relpath)) as (
+            parent_fd, name,
+        ):
+            if content is None:
+                os.mkdir(name, 0o755, dir_fd=parent_fd)
+                continue
+            fd = os.open(
+                name,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW |
+                    os.O_CLOEXEC,
+                0o644,
+                dir_fd=parent_fd,
+            )
+        try:
+            data = base64.b64decode(content)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+
+def _protected_trie(protected_paths: List[str]) -> dict:
+    '''
+    Nests a dict per path component.  Protected paths map to `_PROTECTED`,
+    which covers everything beneath, so they need no children.
+    '''
+    trie = {}
+    for path in protected_paths:
+        parts = _split_path(path)
+        if not parts:
+            return _PROTECTED  # The whole subvolume is protected
+        node = trie
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is _PROTECTED:
+                break
+        else:
+            node[parts[-1]] = _PROTECTED
+    return trie
+
+
+def _check_not_protected(trie: dict, path: str) -> None:
+    node = trie
+    for part in _split_path(path):
+        if node is _PROTECTED:
+            break
+        node = node.get(part)
+        if node is None:
+            return  # Nothing protected at or under `path`
+    if node is _PROTECTED or node:
+        raise RuntimeError(f'{path} overlaps a protected path')
+
+
+def _lstat_if_exists(root_fd: int, path: str) -> Optional[os.stat_result]:
+    '''
+    Like `os.path.lexists`, a missing parent directory is not an error,
+    nor is a parent that is not a directory.
+    '''
+    try:
+        with _open_parent(root_fd, path) as (parent_fd, name):
+            return os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _delete_subvol(parent_fd: int, name: bytes) -> None:
+    'Like `btrfs subvolume delete`, but only one ioctl.'
+    try:
+        fcntl.ioctl(parent_fd, _BTRFS_IOC_SNAP_DESTROY, bytearray(
+            struct.pack(_BTRFS_VOL_ARGS_FORMAT, 0, name)
+        ))
+    except OSError as ex:
+        if ex.errno not in (errno.ENOTTY, errno.EINVAL):
+            raise
+        # Not btrfs, so this is some other filesystem's root.
+        raise RuntimeError(f'Will not remove {name} on another filesystem')
+
+
+def _remove_tree(
+    parent_fd: int, name: bytes, st: os.stat_result, *,
+    dev: int, protected_inodes: set,
+) -> None:
+    if (st.st_dev, st.st_ino) in protected_inodes:
+        raise RuntimeError(f'Will not remove {name}, it is protected')
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(name, dir_fd=parent_fd)
+        return
+    if st.st_dev != dev:
+        if st.st_ino != _BTRFS_SUBVOL_ROOT_INO:
+            raise RuntimeError(f'Will not remove {name} on another device')
+        _delete_subvol(parent_fd, name)
+        return
+    dir_fd = os.open(name, _DIR_FLAGS, dir_fd=parent_fd)
+    try:
+        for child in os.listdir(dir_fd):
+            _remove_tree(
+                dir_fd, child,
+                os.stat(child, dir_fd=dir_fd, follow_symlinks=False),
+                dev=dev, protected_inodes=protected_inodes,
+            )
+    finally:
+        os.close(dir_fd)
+    os.rmdir(name, dir_fd=parent_fd)
+
+
+def _remove_paths(root_fd: int, op: RemovePaths, *, umask: int) -> List[int]:
+    trie = _protected_trie(op.protected_paths)
+    for path, _must_exist in op.paths:
+        if not _split_path(path):  # Like `rm`, refuse to remove `.`
+            raise RuntimeError('Will not remove the subvolume root')
+        _check_not_protected(trie, path)
+    protected_inodes = set()
+    for path in op.protected_paths:
+        st = _lstat_if_exists(root_fd, path)
+        if st is not None:
+            protected_inodes.add((st.st_dev, st.st_ino))
+    # Like `rm --one-file-system`, stay on the subvolume's device.
+    dev = os.fstat(root_fd).st_dev
+    missing = []
+    for idx, (path, must_exist) in enumerate(op.paths):
+        st = _lstat_if_exists(root_fd, path)
+        if st is None:
+            missing.append(idx)
+            if must_exist:
+                break
+            continue
+        with _open_parent(root_fd, path) as (parent_fd, name):
+            _remove_tree(
+                parent_fd, name, st, dev=dev,
+                protected_inodes=protected_inodes,
+            )
+    return missing
+
+
+def _hash_open_file(f, algorithm: str) -> str:
+    'Returns the hex digest of the rest of `f`.'
+    hasher = hashlib.new(algorithm)
+    for chunk in iter(lambda: f.read(_COPY_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@contextmanager
+def _open_tarball(f, source: str) -> Iterator[Any]:
+    '''
+    Yields a streaming `tarfile.TarFile` of `f`, the unbuffered, open file
+    of `source`, starting at its current offset.
+    '''
+    import tarfile  # Lazy, since few layers extract tarballs
+    decompress = decompress_command(source)
+    if decompress is None:
+        with tarfile.open(
+            fileobj=f, mode='r|*', bufsize=_COPY_CHUNK_SIZE,
+        ) as tf:
+            yield tf
+        return
+    with subprocess.Popen(
+        decompress, stdin=f, stdout=subprocess.PIPE,
+    ) as proc:
+        try:
+            with tarfile.open(
+                fileobj=proc.stdout, mode='r|', bufsize=_COPY_CHUNK_SIZE,
+            ) as tf:
+                yield tf
+            # Drain the output, so that the decompressor can exit.
+            while proc.stdout.read(_COPY_CHUNK_SIZE):
+                pass
+        except BaseException:
+            proc.kill()  # It may be blocked on output that we will not read
+            raise
+    check_popen_returncode(proc)
+
+
+def _tar_id(name: str, numeric_id: int, getter: Callable[[str], int]) -> int:
+    'Like `tar --same-owner`, prefer the host ID of `name`, if it has one.'
+    try:
+        return getter(name) if name else numeric_id
+    except KeyError:
+        return numeric_id
+
+
+def _extract_member(
+    tf: Any, member: Any, parent_fd: int, name: bytes, *, uid: int, gid: int,
+) -> bool:
+    '''
+    Makes `name` from the non-hardlink `member`, and returns whether it is
+    a new directory, whose mtime the caller must set after its contents.
+    '''
+    if member.isdir():
+        try:
+            os.mkdir(name, 0o700, dir_fd=parent_fd)
+        except FileExistsError:
+            st = os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                return False  # Keep its metadata, like `--keep-old-files`
+            raise
+    elif member.isreg():
+        fd = os.open(
+            name,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW |
+                os.O_CLOEXEC,
+            0o600,
+            dir_fd=parent_fd,
+        )
+        try:
+            src = tf.extractfile(member)
+            for chunk in iter(lambda: src.read(_COPY_CHUNK_SIZE), b''):
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+    elif member.issym():
+        os.symlink(member.linkname, name, dir_fd=parent_fd)
+    elif member.isfifo():
+        os.mkfifo(name, 0o600, dir_fd=parent_fd)
+    elif member.isdev():
+        os.mknod(
+            name,
+            (stat.S_IFCHR if member.ischr() else stat.S_IFBLK) | 0o600,
+            os.makedev(member.devmajor, member.devminor),
+            dir_fd=parent_fd,
+        )
+    else:
+        raise RuntimeError(f'{member.name} has unknown type {member.type}')
+    os.chown(name, uid, gid, dir_fd=parent_fd, follow_symlinks=False)
+    if not member.issym():
+        # `chown` clears the set-ID bits, so it has to come first.
+        os.chmod(name, stat.S_IMODE(member.mode), dir_fd=parent_fd)
+    if member.isdir():
+        return True
+    os.utime(
+        name, (member.mtime, member.mtime), dir_fd=parent_fd,
+        follow_symlinks=False,
+    )
+    return False
+
+
+def _extract_tarball(root_fd: int, op: ExtractTarball, *, umask: int) -> None:
+    algorithm, expected_hash = op.hash.split(':')
+    # Unbuffered, so that the `seek` also moves the offset of the file
+    # descriptor, which the decompressor reads.
+    with open(op.source, 'rb', buffering=0) as f:
+        # Validate the whole tarball before writing anything, and then
+        # extract the same open file.
+        actual_hash = _hash_open_file(f, algorithm)
+        if actual_hash != expected_hash:
+            raise RuntimeError(
+                f'{op.source} failed hash validation, got {actual_hash}'
+            )
+        f.seek(0)
+        _extract_tarball_members(root_fd, op, f)
+
+
+def _extract_tarball_members(root_fd: int, op: ExtractTarball, f) -> None:
+    get_uid = functools.lru_cache(maxsize=None)(
+        lambda n: pwd.getpwnam(n).pw_uid
+    )
+    get_gid = functools.lru_cache(maxsize=None)(
+        lambda n: grp.getgrnam(n).gr_gid
+    )
+    new_dirs = []  # Their mtimes are set last, since extraction changes it
+    into_fd = _open_dir(root_fd, _split_path(op.into_dir))
+    try:
+        with _open_tarball(f, op.source) as tf:
+            for member in tf:
+                if not _split_path(member.name):
+                    continue  # Like `tar --keep-old-files`, keep `into_dir`
+                with _open_parent(into_fd, member.name) as (parent_fd, name):
+                    if member.islnk():
+                        with _open_parent(into_fd, member.linkname) as (
+                            src_fd, src_name,
+                        ):
+                            os.link(
+                                src_name, name, src_dir_fd=src_fd,
+                                dst_dir_fd=parent_fd, follow_symlinks=False,
+                            )
+                        continue
+                    if op.force_root_ownership:
+                        uid, gid = 0, 0
+                    else:
+                        uid = _tar_id(member.uname, member.uid, get_uid)
+                        gid = _tar_id(member.gname, member.gid, get_gid)
+                    if _extract_member(
+                        tf, member, parent_fd, name, uid=uid, gid=gid,
+                    ):
+                        new_dirs.append(member)
+        # Children come after their parents in a tarball, so the reverse
+        # order sets a directory's mtime after those of its subdirectories.
+        for member in reversed(new_dirs):
+            with _open_parent(into_fd, member.name) as (parent_fd, name):
+                os.utime(
+                    name, (member.mtime, member.mtime), dir_fd=parent_fd,
+                    follow_symlinks=False,
+                )
+    finally:
+        os.close(into_fd)
+
+
+_OP_TYPE_TO_FN = {
+    CopyFile: _copy_file,
+    MakeDirs: _make_dirs,
+    Chmod: _chmod,
+    Chown: _chown,
+    Symlink: _symlink,
+    Lstat: _lstat,
+    SetStatOptions: _set_stat_options,
+    WriteTree: _write_tree,
+    RemovePaths: _remove_paths,
+    ExtractTarball: _extract_tarball,
+}
+assert set(_OP_TYPE_TO_FN) == set(_OP_TYPES.values())
+
+
+def _send_msg(sock: socket.socket, obj: Any) -> None:
+    data = json.dumps(obj).encode()
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_msg(sock: socket.socket) -> Any:
+    'Returns `None` if the peer closed the socket between messages.'
+    header = _recv_exactly(sock, 4)
+    if not header:
+        return None
+    size, = struct.unpack('>I', header)
+    data = _recv_exactly(sock, size)
+    if len(data) != size:
+        raise RuntimeError(f'Truncated message: {len(data)} of {size} bytes')
+    return json.loads(data.decode())
+
+
+def serve(sock: socket.socket, subvol_path: bytes, *, umask: int) -> None:
+    'The helper side of the protocol, returns once the client is done.'
+    while True:
+        request = _recv_msg(sock)
+        if request is None:
+            return
+        results = []
+        error = None
+        try:
+            root_fd = os.open(subvol_path, _DIR_FLAGS)
+            try:
+                for op_name, op_fields in request:
+                    op = _OP_TYPES[op_name](**op_fields)
+                    results.append(
+                        _OP_TYPE_TO_FN[type(op)](root_fd, op, umask=umask)
+                    )
+            finally:
+                os.close(root_fd)
+        except Exception as ex:
+            error = f'{type(ex).__name__}: {ex}'
+            log.error(f'Root helper failed on op {len(results)}: {error}')
+        _send_msg(sock, {'results': results, 'error': error})
+
+
+class RootHelperError(subprocess.CalledProcessError):
+    '''
+    The helper replaces commands that used to raise `CalledProcessError`
+    when run via `sudo`, so its errors derive from that, too.
+    '''
+
+    def __str__(self):
+        return f'Root helper op {self.cmd} failed: {self.stderr}'
+
+
+class RootHelperClient:
+    '''
+    Talks to one running helper, see `start_root_helper`.  Safe to use from
+    several threads, but the helper runs one batch at a time.
+    '''
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._lock = threading.Lock()
+
+    def run(self, ops: Sequence[NamedTuple]) -> List[Any]:
+        'Returns the results of `ops`, or raises `RootHelperError`.'
+        request = [[type(op).__name__, op._asdict()] for op in ops]
+        with self._lock:
+            _send_msg(self._sock, request)
+            response = _recv_msg(self._sock)
+        if response is None:
+            raise RuntimeError('The root helper exited unexpectedly')
+        if response['error'] is not None:
+            raise RootHelperError(
+                returncode=1, cmd=ops[len(response['results'])],
+                stderr=response['error'],
+            )
+        return response['results']
+
+
+@contextmanager
+def start_root_helper(
+    subvol_path: AnyStr, popen: Callable[[List[AnyStr]], Any],
+) -> Iterator[RootHelperClient]:
+    '''
+    `popen` is as in `send_fds_and_run.popen_and_inject_fds_after_sudo`: it
+    should return a `subprocess.Popen`-like context manager that runs its
+    argument as `root`.
+    '''
+    with listen_temporary_unix_socket() as (sock_path, lsock), popen([
+        # As in `send_fds_and_run.py`, keep `root` from writing bytecode
+        # into `buck-out`.
+        'env', 'PYTHONDONTWRITEBYTECODE=1',
+        # The helper binary is part of this library's `resources`, so this
+        # works in @mode/opt, as long as our PAR is not a XAR, whose
+        # content `root` cannot read.
+        os.path.join(os.path.dirname(__file__), 'root-helper'),
+        '--unix-sock', sock_path,
+        '--subvol', subvol_path,
+    ]) as proc:
+        # Unlike `send_fds_and_run`, we outlive many commands, so fail fast
+        # if the helper dies, instead of waiting `FD_UNIX_SOCK_TIMEOUT`.
+        lsock.settimeout(_ACCEPT_POLL_SEC)
+        deadline = time.monotonic() + FD_UNIX_SOCK_TIMEOUT
+        while True:
+            try:
+                sock, _ = lsock.accept()
+                break
+            except socket.timeout:
+                if proc.poll() is not None:
+                    raise RuntimeError(
+                        f'Root helper exited with {proc.returncode}'
+                    )
+                if time.monotonic() > deadline:  # pragma: no cover
+                    raise
+        # Closing the socket tells the helper to exit.
+        with sock:
+            sock.settimeout(None)
+            yield RootHelperClient(sock)
+
+
+def parse_opts(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--unix-sock', required=True,
+        help='Connect to the unix socket at this path to receive requests.',
+    )
+    parser.add_argument(
+        '--subvol', required=True,
+        help='The path of the subvolume, to which all op paths are relative.',
+    )
+    return parser.parse_args(argv)
+
+
+# `test_root_helper.py` runs this as a subprocess, but that is not counted
+# towards coverage.
+if __name__ == '__main__':  # pragma: no cover
+    init_logging()
+    opts = parse_opts(sys.argv[1:])
+    # Create files & directories with exactly the modes we ask for, but
+    # remember the umask, since `mkdir -p` and `chmod u+x` use it.
+    umask = os.umask(0)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(opts.unix_sock)
+        serve(sock, os.fsencode(opts.subvol), umask=umask)
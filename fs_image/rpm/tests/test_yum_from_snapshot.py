@@ -17,7 +17,10 @@ init_logging()
 class YumFromSnapshotTestCase(unittest.TestCase):
 
     @contextmanager
-    def _yum_install(self, *, protected_paths):
+    def _yum_install(
+        self, *, protected_paths, yum_args=_INSTALL_ARGS,
+        verify_installed=None,
+    ):
         install_root = Path(tempfile.mkdtemp())
         try:
             # IMAGE_ROOT/meta/ is always required since it's always protected
@@ -32,7 +35,8 @@ class YumFromSnapshotTestCase(unittest.TestCase):
             yum_from_test_snapshot(
                 install_root,
                 protected_paths=protected_paths,
-                yum_args=_INSTALL_ARGS,
+                yum_args=yum_args,
+                verify_installed=verify_installed,
             )
             yield install_root
         finally:
@@ -92,3 +96,23 @@ class YumFromSnapshotTestCase(unittest.TestCase):
                 pass
         # It was none other than `yum install` that failed.
         self.assertEqual(_INSTALL_ARGS, ctx.exception.cmd[-len(_INSTALL_ARGS):])
+
+    def test_verify_installed(self):
+        with self._yum_install(
+            protected_paths=[], verify_installed=['rpm-test-carrot'],
+        ):
+            pass
+        # `yum shell` succeeds even if it cannot find a package, which is
+        # why `--verify-installed` exists.
+        with tempfile.NamedTemporaryFile('w') as script:
+            script.write('install-n rpm-test-carrot rpm-test-mice-2\nrun\n')
+            script.flush()
+            shell_args = ['--assumeyes', 'shell', script.name]
+            with self._yum_install(protected_paths=[], yum_args=shell_args):
+                pass
+            with self.assertRaises(subprocess.CalledProcessError):
+                with self._yum_install(
+                    protected_paths=[], yum_args=shell_args,
+                    verify_installed=['rpm-test-carrot', 'rpm-test-mice-2'],
+                ):
+                    pass  # pragma: no cover
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+from .. import yum_warm_cache
+
+from ..common import Path
+from ..yum_warm_cache import snapshot_key, use_warm_cache
+
+
+def _run_as_root(args):
+    'Our temporary files are not owned by root, so `sudo` is not needed.'
+    subprocess.run(args, check=True)
+
+
+class YumWarmCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(self._remove_temp_dir)
+        self._orig_run_as_root = yum_warm_cache._run_as_root  # Unpatched
+        patcher = unittest.mock.patch.object(
+            yum_warm_cache, '_run_as_root', side_effect=_run_as_root,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.snapshot_dir = self.temp_dir / 'snapshot'
+        for relpath, content in [
+            ('yum.conf', '[main]\n[cat]\n[dog]\n'),
+            ('cat/repomd.xml', 'cat v1'),
+            ('dog/repomd.xml', 'dog v1'),
+            ('dog/rpm.json', '{}'),  # Not in the key
+        ]:
+            self._write(self.snapshot_dir / relpath, content)
+        self.cache_dir = self.temp_dir / 'cache'
+
+    def _remove_temp_dir(self):
+        for dirpath, dirnames, _ in os.walk(self.temp_dir):
+            for d in dirnames:
+                os.chmod(os.path.join(dirpath, d), 0o755)
+        shutil.rmtree(bytes(self.temp_dir))
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def _fake_yum(self, install_root, repos=('cat', 'dog')):
+        'Writes what `yum install` leaves in its cache.'
+        yum_cache = install_root / 'var/cache/yum/x86_64/7'
+        for repo in repos:
+            self._write(yum_cache / repo / 'repomd.xml', f'{repo} repomd')
+            self._write(yum_cache / repo / 'packages/x.rpm', 'rpm')
+        self._write(yum_cache / 'timedhosts', 'hosts')
+
+    def _install_root(self, name):
+        install_root = self.temp_dir / name
+        os.mkdir(install_root)
+        return install_root
+
+    def _use(self, install_root, cache_dir='default'):
+        return use_warm_cache(
+            cache_dir=self.cache_dir if cache_dir == 'default' else cache_dir,
+            snapshot_dir=self.snapshot_dir,
+            install_root=install_root,
+        )
+
+    def test_run_as_root(self):
+        with unittest.mock.patch.object(subprocess, 'run') as run:
+            self._orig_run_as_root([b'true'])
+        run.assert_called_once_with(['sudo', b'true'], check=True)
+
+    def test_snapshot_key(self):
+        keys = {snapshot_key(self.snapshot_dir)}
+        self.assertEqual(keys, {snapshot_key(self.snapshot_dir)})
+        for relpath, content in [
+            ('dog/rpm.json', '{"a": 1}'),  # Same key
+            ('yum.conf', '[main]\n[dog]\n[cat]\n'),
+            ('cat/repomd.xml', 'cat v2'),
+            ('bunny/repomd.xml', 'bunny v1'),
+        ]:
+            self._write(self.snapshot_dir / relpath, content)
+            keys.add(snapshot_key(self.snapshot_dir))
+        self.assertEqual(4, len(keys))
+
+    def test_store_and_prime(self):
+        # A miss stores the cache, minus the RPMs, once `yum` succeeds.
+        install_root = self._install_root('miss')
+        with self._use(install_root):
+            self.assertFalse(os.path.exists(self.cache_dir))
+            self._fake_yum(install_root)
+        entry_dir = self.cache_dir / snapshot_key(self.snapshot_dir)
+        self.assertEqual([entry_dir], [
+            self.cache_dir / p for p in os.listdir(self.cache_dir)
+        ])
+        self.assertEqual(0o555, os.stat(entry_dir).st_mode & 0o777)
+        entry_cache = entry_dir / 'cache/x86_64/7'
+        self.assertEqual(
+            {b'cat', b'dog', b'timedhosts'}, set(os.listdir(entry_cache)),
+        )
+        self.assertEqual([b'repomd.xml'], os.listdir(entry_cache / 'cat'))
+
+        # A hit primes the install root before `yum` runs, and does not
+        # write to the entry.
+        install_root = self._install_root('hit')
+        yum_cache = install_root / 'var/cache/yum/x86_64/7'
+        with self._use(install_root):
+            self.assertEqual(
+                'cat repomd', self._read(yum_cache / 'cat/repomd.xml'),
+            )
+            self._write(yum_cache / 'cat/repomd.xml', 'changed')
+            self._write(yum_cache / 'cat/packages/y.rpm', 'rpm')
+        self.assertEqual(
+            'cat repomd', self._read(entry_cache / 'cat/repomd.xml'),
+        )
+        self.assertEqual([b'repomd.xml'], os.listdir(entry_cache / 'cat'))
+
+        # A concurrent miss that finishes second keeps the first entry.
+        install_root = self._install_root('concurrent')
+        orig_exists = os.path.exists
+        with unittest.mock.patch.object(
+            os.path, 'exists',
+            side_effect=lambda p: p != entry_dir and orig_exists(p),
+        ), self._use(install_root):
+            self._fake_yum(install_root, repos=['cat', 'dog', 'bunny'])
+        self.assertEqual([entry_dir], [
+            self.cache_dir / p for p in os.listdir(self.cache_dir)
+        ])
+        self.assertEqual({b'cat', b'dog', b'timedhosts'}, set(os.listdir(
+            entry_dir / 'cache/x86_64/7'
+        )))
+
+    def test_no_op(self):
+        # Caches already in the install root are neither replaced, nor
+        # stored.  Nor are caches when there is no cache dir.
+        for name, cache_dir in [('has_cache', 'default'), ('no_dir', None)]:
+            install_root = self._install_root(name)
+            if cache_dir is not None:
+                self._fake_yum(install_root, repos=['cat'])
+            with self._use(install_root, cache_dir):
+                self._fake_yum(install_root)
+            self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_do_not_store(self):
+        # Not every repo has metadata, e.g. since `yum` only removed RPMs.
+        install_root = self._install_root('partial')
+        with self._use(install_root):
+            self._fake_yum(install_root, repos=['dog'])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+        # A failed `yum` leaves no entry.
+        install_root = self._install_root('failed')
+        with self.assertRaisesRegex(RuntimeError, 'yum failed'):
+            with self._use(install_root):
+                self._fake_yum(install_root)
+                raise RuntimeError('yum failed')
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+        # Errors while storing leave no temporary directory behind.
+        install_root = self._install_root('store_error')
+        with unittest.mock.patch.object(
+            os, 'rename', side_effect=PermissionError('rename'),
+        ), self.assertRaisesRegex(PermissionError, 'rename'):
+            with self._use(install_root):
+                self._fake_yum(install_root)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
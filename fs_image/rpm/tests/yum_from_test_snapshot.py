@@ -6,7 +6,7 @@ built by `tests/build_repos.py`.  Used in the image compiler unit tests.
 import json
 import os
 
-from typing import AnyStr, List
+from typing import AnyStr, List, Optional
 
 from ..common import init_logging, Path
 from ..yum_from_snapshot import add_common_yum_args, yum_from_snapshot
@@ -16,6 +16,8 @@ def yum_from_test_snapshot(
     install_root: AnyStr,
     protected_paths: List[AnyStr],
     yum_args: List[AnyStr],
+    warm_cache_dir: Optional[AnyStr] = None,
+    verify_installed: Optional[List[str]] = None,
 ):
     # This works in @mode/opt since the snapshot is baked into the XAR
     snapshot_dir = Path(os.path.dirname(__file__)) / 'snapshot'
@@ -29,6 +31,9 @@ def yum_from_test_snapshot(
         install_root=Path(install_root),
         protected_paths=protected_paths,
         yum_args=yum_args,
+        warm_cache_dir=None if warm_cache_dir is None
+            else Path(warm_cache_dir),
+        verify_installed=verify_installed,
     )
 
 
@@ -47,4 +52,5 @@ if __name__ == '__main__':  # pragma: no cover
 
     yum_from_test_snapshot(
         args.install_root, args.protected_path, args.yum_args,
+        args.warm_cache_dir, args.verify_installed,
     )
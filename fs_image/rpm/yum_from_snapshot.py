@@ -68,8 +68,10 @@ The current tool works well, with these caveats:
 
       * Since we typically run `yum` in an empty clean install-root, the
         initial run is extra-slow due to having to download the repodata,
-        and build the local DB / populate local caches.  The "yum appliance"
-        work below will speed this up dramatically.
+        and build the local DB / populate local caches.  `--warm-cache-dir`
+        addresses this by reusing the caches of an earlier run against the
+        same snapshot, see `yum_warm_cache.py`.  The "yum appliance" work
+        below would also speed this up.
 
   - This brings up and tears down network namespaces frequently. According
     to ast@kernel.org, bugs are routinely introduced that break NETNS
@@ -118,7 +120,7 @@ import time
 
 from contextlib import contextmanager
 from urllib.parse import urlparse, urlunparse
-from typing import Iterator, List, Mapping, TextIO
+from typing import Iterator, List, Mapping, Optional, TextIO
 
 from common import (
     check_popen_returncode, FD_UNIX_SOCK_TIMEOUT, get_file_logger,
@@ -126,6 +128,7 @@ from common import (
 )
 from .common import Path
 from .yum_conf import YumConfParser
+from .yum_warm_cache import use_warm_cache
 
 log = get_file_logger(__file__)
 
@@ -357,6 +360,23 @@ def _make_socket_and_send_via(*, unix_sock_fd):
     ''')]
 
 
+def _verify_installed_after_yum(
+    install_root: Path, rpm_names: List[str],
+) -> List[str]:
+    '''
+    `yum shell` exits 0 even if it found none of the packages to install,
+    so this prefix for the `yum` command then queries the RPM database of
+    the install root for each of `rpm_names`.  It runs inside the `yum`
+    sandbox, with the same `rpm` that `yum` used.
+    '''
+    if not rpm_names:
+        return []
+    return ['bash', '-uec', '"$@"; rpm --root {} --query -- {}'.format(
+        shlex.quote(install_root.decode()),
+        ' '.join(shlex.quote(n) for n in rpm_names),
+    ), 'verify-installed']  # argv[0]
+
+
 @contextmanager
 def _dummy_dev() -> str:
     'A whitelist of devices is safer than the entire host /dev'
@@ -406,6 +426,8 @@ def _dummies_for_protected_paths(protected_paths) -> Mapping[str, str]:
 def yum_from_snapshot(
     *, storage_cfg: str, snapshot_dir: Path, install_root: Path,
     protected_paths: List[str], yum_args: List[str],
+    warm_cache_dir: Optional[Path] = None,
+    verify_installed: Optional[List[str]] = None,
 ):
     # The paths that have trailing slashes are directories, others are
     # files.  There's a separate code path for protecting some files above.
@@ -434,7 +456,12 @@ def yum_from_snapshot(
             assert arg != '-c'
             assert not arg.startswith(bad_arg), f'{arg} is prohibited'
 
-    with _temp_fifo() as netns_fifo, _temp_fifo(
+    # Outermost, since the cache is stored after the sandbox is torn down.
+    with use_warm_cache(
+        cache_dir=warm_cache_dir,
+        snapshot_dir=snapshot_dir,
+        install_root=install_root,
+    ), _temp_fifo() as netns_fifo, _temp_fifo(
                 # Lets the child wait for yum_conf to be ready. This could
                 # be done via an `flock` on `yum_conf.name`, but that's not
                 # robust on some network filesystems, so let's use a pipe.
@@ -455,6 +482,9 @@ def yum_from_snapshot(
                     netns_fifo, ready_fifo,
                 ),
                 'yum-from-snapshot',  # argv[0]
+                *_verify_installed_after_yum(
+                    install_root, verify_installed or [],
+                ),
                 'yum',
                 # Most `yum` options are isolated by our `YumConfIsolator`.
                 '--config', out_yum_conf.name,
@@ -543,6 +573,21 @@ def add_common_yum_args(parser: 'argparse.ArgumentParser'):  # pragma: no cover
             'The path must already exist. There are some internal defaults '
             'that cannot be un-protected. May be repeated.',
     )
+    parser.add_argument(
+        '--warm-cache-dir', type=Path.from_argparse,
+        help='Keep a read-only copy of the `yum` metadata caches of each '
+            'repo snapshot in this directory, normally inside the per-repo '
+            'artifacts dir.  Then, each `yum` run into an install root '
+            'without caches starts from a copy of the warm cache, instead '
+            'of fetching all the repodata.  See `yum_warm_cache.py`.',
+    )
+    parser.add_argument(
+        '--verify-installed', action='append', default=[],
+        help='After `yum` succeeds, fail unless the RPM database of '
+            '--install-root has this package.  Use this with `yum shell`, '
+            'which does not fail when it cannot find a package to install. '
+            'May be repeated.',
+    )
     parser.add_argument(
         'yum_args', nargs='+',
         help='Pass these through to `yum`. You will want to use -- before '
@@ -586,4 +631,6 @@ if __name__ == '__main__':  # pragma: no cover
         install_root=args.install_root,
         protected_paths=args.protected_path,
         yum_args=args.yum_args,
+        warm_cache_dir=args.warm_cache_dir,
+        verify_installed=args.verify_installed,
     )
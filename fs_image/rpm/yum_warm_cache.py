@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+'''
+When `yum` runs in an empty install root, it first has to fetch the
+repodata of every repo from `repo-server`, and to build its local metadata
+caches, which is the bulk of the runtime of a small install.  But these
+caches depend only on the repo snapshot, so `yum-from-snapshot` can warm
+them up once per snapshot, and reuse them across layer builds.
+
+Each entry in the `--warm-cache-dir` is keyed on a hash of the snapshot's
+`yum.conf` and of the `repomd.xml` of each repo -- the latter includes the
+checksums of all the other repodata, so a new snapshot gets a new entry.
+
+  - On a miss, `yum` runs as usual.  If it succeeds, we copy its
+    `$installroot/var/cache/yum` into a new entry, minus any downloaded
+    RPMs.  Readers never see a partial entry, since we rename it into
+    place only once it is complete.
+
+  - On a hit, we copy the entry into the empty install root before `yum`
+    runs.  The copy uses reflinks where the filesystem supports them (e.g.
+    btrfs), so it is cheap, and `yum` only ever writes to its own copy.
+
+Entries are never mutated in place: their content is owned by root, and
+their top directory is read-only.  We do not refresh an entry after later
+runs, nor store a cache that lacks the metadata of some repo (e.g. after
+a `yum remove`), so each entry is built once per snapshot.
+
+Future: garbage-collect entries of snapshots that are no longer in use,
+as `compiler/generator_tarball_cache.py` does.
+'''
+import errno
+import hashlib
+import os
+import subprocess
+import tempfile
+
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from .common import get_file_logger, Path
+
+log = get_file_logger(__file__)
+
+_CACHE = b'cache'  # A copy of `$installroot/var/cache/yum`
+_TEMP_PREFIX = b'.tmp'  # Not yet populated, or failed to populate
+_YUM_CACHE_RELPATH = b'var/cache/yum'
+
+
+def _run_as_root(args: List[bytes]):
+    subprocess.run(['sudo', *args], check=True)
+
+
+def _snapshot_repos(snapshot_dir: Path) -> List[bytes]:
+    return sorted(
+        name for name in os.listdir(snapshot_dir)
+            if os.path.exists(snapshot_dir / name / 'repomd.xml')
+    )
+
+
+def snapshot_key(snapshot_dir: Path) -> str:
+    'Changes whenever `yum` would see different repo metadata.'
+    h = hashlib.sha256()
+    for relpath in [
+        b'yum.conf',
+        *(repo + b'/repomd.xml' for repo in _snapshot_repos(snapshot_dir)),
+    ]:
+        with open(snapshot_dir / relpath, 'rb') as f:
+            content = f.read()
+        # Lengths keep the boundaries between names & contents unambiguous
+        for b in [relpath, content]:
+            h.update(b'%d:%s' % (len(b), b))
+    return h.hexdigest()
+
+
+def _has_all_repos(yum_cache: Path, repos: List[bytes]) -> bool:
+    '''
+    `yum` keeps each repo's metadata in `$cachedir/$basearch/$releasever/
+    REPO/`, so we just look for the `repomd.xml` of each one.
+    '''
+    missing = set(repos)
+    for dirpath, _, filenames in os.walk(yum_cache):
+        if b'repomd.xml' in filenames:
+            missing.discard(os.path.basename(dirpath))
+    return not missing
+
+
+def _prime(entry_cache: Path, yum_cache: Path):
+    _run_as_root([b'mkdir', b'-p', os.path.dirname(yum_cache)])
+    _run_as_root([
+        b'cp', b'--recursive', b'--reflink=auto', b'--no-target-directory',
+        # Omitting timestamps makes the "cachecookie"s look new, so `yum`
+        # does not even fetch `repomd.xml` to check if they are stale.
+        # That is fine, since the entry's key includes every `repomd.xml`.
+        b'--preserve=mode,ownership,links',
+        entry_cache, yum_cache,
+    ])
+
+
+def _store(cache_dir: Path, entry_dir: Path, yum_cache: Path):
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = Path(tempfile.mkdtemp(dir=cache_dir, prefix=_TEMP_PREFIX))
+    try:
+        temp_cache = temp_dir / _CACHE
+        _run_as_root([
+            b'cp', b'--recursive', b'--reflink=auto', b'--no-target-directory',
+            b'--preserve=mode,ownership,links', yum_cache, temp_cache,
+        ])
+        # The downloaded RPMs are useless to later runs, and are large.
+        _run_as_root([
+            b'find', temp_cache, b'-mindepth', b'1', b'-type', b'd',
+            b'-name', b'packages', b'-prune', b'-exec', b'rm', b'-rf', b'{}',
+            b'+',
+        ])
+        os.chmod(temp_dir, 0o555)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError as ex:
+            # A concurrent `yum-from-snapshot` already populated this entry.
+            if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise  # pragma: no cover
+            log.info(f'{entry_dir.decode()} was stored concurrently')
+        else:
+            log.info(f'Stored warm yum cache {entry_dir.decode()}')
+    finally:
+        # `temp_cache` is owned by root, and `temp_dir` is read-only.
+        if os.path.exists(temp_dir):
+            _run_as_root([b'rm', b'-rf', temp_dir])
+
+
+@contextmanager
+def use_warm_cache(
+    *, cache_dir: Optional[Path], snapshot_dir: Path, install_root: Path,
+) -> Iterator[None]:
+    '''
+    Wrap a `yum` invocation to start with the snapshot's warm cache if
+    `cache_dir` has it, or else to store the cache once `yum` succeeds.
+    A no-op if `cache_dir` is None, or if the install root already has a
+    `yum` cache, e.g. from a parent layer.
+    '''
+    yum_cache = install_root / _YUM_CACHE_RELPATH
+    if cache_dir is None or os.path.exists(yum_cache):
+        yield
+        return
+    entry_dir = cache_dir / snapshot_key(snapshot_dir)
+    if os.path.exists(entry_dir):
+        log.info(f'Using warm yum cache {entry_dir.decode()}')
+        _prime(entry_dir / _CACHE, yum_cache)
+        yield
+        return
+    yield  # Not reached if `yum` fails, so we never store a bad cache.
+    if _has_all_repos(yum_cache, _snapshot_repos(snapshot_dir)):
+        _store(cache_dir, entry_dir, yum_cache)
+    else:
+        log.info(f'Not storing {yum_cache.decode()}, it lacks some repos')
@@ -5,10 +5,11 @@ import subprocess
 import time
 
 from contextlib import contextmanager
-from typing import AnyStr, BinaryIO, Iterator
+from typing import Any, AnyStr, BinaryIO, Iterator, List, NamedTuple
 
 from btrfs_loopback import LoopbackVolume, run_stdout_to_err
 from common import byteme, check_popen_returncode, get_file_logger, pipe
+from root_helper import RootHelperClient, start_root_helper
 from unshare import Namespace, nsenter_as_root, nsenter_as_user, Unshare
 
 from compiler.subvolume_on_disk import SubvolumeOnDisk
@@ -86,6 +87,7 @@ class Subvol:
         '''
         self._path = os.path.abspath(byteme(path))
         self._exists = already_exists
+        self._root_helper = None
         if self._exists and not _path_is_btrfs_subvol(self._path):
             raise AssertionError(f'No btrfs subvol at {self._path}')
 
@@ -205,6 +207,37 @@ class Subvol:
             stderr=stderr,
         )
 
+    @contextmanager
+    def root_helper(self) -> Iterator[RootHelperClient]:
+        '''
+        Inside this context, `run_root_helper_ops` reuses a single `root`
+        process, instead of paying for `sudo` on every call.  The helper
+        may be started before `create` or `snapshot`.
+        '''
+        assert self._root_helper is None, 'Root helper is already running'
+        with start_root_helper(self.path(), lambda args: self.popen_as_root(
+            args, _subvol_exists=self._exists,
+        )) as helper:
+            self._root_helper = helper
+            try:
+                yield helper
+            finally:
+                self._root_helper = None
+
+    def run_root_helper_ops(self, ops: List[NamedTuple]) -> List[Any]:
+        '''
+        Applies a batch of ops from `root_helper.py` to this subvolume, and
+        returns their results.  All paths are relative to the subvolume,
+        and may not leave it, so -- unlike with `run_as_root` -- there is
+        no need to wrap them with `Subvol.path`.
+        '''
+        if not self._exists:
+            raise AssertionError(f'{self.path()} does not exist')
+        if self._root_helper is not None:
+            return self._root_helper.run(ops)
+        with self.root_helper() as helper:
+            return helper.run(ops)
+
     # Future: run_in_image()
 
     # From here on out, every public method directly maps to the btrfs API.
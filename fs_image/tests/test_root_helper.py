@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+import errno
+import gzip
+import hashlib
+import io
+import os
+import socket
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from contextlib import contextmanager
+
+from common import decompress_command
+from root_helper import (
+    _copy_data, _open_dir, _recv_msg, _remove_tree, _send_msg, apply_mode,
+    parse_opts, serve, start_root_helper, Chmod, Chown, CopyFile,
+    ExtractTarball, Lstat, MakeDirs, RemovePaths, RootHelperClient,
+    RootHelperError, SetStatOptions, StatOptions, Symlink, WriteTree,
+)
+
+
+@contextmanager
+def _serving_client(subvol_path):
+    'Runs `serve` in a thread, so that coverage can see it.'
+    csock, ssock = socket.socketpair()
+    t = threading.Thread(
+        target=serve, args=(ssock, subvol_path), kwargs={'umask': 0o022},
+    )
+    t.start()
+    try:
+        with csock:
+            yield RootHelperClient(csock)
+    finally:
+        t.join()
+        ssock.close()
+
+
+def _mode(path):
+    return stat.S_IMODE(os.lstat(path).st_mode)
+
+
+class RootHelperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._td_ctx = tempfile.TemporaryDirectory()
+        self.td = self._td_ctx.__enter__()
+        self.subvol = os.path.join(self.td, 'subvol')
+        os.mkdir(self.subvol)
+        self.addCleanup(self._td_ctx.__exit__, None, None, None)
+
+    def _p(self, path):
+        return os.path.join(self.subvol, path)
+
+    def test_apply_mode(self):
+        for mode, old_mode, is_dir, expected in [
+            (0o644, 0o100777, False, 0o644),
+            # Numeric modes keep the set-ID bits of directories
+            (0o755, 0o42700, True, 0o2755),
+            (0o755, 0o102700, False, 0o755),
+            ('a-rwxXst,u+rw', 0o107777, False, 0o600),
+            ('a-rwxXst,u+rx', 0o40777, True, 0o500),
+            ('u=rwx,go=rx', 0o100000, False, 0o755),
+            ('g+s,o+t', 0o40000, True, 0o3000),
+            ('u+s', 0o100000, False, 0o4000),
+            # `X` depends on an existing execute bit, or on being a dir
+            ('a+X', 0o100644, False, 0o644),
+            ('a+X', 0o100744, False, 0o755),
+            ('a+X', 0o40600, True, 0o711),
+            ('a-x+X', 0o100755, False, 0o644),
+            # Without `ugoa`, the umask bits are left alone
+            ('+w', 0o100444, False, 0o644),
+            ('=rx', 0o100777, False, 0o777 & ~0o222 | 0o022),
+            ('-w', 0o100666, False, 0o466),
+        ]:
+            self.assertEqual(expected, apply_mode(
+                mode, old_mode, is_dir=is_dir, umask=0o022,
+            ), (mode, oct(old_mode)))
+        with self.assertRaisesRegex(RuntimeError, 'Unsupported clause'):
+            apply_mode('u+q', 0o100644, is_dir=False, umask=0)
+
+    def test_ops(self):
+        src = os.path.join(self.td, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'0123456789' * 300000)  # Several copy chunks
+        os.chmod(src, 0o751)
+        with _serving_client(self.subvol.encode()) as helper:
+            self.assertEqual([None] * 5, helper.run([
+                MakeDirs(path='a/b', mode=0o700),
+                MakeDirs(path='/a/b/'),  # Exists, so the mode is unchanged
+                CopyFile(source=src, dest='a/b/f'),
+                Symlink(source='/a/b/f', dest='a/l'),
+                Symlink(source='b', dest='a/dl'),
+            ]))
+            self.assertEqual(0o755, _mode(self._p('a')))
+            self.assertEqual(0o700, _mode(self._p('a/b')))
+            self.assertEqual(0o751 & ~0o022, _mode(self._p('a/b/f')))
+            with open(self._p('a/b/f'), 'rb') as f:
+                self.assertEqual(b'0123456789' * 300000, f.read())
+            self.assertEqual('/a/b/f', os.readlink(self._p('a/l')))
+
+            # Overwriting keeps the mode, like `cp`.
+            with open(src, 'wb') as f:
+                f.write(b'new')
+            helper.run([CopyFile(source=src, dest='a/b/f')])
+            with open(self._p('a/b/f'), 'rb') as f:
+                self.assertEqual(b'new', f.read())
+            self.assertEqual(0o751 & ~0o022, _mode(self._p('a/b/f')))
+
+            # Relative in-subvol symlinks are fine in directory components
+            helper.run([
+                MakeDirs(path='a/dl/c'),
+                CopyFile(source=src, dest='a/dl/../dl/c/g'),
+            ])
+            self.assertTrue(os.path.isfile(self._p('a/b/c/g')))
+
+            helper.run([
+                Chmod(path='a', mode='a-rwxXst,u+rx', recursive=True),
+                Chmod(path='a/b/c/g', mode=0o640),
+                Chmod(path='.', mode=0o711),
+                Chown(path='a/b', user='root', group='12', recursive=True),
+                Chown(path='a/b/f', user='77', group='root'),
+                Chown(path='a/l', user='5', group='6', recursive=True),
+            ])
+            self.assertEqual(0o711, _mode(self.subvol))
+            self.assertEqual(0o500, _mode(self._p('a')))
+            self.assertEqual(0o500, _mode(self._p('a/b')))
+            self.assertEqual(0o500, _mode(self._p('a/b/f')))
+            self.assertEqual(0o640, _mode(self._p('a/b/c/g')))
+            # `chmod -R` skipped the symlink, but `chown` got it.
+            self.assertEqual(0o777, _mode(self._p('a/l')))
+
+            [missing, f_stat, l_stat, root_stat] = helper.run([
+                Lstat(path='a/missing'),
+                Lstat(path='a/b/f'),
+                Lstat(path='a/l'),
+                Lstat(path='/'),
+            ])
+            self.assertIsNone(missing)
+            self.assertEqual(
+                {'mode': 0o100500, 'uid': 77, 'gid': 0, 'size': 3}, f_stat,
+            )
+            self.assertEqual((5, 6), (l_stat['uid'], l_stat['gid']))
+            self.assertTrue(stat.S_ISLNK(l_stat['mode']))
+            self.assertEqual(0o40711, root_stat['mode'])
+            self.assertEqual(
+                (0, 12), tuple(os.lstat(self._p('a/b/c')))[4:6],
+            )
+
+    def test_set_stat_options(self):
+        os.makedirs(self._p('etc'))
+        os.makedirs(self._p('d/e'))
+        with open(self._p('d/f'), 'w'):
+            pass
+        os.chmod(self._p('d/f'), 0o644)
+        os.symlink('f', self._p('d/l'))
+        with _serving_client(self.subvol.encode()) as helper:
+            # Without `/etc/passwd` & `/etc/group`, we use the host's.
+            helper.run([SetStatOptions(entries=[
+                StatOptions(path='d/f', mode='u+s', user='root', group='0'),
+            ])])
+            st = os.lstat(self._p('d/f'))
+            self.assertEqual(
+                (0o104644, 0, 0), (st.st_mode, st.st_uid, st.st_gid),
+            )
+
+            with open(self._p('etc/passwd'), 'w') as f:
+                f.write('root:x:0:0::/:/bin/sh\nalice:x:1234:5:::\n')
+                f.write('alice:x:999:5:::\nbad line\n')
+            with open(self._p('etc/group'), 'w') as f:
+                f.write('root:x:0:\nwheel:x:4321:alice\n')
+            self.assertEqual([None], helper.run([SetStatOptions(entries=[
+                StatOptions(path='d', mode=0o750, user='alice', group='0'),
+                StatOptions(
+                    path='d/e', mode='a-rwxXst,u+rx', user='7', group='wheel',
+                ),
+                StatOptions(
+                    path='d/f', mode='a-rwxXst,u+rwXs', user='alice',
+                    group='wheel',
+                ),
+            ])]))
+            self.assertEqual(0o750, _mode(self._p('d')))
+            self.assertEqual(0o500, _mode(self._p('d/e')))
+            # Applied after `chown`, so the set-UID bit survives.
+            self.assertEqual(0o4600, _mode(self._p('d/f')))
+            self.assertEqual(
+                [(1234, 0), (7, 4321), (1234, 4321)],
+                [
+                    tuple(os.lstat(self._p(p)))[4:6]
+                        for p in ['d', 'd/e', 'd/f']
+                ],
+            )
+
+            # The host's users are not used when the image has a database.
+            for user, group, msg in [
+                ('daemon', 'root', 'Unknown user or group: daemon'),
+                ('root', 'daemon', 'Unknown user or group: daemon'),
+            ]:
+                with self.assertRaisesRegex(RootHelperError, msg):
+                    helper.run([SetStatOptions(entries=[StatOptions(
+                        path='d', mode=0o755, user=user, group=group,
+                    )])])
+            with self.assertRaisesRegex(RootHelperError, 'd/l, a symlink'):
+                helper.run([SetStatOptions(entries=[StatOptions(
+                    path='d/l', mode=0o755, user='root', group='root',
+                )])])
+
+    def test_write_tree(self):
+        os.mkdir(self._p('a'))
+        os.chmod(self._p('a'), 0o700)
+        with _serving_client(self.subvol.encode()) as helper:
+            helper.run([WriteTree(path='a/b/c', entries=[
+                ('', None),
+                ('d', None),
+                ('d/e.bin', 'AP8='),  # b'\x00\xff'
+                ('f', ''),
+            ])])
+            # Only the missing parents are made
+            self.assertEqual(0o700, _mode(self._p('a')))
+            self.assertEqual(0o755, _mode(self._p('a/b')))
+            self.assertEqual(0o755, _mode(self._p('a/b/c/d')))
+            self.assertEqual(0o644, _mode(self._p('a/b/c/d/e.bin')))
+            with open(self._p('a/b/c/d/e.bin'), 'rb') as f:
+                self.assertEqual(b'\x00\xff', f.read())
+            self.assertEqual(0, os.path.getsize(self._p('a/b/c/f')))
+
+            helper.run([WriteTree(path='g', entries=[('', 'eA==')])])
+            with open(self._p('g'), 'rb') as f:
+                self.assertEqual(b'x', f.read())
+
+            # Like `serialize`, fail if anything exists.
+            for op in [
+                WriteTree(path='a/b/c', entries=[('', None)]),
+                WriteTree(path='g', entries=[('', 'eA==')]),
+                WriteTree(path='h', entries=[('', None), ('', None)]),
+            ]:
+                with self.assertRaisesRegex(RootHelperError, 'FileExists'):
+                    helper.run([op])
+            with self.assertRaisesRegex(RootHelperError, 'NotADirectory'):
+                helper.run([WriteTree(path='g/x/y', entries=[('', None)])])
+
+    def test_remove_paths(self):
+        for d in ['a/b/c', 'f/g', 'meta', 'mnt/x']:
+            os.makedirs(self._p(d))
+        for f in ['a/b/c/d', 'a/b/e', 'f/h', 'f/i']:
+            with open(self._p(f), 'w'):
+                pass
+        os.symlink('/f', self._p('a/b/f_sym'))
+        os.symlink('i', self._p('f/i_sym'))
+        os.symlink('..', self._p('f/up'))
+        # `meta/in/x` is redundant, and does not exist.
+        protected = ['meta/', 'mnt/x/', 'f/i', 'meta/in/x']
+
+        def remove(*paths):
+            return helper.run([RemovePaths(
+                paths=list(paths), protected_paths=protected,
+            )])[0]
+
+        with _serving_client(self.subvol.encode()) as helper:
+            # Nothing is removed when a path overlaps a protected one.
+            for path in ['meta', '/meta/x', 'mnt', 'f']:
+                with self.assertRaisesRegex(
+                    RootHelperError, f'{path} overlaps a protected path',
+                ):
+                    remove(('f/h', True), (path, False))
+                self.assertTrue(os.path.exists(self._p('f/h')))
+            # An alias of a protected path, via a symlinked parent, is only
+            # caught by the walk, so earlier paths were already removed.
+            with self.assertRaisesRegex(
+                RootHelperError, "Will not remove b'meta', it is protected",
+            ):
+                remove(('f/g', True), ('f/up/meta', True))
+            self.assertFalse(os.path.exists(self._p('f/g')))
+            self.assertTrue(os.path.isdir(self._p('meta')))
+
+            # As with `os.path.lexists`, a file parent means "missing".
+            self.assertEqual([0], remove(('f/h/x', False)))
+            self.assertEqual([0, 2], remove(
+                ('nope', False),
+                ('f/i_sym', True),  # The symlink goes, not its target
+                ('nope/x', True),  # We stop here
+                ('f/h', True),
+            ))
+            self.assertEqual([], remove(
+                ('a/b/c/d', True), ('a/b/', True), ('f/h', True),
+            ))
+            self.assertEqual([], os.listdir(self._p('a')))
+            # `a/b/f_sym` was not followed, and `f/i` was protected anyway.
+            self.assertEqual(['i', 'up'], sorted(os.listdir(self._p('f'))))
+
+            for path in ['.', '/', 'f/..']:
+                with self.assertRaisesRegex(
+                    RootHelperError, 'Will not remove the subvolume root',
+                ):
+                    remove((path, False))
+            protected = ['/']
+            with self.assertRaisesRegex(RootHelperError, 'overlaps'):
+                remove(('f/up', True))
+            protected = []
+            self.assertEqual([], remove(('f', True), ('meta', True)))
+            self.assertEqual(['a', 'mnt'], sorted(os.listdir(self.subvol)))
+
+    def test_remove_tree_on_another_device(self):
+        os.makedirs(self._p('dir/sub'))
+        fd = os.open(self.subvol, os.O_RDONLY | os.O_DIRECTORY)
+        self.addCleanup(os.close, fd)
+
+        def remove(ino):
+            st = os.stat(self._p('dir'))
+            _remove_tree(fd, b'dir', os.stat_result((
+                st.st_mode, ino, st.st_dev + 1, *st[3:],
+            )), dev=st.st_dev, protected_inodes=set())
+
+        with self.assertRaisesRegex(RuntimeError, 'on another device'):
+            remove(12)
+        # Btrfs subvolumes are deleted with one ioctl, and without a walk.
+        with unittest.mock.patch('fcntl.ioctl') as ioctl:
+            remove(256)
+        (ioctl_fd, request, arg), = [c[0] for c in ioctl.call_args_list]
+        self.assertEqual((fd, 0x5000940f, 4096), (ioctl_fd, request, len(arg)))
+        self.assertEqual(b'dir\0', bytes(arg[8:12]))
+        for err, msg in [
+            (errno.ENOTTY, 'on another filesystem'),
+            (errno.EBUSY, 'Device or resource busy'),
+        ]:
+            with unittest.mock.patch(
+                'fcntl.ioctl', side_effect=OSError(err, os.strerror(err)),
+            ), self.assertRaisesRegex(Exception, msg):
+                remove(256)
+        self.assertTrue(os.path.isdir(self._p('dir/sub')))
+
+    def _tarball(self, name, members, *, padding=b''):
+        '''
+        Writes `members`, `(TarInfo fields, data)` pairs, and then `padding`
+        to a tarball, which is gzipped if `name` ends with `.tgz`.  Returns
+        a function making an `ExtractTarball` for it.
+        '''
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tf:
+            for fields, data in members:
+                info = tarfile.TarInfo()
+                for k, v in fields.items():
+                    setattr(info, k, v)
+                info.size = len(data or b'')
+                tf.addfile(info, io.BytesIO(data) if data else None)
+        content = buf.getvalue() + padding
+        if name.endswith('.tgz'):
+            content = gzip.compress(content)
+        path = os.path.join(self.td, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        tarball_hash = 'sha256:' + hashlib.sha256(content).hexdigest()
+        return lambda **kw: ExtractTarball(
+            source=path, hash=tarball_hash,
+            **{'force_root_ownership': False, **kw},
+        )
+
+    def test_extract_tarball(self):
+        big = b'0123456789' * 300000  # Several copy chunks
+        members = [
+            ({'name': './', 'type': tarfile.DIRTYPE, 'mode': 0o700}, None),
+            ({'name': 'old', 'type': tarfile.DIRTYPE, 'mode': 0o755}, None),
+            ({
+                'name': 'old/d', 'type': tarfile.DIRTYPE, 'mode': 0o2750,
+                'uid': 12, 'gid': 34, 'mtime': 1000,
+            }, None),
+            ({
+                'name': '/old/d/f', 'mode': 0o4755, 'uid': 56, 'gid': 78,
+                'uname': 'root', 'gname': 'nobody!', 'mtime': 2000,
+            }, big),
+            ({
+                'name': 'old/d/l', 'type': tarfile.SYMTYPE, 'linkname': 'f',
+                'uid': 9, 'gid': 10, 'mtime': 3000,
+            }, None),
+            ({
+                'name': 'old/d/h', 'type': tarfile.LNKTYPE,
+                'linkname': 'old/d/f',
+            }, None),
+            ({'name': 'p', 'type': tarfile.FIFOTYPE, 'mode': 0o640}, None),
+            ({
+                'name': 'n', 'type': tarfile.CHRTYPE, 'mode': 0o666,
+                'devmajor': 1, 'devminor': 3,
+            }, None),
+            ({
+                'name': 'b', 'type': tarfile.BLKTYPE, 'mode': 0o660,
+                'devmajor': 7, 'devminor': 0,
+            }, None),
+        ]
+        # `tarfile` stops at the end of the archive, but we still hash the
+        # padding after it.
+        padding = b'\0' * 2 ** 21
+        plain = self._tarball('t.tar', members, padding=padding)
+        gzipped = self._tarball('t.tgz', members, padding=padding)
+        with _serving_client(self.subvol.encode()) as helper:
+            for into_dir, make_op, force_root in [
+                ('x', plain, False), ('y/', gzipped, False),
+                ('/z', plain, True),
+            ]:
+
+                def p(path):
+                    return os.path.join(self._p(into_dir.strip('/')), path)
+
+                os.makedirs(p('old'))
+                os.chmod(p('.'), 0o711)
+                os.chown(p('old'), 123, 456)
+                helper.run([make_op(
+                    into_dir=into_dir, force_root_ownership=force_root,
+                )])
+
+                # `into_dir` and `old` keep their metadata.
+                self.assertEqual(0o711, _mode(p('.')))
+                self.assertEqual(
+                    (0o40755, 123, 456), tuple(os.lstat(p('old')))[:1] +
+                        tuple(os.lstat(p('old')))[4:6],
+                )
+                ids = {
+                    path: tuple(os.lstat(p(path)))[4:6]
+                        for path in ['old/d', 'old/d/f', 'old/d/l']
+                }
+                self.assertEqual({
+                    path: (0, 0) for path in ids
+                } if force_root else {
+                    # `root` exists on the host, but `nobody!` does not.
+                    'old/d': (12, 34), 'old/d/f': (0, 78), 'old/d/l': (9, 10),
+                }, ids)
+                for path, mode, mtime in [
+                    ('old/d', 0o42750, 1000),
+                    ('old/d/f', 0o104755, 2000),
+                    ('old/d/l', 0o120777, 3000),
+                    ('p', 0o10640, 0),
+                    ('n', 0o20666, 0),
+                    ('b', 0o60660, 0),
+                ]:
+                    st = os.lstat(p(path))
+                    self.assertEqual(
+                        (mode, mtime, mtime),
+                        (st.st_mode, st.st_atime, st.st_mtime), path,
+                    )
+                self.assertEqual(os.makedev(1, 3), os.lstat(p('n')).st_rdev)
+                with open(p('old/d/h'), 'rb') as f:
+                    self.assertEqual(big, f.read())
+                self.assertEqual(
+                    os.lstat(p('old/d/f')).st_ino,
+                    os.lstat(p('old/d/h')).st_ino,
+                )
+                self.assertEqual('f', os.readlink(p('old/d/l')))
+
+            # Existing paths other than directories are errors, as are
+            # members outside of `into_dir`.  Neither a symlink in the
+            # image, nor one from the tarball, are written through.
+            os.makedirs(self._p('e/dir'))
+            os.symlink('/', self._p('e/abs'))
+            os.symlink('dir', self._p('e/rel'))
+            helper.run([self._tarball('e.tar', [
+                ({'name': 'rel/ok'}, None),
+            ])(into_dir='e')])
+            for member, msg in [
+                ({'name': 'dir', 'type': tarfile.DIRTYPE}, None),
+                ({'name': 'rel'}, 'FileExistsError'),
+                ({'name': 'dir/ok', 'type': tarfile.DIRTYPE}, 'FileExists'),
+                ({'name': 'abs/x'}, 'traverses absolute symlink'),
+                ({'name': '../x'}, 'outside the subvol'),
+                ({'name': 'x', 'type': b'Z'}, "x has unknown type b'Z'"),
+            ]:
+                for name in ['e.tar', 'e.tgz']:
+                    make_op = self._tarball(name, [(member, None)])
+                    if msg is None:
+                        helper.run([make_op(into_dir='e')])
+                        continue
+                    with self.assertRaisesRegex(RootHelperError, msg):
+                        helper.run([make_op(into_dir='e')])
+            self.assertEqual(
+                ['ok'], os.listdir(self._p('e/dir')),
+            )
+
+            # A failure while a big tarball is still being decompressed
+            # stops the decompressor, too.
+            make_op = self._tarball('e.tgz', [
+                ({'name': 'rel'}, None),
+                ({'name': 'big'}, os.urandom(2 ** 22)),
+            ])
+            with self.assertRaisesRegex(RootHelperError, 'FileExistsError'):
+                helper.run([make_op(into_dir='e')])
+
+            # A tarball that fails hash validation is not extracted at all.
+            make_op = self._tarball('f.tar', [({'name': 'f'}, b'x')])
+            with open(make_op(into_dir='f').source, 'ab') as f:
+                f.write(b'\0' * 512)
+            os.mkdir(self._p('f'))
+            with self.assertRaisesRegex(RootHelperError, 'failed hash val'):
+                helper.run([make_op(into_dir='f')])
+            self.assertEqual([], os.listdir(self._p('f')))
+
+        # `pzstd` and `pigz` are optional.
+        for which, tools in [
+            (None, ['zstd', 'gzip']), ('/bin/x', ['pzstd', 'pigz']),
+        ]:
+            with unittest.mock.patch('shutil.which', return_value=which):
+                self.assertEqual(
+                    [[tool, '--decompress', '--stdout'] for tool in tools],
+                    [decompress_command(p) for p in ['a.zst', b'b.tgz']],
+                )
+        self.assertIsNone(decompress_command('c.tar.xz'))
+
+    def test_errors(self):
+        os.symlink('/', self._p('abs'))
+        os.symlink('..', self._p('up'))
+        os.symlink('loop', self._p('loop'))
+        with open(self._p('file'), 'w'):
+            pass
+        with _serving_client(self.subvol.encode()) as helper:
+            for op, msg in [
+                (Chmod(path='abs', mode=0o755), 'is a symlink'),
+                (MakeDirs(path='abs/x'), 'traverses absolute symlink'),
+                (MakeDirs(path='up/x'), 'exits the subvol'),
+                (Lstat(path='a/../../x'), 'outside the subvol'),
+                (Lstat(path='loop/x'), 'Too many symlinks'),
+                (Lstat(path='file/x'), 'NotADirectoryError'),
+                (MakeDirs(path='file'), 'NotADirectoryError'),
+                (Chown(path='file', user='nobody!', group='0'), 'Unknown'),
+                (Chown(path='file', user='0', group='nobody!'), 'Unknown'),
+                (CopyFile(source=self._p('file'), dest='abs'), 'ELOOP|link'),
+            ]:
+                with self.assertRaisesRegex(RootHelperError, msg) as ctx:
+                    helper.run([Lstat(path='file'), op, Lstat(path='x')])
+                self.assertEqual(op, ctx.exception.cmd)
+                # It is still a `CalledProcessError`, like `run_as_root`.
+                self.assertIsInstance(
+                    ctx.exception, subprocess.CalledProcessError,
+                )
+        with _serving_client(os.path.join(self.td, 'nope').encode()) as h:
+            with self.assertRaisesRegex(RootHelperError, 'FileNotFound'):
+                h.run([Lstat(path='.')])
+
+    def test_copy_data(self):
+        src = os.path.join(self.td, 'src')
+        dst = os.path.join(self.td, 'dst')
+        content = b'0123456789' * 300000  # Several copy chunks
+        with open(src, 'wb') as f:
+            f.write(content)
+
+        def copy_chunk(src_fd, dst_fd, count):
+            return os.write(dst_fd, os.read(src_fd, count))
+
+        def copy(
+            *, ioctl_errno=None, copy_file_range_errno=None,
+            has_copy_file_range=True,
+        ):
+            calls = []
+
+            def ioctl(dst_fd, _request, src_fd):
+                calls.append('ioctl')
+                if ioctl_errno is None:  # Pretend to clone
+                    while copy_chunk(src_fd, dst_fd, len(content)):
+                        pass
+                    return 0
+                raise OSError(ioctl_errno, os.strerror(ioctl_errno))
+
+            def copy_file_range(*args):
+                calls.append('copy_file_range')
+                if copy_file_range_errno is None:
+                    return copy_chunk(*args)
+                # Copy a chunk first if the error is not a fallback one
+                if copy_file_range_errno == errno.EIO and len(calls) == 2:
+                    return copy_chunk(*args)
+                raise OSError(
+                    copy_file_range_errno, os.strerror(copy_file_range_errno),
+                )
+
+            with open(src, 'rb') as sf, open(dst, 'wb') as df, \
+                    unittest.mock.patch('fcntl.ioctl', side_effect=ioctl), \
+                    unittest.mock.patch.dict(os.__dict__, {
+                        'copy_file_range': copy_file_range,
+                    }):
+                if not has_copy_file_range:
+                    del os.copy_file_range
+                _copy_data(sf.fileno(), df.fileno())
+            with open(dst, 'rb') as f:
+                self.assertEqual(content, f.read())
+            return calls
+
+        self.assertEqual(['ioctl'], copy())
+        # Not the same filesystem, or it does not support cloning
+        for e in [errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL]:
+            self.assertEqual(['ioctl'] + ['copy_file_range'] * 4, copy(
+                ioctl_errno=e,
+            ))
+            # Falls back to `read` & `write`
+            self.assertEqual(['ioctl', 'copy_file_range'], copy(
+                ioctl_errno=e, copy_file_range_errno=errno.EXDEV,
+            ))
+            # Before Python 3.8
+            self.assertEqual(['ioctl'], copy(
+                ioctl_errno=e, has_copy_file_range=False,
+            ))
+        # Other errors propagate
+        with self.assertRaises(PermissionError):
+            copy(ioctl_errno=errno.EACCES)
+        with self.assertRaises(PermissionError):
+            copy(ioctl_errno=errno.EXDEV, copy_file_range_errno=errno.EACCES)
+        # Once some data is copied, falling back could corrupt the output.
+        with self.assertRaisesRegex(OSError, 'Input/output'):
+            copy(ioctl_errno=errno.EXDEV, copy_file_range_errno=errno.EIO)
+
+    def test_open_dir_closes_fds(self):
+        os.makedirs(self._p('a/b'))
+        os.symlink('a/b', self._p('l'))
+        root_fd = os.open(self.subvol, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fd = _open_dir(root_fd, [b'l', b'..', b'b', b'.'])
+            try:
+                self.assertEqual(
+                    os.stat(self._p('a/b')).st_ino, os.fstat(fd).st_ino,
+                )
+            finally:
+                os.close(fd)
+            before = set(os.listdir('/proc/self/fd'))
+            with self.assertRaises(FileNotFoundError):
+                _open_dir(root_fd, [b'a', b'b', b'missing'])
+            self.assertEqual(before, set(os.listdir('/proc/self/fd')))
+        finally:
+            os.close(root_fd)
+
+    def test_protocol(self):
+        a, b = socket.socketpair()
+        with a, b:
+            _send_msg(a, {'x': [1, 'y']})
+            self.assertEqual({'x': [1, 'y']}, _recv_msg(b))
+            a.sendall(b'\0\0\0\x05abc')
+            a.shutdown(socket.SHUT_WR)
+            with self.assertRaisesRegex(RuntimeError, '3 of 5 bytes'):
+                _recv_msg(b)
+            self.assertIsNone(_recv_msg(b))
+            with self.assertRaisesRegex(RuntimeError, 'exited unexpectedly'):
+                RootHelperClient(b).run([Lstat(path='.')])
+
+    def test_start_root_helper(self):
+        argvs = []
+
+        def popen(argv):
+            argvs.append(argv)
+            return subprocess.Popen(argv)
+
+        with start_root_helper(self.subvol, popen) as helper:
+            helper.run([MakeDirs(path='x/y', mode=0o750)])
+            self.assertEqual(
+                [None], helper.run([Symlink(source='y', dest='x/z')]),
+            )
+        self.assertEqual(0o750, _mode(self._p('x/y')))
+        self.assertEqual('y', os.readlink(self._p('x/z')))
+        [argv] = argvs
+        self.assertEqual(['env', 'PYTHONDONTWRITEBYTECODE=1'], argv[:2])
+        self.assertEqual('root-helper', os.path.basename(argv[2]))
+        opts = parse_opts(argv[3:])
+        self.assertEqual(self.subvol, opts.subvol)
+
+        # We do not wait for the timeout if the helper fails to start.
+        with self.assertRaisesRegex(RuntimeError, 'exited with 1'):
+            with start_root_helper(self.subvol, lambda argv: subprocess.Popen(
+                ['false'],
+            )):
+                pass  # pragma: no cover
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import tempfile
 import unittest
 import unittest.mock
 
+from root_helper import Lstat, MakeDirs
 from subvol_utils import Subvol, get_subvolume_path
 
 from find_built_subvol import subvolumes_dir
@@ -82,6 +83,30 @@ class SubvolTestCase(unittest.TestCase):
         with open(sv.path('hello')) as infile:
             self.assertEqual('world', infile.read())
 
+    @with_temp_subvols
+    def test_root_helper(self, temp_subvols):
+        with self.assertRaisesRegex(AssertionError, 'does not exist'):
+            Subvol('/dev/null/no-such-dir').run_root_helper_ops([])
+
+        sv = temp_subvols.create('subvol')
+        # Without `root_helper()`, we start a helper just for this batch.
+        self.assertEqual([None], sv.run_root_helper_ops([MakeDirs(path='a')]))
+
+        # The helper can start before the subvolume exists.
+        sv2 = temp_subvols.caller_will_create('subvol2')
+        with sv2.root_helper() as helper:
+            with self.assertRaisesRegex(AssertionError, 'already running'):
+                with sv2.root_helper():
+                    pass  # pragma: no cover
+            sv2.snapshot(sv)
+            self.assertEqual(
+                [None], sv2.run_root_helper_ops([MakeDirs(path='a/b')]),
+            )
+            [st] = helper.run([Lstat(path='a/b')])
+            self.assertEqual(0, st['uid'])
+        self.assertTrue(os.path.isdir(sv2.path('a/b')))
+        self.assertFalse(os.path.exists(sv.path('a/b')))
+
     @with_temp_subvols
     def test_mark_readonly_and_get_sendstream(self, temp_subvols):
         sv = temp_subvols.create('subvol')